@@ -0,0 +1,181 @@
+# 批量評估：以 JSONL 問題集並行執行直接 LLM 及多層次優化流程，結果寫入 JSONL（或 Parquet）。
+#
+# 輸入檔案每行一個 JSON 物件（id、additional_info、original_facts 為可選，id 預設為行號）：
+#     {"id": "q1", "user_question": "...", "additional_info": "...", "original_facts": "..."}
+# 輸出檔案同時作為檢查點：每完成一條問題便追加一行，重新執行時會略過已成功的問題。
+#
+# 用法：
+#     python batch_eval.py questions.jsonl -o results.jsonl --concurrency 8 --rpm 500 --tpm 200000
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import main
+from rate_limit import RateLimiter
+
+
+# 讀取問題集，返回 [(id, 問題)]
+def load_questions(path):
+    questions = []
+    with open(path, encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if not item.get('user_question'):
+                print(f"[錯誤] 第 {line_number} 行缺少 user_question，已略過")
+                continue
+            questions.append((str(item.get('id', line_number)), item))
+    return questions
+
+
+# 讀取檢查點（即已有的輸出檔案），返回已成功完成的問題 id
+def load_completed(path):
+    completed = set()
+    if not os.path.exists(path):
+        return completed
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # 上次中斷時寫了一半的行
+            if record.get('status') == 'ok':
+                completed.add(record['id'])
+    return completed
+
+
+# 對單條問題執行流程，返回輸出記錄
+def evaluate_question(question_id, item, mode, beam_config, iteration_config=None):
+    user_question = item['user_question']
+    additional_info = item.get('additional_info', "")
+    original_facts = item.get('original_facts', "")
+    record = {'id': question_id, 'user_question': user_question}
+    start = time.monotonic()
+    try:
+        direct_result = None
+        if mode in ('direct', 'both'):
+            direct_result = main.run_direct_llm(user_question, additional_info)
+            record['direct'] = direct_result
+            original_facts = original_facts or direct_result['original_facts']
+        if mode in ('optimized', 'both'):
+            result = main.run_main_loop(user_question, additional_info, original_facts,
+                                        direct_result=direct_result, beam_config=beam_config,
+                                        iteration_config=iteration_config)
+            record['optimized'] = {
+                'final_answer': result['final_answer'],
+                'initial_score': result['initial_score'],
+                'final_score': result['final_score'],
+                'total_tokens': result['total_tokens'],
+                'core_facts': result['core_facts'],
+                'comparison_result': result['comparison_result'],
+                'iterations': [{'iteration': data['iteration'], 'score': data['score'], 'scores': data['scores']}
+                               for data in result['iterations_data']],
+                'stop_reason': result['stop_reason'],
+                'llm_usage': result['llm_usage'],
+                'trace': result['trace'],
+            }
+        record['status'] = 'ok'
+    except Exception as e:
+        print(f"[錯誤] 問題 {question_id} 執行失敗: {e}")
+        record['status'] = 'error'
+        record['error'] = str(e)
+    record['elapsed_seconds'] = round(time.monotonic() - start, 3)
+    return record
+
+
+# 將 JSONL 結果轉換為 Parquet（需要安裝 pyarrow）
+def write_parquet(jsonl_path, parquet_path):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        print("[錯誤] 輸出 Parquet 需要安裝 pyarrow，結果已保留在 " + jsonl_path)
+        return False
+    latest = {}
+    with open(jsonl_path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            latest[record['id']] = record  # 同一問題只保留最後一次的結果
+    rows = [{key: json.dumps(value, ensure_ascii=False) if isinstance(value, (dict, list)) else value
+             for key, value in record.items()} for record in latest.values()]
+    pq.write_table(pa.Table.from_pylist(rows), parquet_path)
+    return True
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="以 JSONL 問題集批量執行答案迭代流程")
+    parser.add_argument('input', help="輸入的 JSONL 問題集")
+    parser.add_argument('-o', '--output', default="batch_results.jsonl", help="輸出檔案（.jsonl 或 .parquet）")
+    parser.add_argument('--mode', choices=['direct', 'optimized', 'both'], default='both', help="執行的流程")
+    parser.add_argument('--concurrency', type=int, default=4, help="同時處理的問題數量")
+    parser.add_argument('--rpm', type=int, default=None, help="每分鐘 LLM 請求數上限")
+    parser.add_argument('--tpm', type=int, default=None, help="每分鐘 LLM token 數上限")
+    parser.add_argument('--beam', action='store_true', help="以 beam 模式進行優化迭代")
+    parser.add_argument('--max-rounds', type=int, default=None, help="每條問題最多的優化輪數")
+    parser.add_argument('--max-tokens', type=int, default=None, help="每條問題的 token 上限")
+    parser.add_argument('--max-cost', type=float, default=None, help="每條問題的成本上限（美元）")
+    parser.add_argument('--deadline', type=float, default=None, help="每條問題優化迭代的截止時間（秒）")
+    parser.add_argument('--limit', type=int, default=None, help="最多處理的問題數量")
+    return parser.parse_args(argv)
+
+
+def main_cli(argv=None):
+    args = parse_args(argv)
+    parquet_path = args.output if args.output.endswith('.parquet') else None
+    checkpoint_path = f"{args.output}.jsonl" if parquet_path else args.output
+
+    questions = load_questions(args.input)
+    completed = load_completed(checkpoint_path)
+    pending = [(question_id, item) for question_id, item in questions if question_id not in completed]
+    if args.limit is not None:
+        pending = pending[:args.limit]
+    print(f"[INFO] 共 {len(questions)} 條問題，已完成 {len(completed)} 條，本次處理 {len(pending)} 條")
+
+    if args.rpm or args.tpm:
+        main.llm_rate_limiter = RateLimiter(rpm=args.rpm, tpm=args.tpm)
+    beam_config = main.beam_config_from_request({'beam': True}) if args.beam else None
+    # 命令行由操作者執行，可放寬伺服器的預設上限（請求中的設定則只能收緊）
+    iteration_config = dict(main.DEFAULT_ITERATION_CONFIG, **{
+        key: value for key, value in (('max_rounds', args.max_rounds), ('max_tokens', args.max_tokens),
+                                      ('max_cost', args.max_cost), ('deadline', args.deadline))
+        if value is not None})
+
+    succeeded = failed = 0
+    start = time.monotonic()
+    with open(checkpoint_path, 'a+', encoding='utf-8') as output, \
+            ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix='batch') as executor:
+        if output.tell() > 0:
+            output.seek(output.tell() - 1)
+            if output.read(1) != '\n':
+                output.write('\n')  # 上次中斷時最後一行未寫完，從新的一行開始
+        futures = [executor.submit(evaluate_question, question_id, item, args.mode, beam_config, iteration_config)
+                   for question_id, item in pending]
+        for done_count, future in enumerate(as_completed(futures), 1):
+            record = future.result()
+            output.write(json.dumps(record, ensure_ascii=False) + '\n')
+            output.flush()
+            os.fsync(output.fileno())  # 每條結果都落盤，崩潰後可從檢查點繼續
+            if record['status'] == 'ok':
+                succeeded += 1
+            else:
+                failed += 1
+            elapsed = time.monotonic() - start
+            print(f"[INFO] 進度 {done_count}/{len(pending)}（成功 {succeeded}，失敗 {failed}），"
+                  f"吞吐量 {done_count / elapsed * 60:.1f} 條/分鐘")
+
+    main.get_search_log().flush()
+    if parquet_path:
+        write_parquet(checkpoint_path, parquet_path)
+    print(f"[INFO] 批量評估完成：成功 {succeeded} 條，失敗 {failed} 條，用時 {time.monotonic() - start:.1f} 秒")
+    return 0 if failed == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
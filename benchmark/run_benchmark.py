@@ -0,0 +1,374 @@
+# 效能基準測試：以本地模擬的 OpenAI / Firecrawl 服務（stub_server.py）驅動應用程式，
+# 在受控的並行數下量度 /direct_llm、/main_loop、/main_loop_stream 及批量評估流程的延遲分佈、
+# 吞吐量、每個請求的 LLM 調用次數及 token 用量、以及進程的峰值記憶體（RSS），並與已儲存的基準比較。
+#
+# 用法：
+#     python benchmark/run_benchmark.py --requests 20 --concurrency 4 --latency-ms 200
+#     python benchmark/run_benchmark.py --save-baseline                 # 以本次結果更新基準
+#     python benchmark/run_benchmark.py --scenarios direct,stream --tolerance 0.15
+# 結果比基準差超過容許比例時以返回碼 1 結束，可用於 CI。
+import argparse
+import contextlib
+import json
+import logging
+import math
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from stub_server import StubConfig, start_stub_server  # noqa: E402
+
+SCENARIOS = ['direct', 'main_loop', 'stream', 'batch']
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# 比較基準時檢查的指標，True 表示數值越大越好
+COMPARED_METRICS = {
+    'p50_seconds': False,
+    'p95_seconds': False,
+    'p99_seconds': False,
+    'throughput_per_minute': True,
+    'llm_calls_per_request': False,
+    'tokens_per_request': False,
+    'peak_rss_mb': False,
+    'response_kb_per_request': False,
+}
+
+
+# 以最近秩法計算百分位數
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024  # macOS 以字節為單位，Linux 以 KB 為單位
+
+
+# 返回 (回應 JSON, 回應字節數)
+def post_json(url, payload, timeout=600):
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    request = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        raw = response.read()
+        return json.loads(raw), len(raw)
+
+
+# 讀取 SSE 串流，返回 (首個答案片段的秒數, 最終結果, 串流字節數)
+def post_stream(url, payload, start, timeout=600):
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    request = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'})
+    first_delta = None
+    event = None
+    size = 0
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        for raw_line in response:
+            size += len(raw_line)
+            line = raw_line.decode('utf-8').rstrip('\n')
+            if line.startswith('event: '):
+                event = line[len('event: '):]
+                if event == 'delta' and first_delta is None:
+                    first_delta = time.monotonic() - start
+            elif line.startswith('data: ') and event in ('result', 'error'):
+                data = json.loads(line[len('data: '):])
+                if event == 'error':
+                    raise RuntimeError(data.get('message'))
+                return first_delta, data, size
+    raise RuntimeError("串流在返回結果前結束")
+
+
+def make_question(i, offset, args):
+    item = {'user_question': f"第 {offset + i} 題：請解釋城市化對氣候變化的影響，並舉出具體例子。"}
+    if args.urls:
+        # 每個請求引用 args.urls 個網址，同一場景內部分網址在請求之間重複，以反映抓取快取的效果
+        item['additional_info'] = " ".join(f"https://example.com/{offset}/page-{(i + k) % (args.urls * 2)}"
+                                           for k in range(args.urls))
+    return item
+
+
+class ScenarioRunner:
+    def __init__(self, args, base_url, stub_stats):
+        self.args = args
+        self.base_url = base_url
+        self.stub_stats = stub_stats
+
+    # 以 args.concurrency 個線程執行 func(i)，返回 (每個請求的結果列表, 總秒數)
+    def _run_concurrently(self, func, count):
+        def timed(i):
+            start = time.monotonic()
+            try:
+                extra = func(i)
+                return {'ok': True, 'seconds': time.monotonic() - start, 'extra': extra}
+            except Exception as e:
+                return {'ok': False, 'seconds': time.monotonic() - start, 'error': str(e)}
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.args.concurrency, thread_name_prefix='bench') as executor:
+            results = list(executor.map(timed, range(count)))
+        return results, time.monotonic() - start
+
+    # 為 main_loop / stream 場景預先取得直接 LLM 的結果（不計入量度）
+    def _prepare_direct_results(self, offset):
+        results, _ = self._run_concurrently(
+            lambda i: post_json(f"{self.base_url}/direct_llm", make_question(i, offset, self.args))[0],
+            self.args.requests)
+        failed = [result['error'] for result in results if not result['ok']]
+        if failed:
+            raise RuntimeError(f"預備直接 LLM 結果失敗: {failed[0]}")
+        return [result['extra'] for result in results]
+
+    # 以 batch_eval 命令行工具（包括檢查點及搜索日志寫入）處理同一批問題，返回 (每條問題的結果列表, 總秒數)
+    def _run_batch(self, offset):
+        import batch_eval
+
+        with tempfile.TemporaryDirectory(prefix="bench-batch-") as directory:
+            input_path = os.path.join(directory, "questions.jsonl")
+            output_path = os.path.join(directory, "results.jsonl")
+            with open(input_path, 'w', encoding='utf-8') as f:
+                for i in range(self.args.requests):
+                    f.write(json.dumps(dict(make_question(i, offset, self.args), id=str(i)), ensure_ascii=False) + '\n')
+            argv = [input_path, '-o', output_path, '--concurrency', str(self.args.concurrency)]
+            if self.args.beam:
+                argv.append('--beam')
+            start = time.monotonic()
+            exit_code = batch_eval.main_cli(argv)
+            elapsed = time.monotonic() - start
+            with open(output_path, encoding='utf-8') as f:
+                records = [json.loads(line) for line in f if line.strip()]
+        results = [{'ok': record['status'] == 'ok', 'seconds': record['elapsed_seconds'], 'extra': {},
+                    'error': record.get('error')} for record in records]
+        if exit_code != 0 and all(result['ok'] for result in results):
+            results.append({'ok': False, 'seconds': elapsed, 'error': f"batch_eval 返回碼 {exit_code}"})
+        return results, elapsed
+
+    def run(self, scenario, offset):
+        prepared = None
+        if scenario in ('main_loop', 'stream'):
+            prepared = self._prepare_direct_results(offset)
+
+        def direct_request(i):
+            result, size = post_json(f"{self.base_url}/direct_llm", make_question(i, offset, self.args))
+            result['response_bytes'] = size
+            return result
+
+        def main_loop_request(i):
+            start = time.monotonic()
+            payload = dict(make_question(i, offset, self.args), **prepared[i])
+            if self.args.beam:
+                payload['beam'] = True
+            if self.args.compact:
+                payload['compact'] = True
+            if scenario == 'main_loop':
+                result, size = post_json(f"{self.base_url}/main_loop", payload)
+            else:
+                first_delta, result, size = post_stream(f"{self.base_url}/main_loop_stream", payload, start)
+                result['first_delta_seconds'] = first_delta
+            result['response_bytes'] = size
+            return result
+
+        before = self.stub_stats.snapshot()
+        if scenario == 'batch':
+            results, elapsed = self._run_batch(offset)
+        else:
+            func = {'direct': direct_request, 'main_loop': main_loop_request, 'stream': main_loop_request}[scenario]
+            results, elapsed = self._run_concurrently(func, self.args.requests)
+        after = self.stub_stats.snapshot()
+        return summarize(scenario, results, elapsed, before, after)
+
+
+def summarize(scenario, results, elapsed, before, after):
+    ok = [result for result in results if result['ok']]
+    latencies = [result['seconds'] for result in ok]
+    count = max(1, len(results))
+    calls = after['chat_calls'] - before['chat_calls']
+    tokens = (after['prompt_tokens'] + after['completion_tokens']) - (before['prompt_tokens'] + before['completion_tokens'])
+    summary = {
+        'requests': len(results),
+        'errors': len(results) - len(ok),
+        'p50_seconds': percentile(latencies, 50),
+        'p95_seconds': percentile(latencies, 95),
+        'p99_seconds': percentile(latencies, 99),
+        'throughput_per_minute': len(ok) / elapsed * 60 if elapsed else None,
+        'llm_calls_per_request': calls / count,
+        'tokens_per_request': tokens / count,
+        'scrape_calls': after['scrape_calls'] - before['scrape_calls'],
+        'rate_limited_calls': after['rate_limited'] - before['rate_limited'],
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    sizes = [result['extra']['response_bytes'] for result in ok if 'response_bytes' in result['extra']]
+    if sizes:
+        summary['response_kb_per_request'] = sum(sizes) / len(sizes) / 1024  # 未壓縮的回應大小
+    if scenario == 'stream':
+        first_deltas = [result['extra']['first_delta_seconds'] for result in ok
+                        if result['extra'].get('first_delta_seconds') is not None]
+        summary['first_delta_p50_seconds'] = percentile(first_deltas, 50)
+        summary['first_delta_p95_seconds'] = percentile(first_deltas, 95)
+    if len(ok) < len(results):
+        summary['first_error'] = next(result['error'] for result in results if not result['ok'])
+    return summary
+
+
+# 與基準比較，返回退步的項目 [(場景, 指標, 基準值, 本次數值)]
+def compare_with_baseline(report, baseline, tolerance):
+    regressions = []
+    for scenario, summary in report['scenarios'].items():
+        reference = baseline.get('scenarios', {}).get(scenario)
+        if not reference:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            old, new = reference.get(metric), summary.get(metric)
+            if old is None or new is None or old == 0:
+                continue
+            change = (new - old) / old
+            if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+                regressions.append((scenario, metric, old, new))
+    return regressions
+
+
+def format_value(value):
+    if value is None:
+        return "-"
+    return f"{value:.3f}" if isinstance(value, float) else str(value)
+
+
+def print_report(report, baseline):
+    columns = ['requests', 'errors', 'p50_seconds', 'p95_seconds', 'p99_seconds', 'throughput_per_minute',
+               'llm_calls_per_request', 'tokens_per_request', 'scrape_calls', 'rate_limited_calls', 'peak_rss_mb',
+               'response_kb_per_request']
+    for scenario, summary in report['scenarios'].items():
+        reference = (baseline or {}).get('scenarios', {}).get(scenario, {})
+        print(f"\n== {scenario} ==")
+        for column in columns + [key for key in summary if key.startswith('first_')]:
+            line = f"  {column:<26}{format_value(summary.get(column)):>14}"
+            if isinstance(reference.get(column), (int, float)) and isinstance(summary.get(column), (int, float)):
+                old = reference[column]
+                line += f"   基準 {format_value(old):>10}"
+                if old:
+                    line += f" ({(summary[column] - old) / old:+.1%})"
+            print(line)
+    startup = report.get('startup')
+    if startup:
+        print("\n== startup ==")
+        for key in ('import_seconds', 'create_app_seconds', 'rss_mb'):
+            print(f"  {key:<26}{format_value(startup.get(key)):>14}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="以本地模擬服務量度答案迭代流程的效能")
+    parser.add_argument('--scenarios', default=",".join(SCENARIOS), help=f"執行的場景（{', '.join(SCENARIOS)}）")
+    parser.add_argument('--requests', type=int, default=20, help="每個場景的請求數量")
+    parser.add_argument('--concurrency', type=int, default=4, help="同時發出的請求數量")
+    parser.add_argument('--urls', type=int, default=2, help="每個請求附帶的網址數量（0 表示不抓取網頁）")
+    parser.add_argument('--beam', action='store_true', help="以 beam 模式進行優化迭代")
+    parser.add_argument('--compact', action='store_true', help="主循環使用精簡回應模式")
+    parser.add_argument('--latency-ms', type=float, default=200, help="模擬 LLM 請求的基本延遲")
+    parser.add_argument('--jitter-ms', type=float, default=50, help="模擬延遲的隨機附加上限")
+    parser.add_argument('--tokens-per-second', type=float, default=400, help="模擬的生成速度（0 表示不按長度延遲）")
+    parser.add_argument('--answer-tokens', type=int, default=400, help="模擬回答的 token 數量")
+    parser.add_argument('--score-min', type=int, default=30, help="模擬評估總分的下限（滿分 50）")
+    parser.add_argument('--score-max', type=int, default=44, help="模擬評估總分的上限（滿分 50）")
+    parser.add_argument('--scrape-latency-ms', type=float, default=300, help="模擬抓取網頁的延遲")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help="模擬以 429 回應的 LLM 請求比例")
+    parser.add_argument('--slow-rate', type=float, default=0.0, help="模擬長尾延遲的 LLM 請求比例")
+    parser.add_argument('--slow-ms', type=float, default=0, help="長尾請求的額外延遲")
+    parser.add_argument('--output', default=None, help="將結果寫入 JSON 檔案")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help="基準結果的 JSON 檔案")
+    parser.add_argument('--save-baseline', action='store_true', help="以本次結果覆蓋基準")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="容許比基準差的比例")
+    parser.add_argument('--verbose', action='store_true', help="顯示應用程式的日志輸出")
+    return parser.parse_args(argv)
+
+
+def main_cli(argv=None):
+    args = parse_args(argv)
+    scenarios = [scenario.strip() for scenario in args.scenarios.split(',') if scenario.strip()]
+    unknown = [scenario for scenario in scenarios if scenario not in SCENARIOS]
+    if unknown:
+        print(f"[錯誤] 未知的場景: {', '.join(unknown)}")
+        return 2
+
+    config = StubConfig(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, tokens_per_second=args.tokens_per_second,
+                        answer_tokens=args.answer_tokens, score_range=(args.score_min, args.score_max),
+                        scrape_latency_ms=args.scrape_latency_ms, seed=args.seed, error_rate=args.error_rate,
+                        slow_rate=args.slow_rate, slow_ms=args.slow_ms)
+    stub_server, stub_stats = start_stub_server(config)
+    stub_url = f"http://127.0.0.1:{stub_server.server_address[1]}"
+
+    # 應用程式在導入時讀取環境變量，因此須在導入 main 之前指向模擬服務
+    log_dir = tempfile.mkdtemp(prefix="bench-search-log-")
+    os.environ.update({
+        'OPENAI_BASE_URL': f"{stub_url}/v1",
+        'OPENAI_API_KEY': "stub",
+        'FIRECRAWL_API_URL': stub_url,
+        'FIRECRAWL_API_KEY': "stub",
+        'SEARCH_LOG_DIR': log_dir,
+        'LLM_CACHE_DB': "",
+        'SCRAPE_CACHE_DB': "",
+    })
+    from werkzeug.serving import make_server
+
+    import main
+
+    if not args.verbose:
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    app_server = make_server("127.0.0.1", 0, main.app, threaded=True)
+    threading.Thread(target=app_server.serve_forever, name='bench-app', daemon=True).start()
+    runner = ScenarioRunner(args, f"http://127.0.0.1:{app_server.server_port}", stub_stats)
+
+    report = {
+        'timestamp': time.time(),
+        'settings': {key: value for key, value in vars(args).items()
+                     if key not in ('output', 'baseline', 'save_baseline', 'tolerance', 'verbose')},
+        'startup': dict(main.startup_report),  # 導入 main 及建立應用程式的冷啟動用時及記憶體
+        'scenarios': {},
+    }
+    for index, scenario in enumerate(scenarios):
+        print(f"[INFO] 執行場景 {scenario}（{args.requests} 個請求，並行數 {args.concurrency}）")
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(sys.stdout if args.verbose else devnull):
+            # 每個場景使用不同的問題，避免 LLM 回應快取令後面的場景失真
+            report['scenarios'][scenario] = runner.run(scenario, offset=index * args.requests)
+
+    app_server.shutdown()
+    stub_server.shutdown()
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n[INFO] 已更新基準 {args.baseline}")
+        return 0
+
+    if baseline:
+        if baseline.get('settings') != report['settings']:
+            print("\n[INFO] 本次設定與基準不同，比較結果僅供參考")
+        regressions = compare_with_baseline(report, baseline, args.tolerance)
+        if regressions:
+            print(f"\n[錯誤] 以下指標比基準差超過 {args.tolerance:.0%}:")
+            for scenario, metric, old, new in regressions:
+                print(f"  {scenario}.{metric}: {format_value(old)} -> {format_value(new)}")
+            return 1
+        print(f"\n[INFO] 所有指標均在基準的 {args.tolerance:.0%} 範圍內")
+    errors = sum(summary['errors'] for summary in report['scenarios'].values())
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
@@ -0,0 +1,260 @@
+# 本地模擬的 OpenAI Chat Completions 及 Firecrawl 抓取 API，用於在不花費 API 費用的情況下量度效能。
+#
+# 用法（獨立執行）：
+#     python benchmark/stub_server.py --port 8900 --latency-ms 300 --tokens-per-second 200
+# 然後設定：
+#     OPENAI_BASE_URL=http://127.0.0.1:8900/v1 OPENAI_API_KEY=stub
+#     FIRECRAWL_API_URL=http://127.0.0.1:8900 FIRECRAWL_API_KEY=stub
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ASPECTS = ["準確性", "全面性", "深度", "相關例子", "論證的邏輯性"]
+
+
+# 模擬服務的設定
+class StubConfig:
+    def __init__(self, latency_ms=200, jitter_ms=50, tokens_per_second=0, answer_tokens=400,
+                 score_range=(30, 44), scrape_latency_ms=300, page_paragraphs=40, seed=0, error_rate=0.0,
+                 slow_rate=0.0, slow_ms=0):
+        self.latency_ms = latency_ms  # 每個請求的基本延遲
+        self.jitter_ms = jitter_ms  # 隨機附加的延遲上限
+        self.tokens_per_second = tokens_per_second  # 生成速度，0 表示不按生成長度延遲
+        self.answer_tokens = answer_tokens  # 每個回答的 completion token 數（不超過 max_tokens）
+        self.score_range = score_range  # 評估總分（滿分 50）的隨機範圍
+        self.scrape_latency_ms = scrape_latency_ms
+        self.page_paragraphs = page_paragraphs
+        self.error_rate = error_rate  # 以 429 回應的 LLM 請求比例
+        self.slow_rate = slow_rate  # 額外延遲 slow_ms 的 LLM 請求比例（模擬長尾延遲）
+        self.slow_ms = slow_ms
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+
+# 模擬服務的統計
+class StubStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.chat_calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.scrape_calls = 0
+        self.rate_limited = 0
+
+    def snapshot(self):
+        with self.lock:
+            return {'chat_calls': self.chat_calls, 'prompt_tokens': self.prompt_tokens,
+                    'completion_tokens': self.completion_tokens, 'scrape_calls': self.scrape_calls,
+                    'rate_limited': self.rate_limited}
+
+
+# 粗略估算 token 數（中文約每字 1 token，英文約每 4 字符 1 token）
+def estimate_tokens(text):
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return max(1, (len(text) - ascii_chars) + ascii_chars // 4)
+
+
+# 生成包含 "總評分：NN/50" 的評估文本
+def evaluation_text(config):
+    with config.lock:
+        total = config.random.randint(*config.score_range)
+    # 總分平均分配到各方面，餘數加到前面的方面
+    base, extra = divmod(total, len(ASPECTS))
+    parts = [f"{i + 1}. {aspect}：{base + (1 if i < extra else 0)}/10 - 評論。" for i, aspect in enumerate(ASPECTS)]
+    return "\n".join(parts) + f"\n\n總評分：{total}/50\n\n改進建議：增加具體例子及資料出處。"
+
+
+# 按 JSON schema 生成結構化輸出（用於 response_format 及 function calling），整數按評分範圍隨機生成
+def schema_value(schema, config):
+    kind = schema.get('type')
+    if kind == 'object':
+        return {key: schema_value(value, config) for key, value in schema.get('properties', {}).items()}
+    if kind == 'array':
+        return [schema_value(schema.get('items', {}), config)]
+    if kind in ('integer', 'number'):
+        with config.lock:
+            return config.random.randint(config.score_range[0] // len(ASPECTS), -(-config.score_range[1] // len(ASPECTS)))
+    if kind == 'boolean':
+        return True
+    return "模擬的評論及改進建議。"
+
+
+def answer_text(tokens):
+    sentence = "這是模擬的回答內容，用於效能測試。"
+    return (sentence * (tokens // len(sentence) + 1))[:tokens]
+
+
+def make_handler(config, stats):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass  # 不打印每個請求的日志
+
+        def _read_json(self):
+            length = int(self.headers.get('Content-Length', 0))
+            return json.loads(self.rfile.read(length) or b"{}")
+
+        def _send_json(self, data, status=200):
+            body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _delay(self, base_ms):
+            with config.lock:
+                jitter = config.random.uniform(0, config.jitter_ms)
+            time.sleep((base_ms + jitter) / 1000)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._send_json(stats.snapshot())
+            else:
+                self._send_json({'error': 'not found'}, 404)
+
+        def do_POST(self):
+            if self.path.endswith('/chat/completions'):
+                self._chat_completions(self._read_json())
+            elif self.path.endswith('/scrape'):
+                self._scrape(self._read_json())
+            else:
+                self._send_json({'error': 'not found'}, 404)
+
+        def _chat_completions(self, payload):
+            with config.lock:
+                rate_limited = config.random.random() < config.error_rate
+                slow = config.random.random() < config.slow_rate
+            if rate_limited:
+                with stats.lock:
+                    stats.rate_limited += 1
+                self._delay(config.latency_ms / 4)
+                body = json.dumps({'error': {'message': "Rate limit reached", 'type': 'requests',
+                                             'code': 'rate_limit_exceeded'}}).encode('utf-8')
+                self.send_response(429)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('Retry-After', '0')
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            if slow:
+                time.sleep(config.slow_ms / 1000)
+            prompt = "".join(message.get('content') or "" for message in payload.get('messages', []))
+            tool_calls = None
+            response_format = payload.get('response_format') or {}
+            if payload.get('tools'):
+                function = payload['tools'][0]['function']
+                arguments = json.dumps(schema_value(function.get('parameters', {}), config), ensure_ascii=False)
+                tool_calls = [{'id': f"call_{uuid.uuid4().hex[:24]}", 'type': 'function',
+                               'function': {'name': function['name'], 'arguments': arguments}}]
+                content = None
+            elif response_format.get('type') == 'json_schema':
+                content = json.dumps(schema_value(response_format['json_schema']['schema'], config), ensure_ascii=False)
+            elif "總評分" in prompt:
+                content = evaluation_text(config)
+            else:
+                content = answer_text(min(config.answer_tokens, payload.get('max_tokens') or config.answer_tokens))
+            prompt_tokens = estimate_tokens(prompt)
+            completion_tokens = estimate_tokens(content or tool_calls[0]['function']['arguments'])
+            with stats.lock:
+                stats.chat_calls += 1
+                stats.prompt_tokens += prompt_tokens
+                stats.completion_tokens += completion_tokens
+            usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                     'total_tokens': prompt_tokens + completion_tokens}
+            response_id = f"chatcmpl-{uuid.uuid4().hex}"
+            base = {'id': response_id, 'created': int(time.time()), 'model': payload.get('model', 'stub')}
+            generation_seconds = completion_tokens / config.tokens_per_second if config.tokens_per_second else 0
+
+            self._delay(config.latency_ms)
+            if not payload.get('stream'):
+                time.sleep(generation_seconds)
+                message = {'role': 'assistant', 'content': content}
+                if tool_calls:
+                    message['tool_calls'] = tool_calls
+                self._send_json(dict(base, object='chat.completion', usage=usage, choices=[{
+                    'index': 0, 'finish_reason': 'tool_calls' if tool_calls else 'stop', 'message': message}]))
+                return
+
+            # 串流回應：把內容分成多段，按生成速度逐段發送
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            pieces = [content[i:i + 20] for i in range(0, len(content), 20)] or [""]
+            for piece in pieces:
+                chunk = dict(base, object='chat.completion.chunk', choices=[{
+                    'index': 0, 'finish_reason': None, 'delta': {'role': 'assistant', 'content': piece}}])
+                self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+                self.wfile.flush()
+                time.sleep(generation_seconds / len(pieces))
+            final = dict(base, object='chat.completion.chunk', choices=[{'index': 0, 'finish_reason': 'stop', 'delta': {}}])
+            self.wfile.write(f"data: {json.dumps(final)}\n\n".encode('utf-8'))
+            if (payload.get('stream_options') or {}).get('include_usage'):
+                usage_chunk = dict(base, object='chat.completion.chunk', choices=[], usage=usage)
+                self.wfile.write(f"data: {json.dumps(usage_chunk)}\n\n".encode('utf-8'))
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+            self.close_connection = True
+
+        def _scrape(self, payload):
+            with stats.lock:
+                stats.scrape_calls += 1
+            self._delay(config.scrape_latency_ms)
+            url = payload.get('url', '')
+            markdown = "\n\n".join(f"第 {i + 1} 段：關於 {url} 的模擬網頁內容，包括一些數據及背景資料。"
+                                   for i in range(config.page_paragraphs))
+            self._send_json({'success': True, 'data': {
+                'markdown': markdown,
+                'metadata': {'statusCode': 200, 'title': f"模擬網頁 {url}", 'description': "模擬描述", 'sourceURL': url}}})
+
+    return StubHandler
+
+
+# 在背景線程啟動模擬服務，返回 (server, stats)；port 為 0 時自動選擇可用端口
+def start_stub_server(config=None, host="127.0.0.1", port=0):
+    config = config or StubConfig()
+    stats = StubStats()
+    server = ThreadingHTTPServer((host, port), make_handler(config, stats))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='stub-server', daemon=True)
+    thread.start()
+    return server, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模擬的 OpenAI 及 Firecrawl API")
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--latency-ms', type=float, default=200)
+    parser.add_argument('--jitter-ms', type=float, default=50)
+    parser.add_argument('--tokens-per-second', type=float, default=0)
+    parser.add_argument('--answer-tokens', type=int, default=400)
+    parser.add_argument('--score-min', type=int, default=30)
+    parser.add_argument('--score-max', type=int, default=44)
+    parser.add_argument('--scrape-latency-ms', type=float, default=300)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help="以 429 回應的 LLM 請求比例")
+    parser.add_argument('--slow-rate', type=float, default=0.0, help="額外延遲 --slow-ms 的 LLM 請求比例")
+    parser.add_argument('--slow-ms', type=float, default=0)
+    args = parser.parse_args()
+    config = StubConfig(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, tokens_per_second=args.tokens_per_second,
+                        answer_tokens=args.answer_tokens, score_range=(args.score_min, args.score_max),
+                        scrape_latency_ms=args.scrape_latency_ms, seed=args.seed, error_rate=args.error_rate,
+                        slow_rate=args.slow_rate, slow_ms=args.slow_ms)
+    server, _ = start_stub_server(config, args.host, args.port)
+    print(f"[INFO] 模擬服務已啟動: http://{args.host}:{server.server_address[1]}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+# 以 SQLite 儲存快取內容，供多個工作進程共享及在重啟後保留
+class SQLiteBackend:
+    def __init__(self, path, table="cache"):
+        self.path = path
+        self.table = table
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"""CREATE TABLE IF NOT EXISTS {table} (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                expires_at REAL NOT NULL,
+                accessed_at REAL NOT NULL)""")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_accessed ON {table} (accessed_at)")
+
+    # 每次操作使用獨立連接，避免跨線程共用連接；完成後提交並關閉
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    # 返回 (value, expires_at)，不存在或已過期時返回 None
+    def get(self, key):
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] <= now:
+                conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                return None
+            conn.execute(f"UPDATE {self.table} SET accessed_at = ? WHERE key = ?", (now, key))
+            return row[0], row[1]
+
+    def set(self, key, value, size, expires_at):
+        with self._connect() as conn:
+            conn.execute(f"INSERT OR REPLACE INTO {self.table} (key, value, size, expires_at, accessed_at) "
+                         "VALUES (?, ?, ?, ?, ?)", (key, value, size, expires_at, time.time()))
+
+    def delete(self, key):
+        with self._connect() as conn:
+            conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    # 刪除過期內容，再按最近最少使用次序刪除超出上限的內容，返回刪除數量
+    def evict(self, max_entries, max_bytes):
+        with self._connect() as conn:
+            removed = conn.execute(f"DELETE FROM {self.table} WHERE expires_at <= ?", (time.time(),)).rowcount
+            count, total = conn.execute(f"SELECT COUNT(*), COALESCE(SUM(size), 0) FROM {self.table}").fetchone()
+            if count <= max_entries and total <= max_bytes:
+                return removed
+            rows = conn.execute(f"SELECT key, size FROM {self.table} ORDER BY accessed_at").fetchall()
+            stale = []
+            for key, size in rows:
+                if count <= max_entries and total <= max_bytes:
+                    break
+                stale.append((key,))
+                count -= 1
+                total -= size
+            conn.executemany(f"DELETE FROM {self.table} WHERE key = ?", stale)
+            return removed + len(stale)
+
+    def stats(self):
+        with self._connect() as conn:
+            count, total = conn.execute(f"SELECT COUNT(*), COALESCE(SUM(size), 0) FROM {self.table}").fetchone()
+        return {'path': self.path, 'entries': count, 'bytes': total}
+
+
+# 有容量上限及有效期的 LRU 快取（值預設為字符串，其他類型需提供 sizeof 且不能使用 backend）
+# 記憶體中按項目數量及總字節數淘汰最近最少使用的內容；空字符串視為失敗結果，只保留 negative_ttl 秒；
+# 若提供 backend，記憶體未命中時會查詢 backend，寫入時同時寫入 backend（backend 的上限預設為記憶體上限的 4 倍）
+class TTLCache:
+    def __init__(self, max_entries=256, max_bytes=32 * 1024 * 1024, ttl=3600, negative_ttl=60, backend=None,
+                 backend_max_entries=None, backend_max_bytes=None, sizeof=None):
+        self.sizeof = sizeof or (lambda value: len(value.encode('utf-8')))
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.backend_max_entries = backend_max_entries or max_entries * 4
+        self.backend_max_bytes = backend_max_bytes or max_bytes * 4
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.backend = backend
+        self._entries = OrderedDict()  # key -> (value, size, expires_at)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.backend_hits = 0
+        self.backend_evictions = 0
+        self.backend_errors = 0
+
+    # 返回快取內容，未命中或已過期時返回 None
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[2] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                self._remove(key)
+                self.expirations += 1
+        if self.backend is not None:
+            try:
+                row = self.backend.get(key)
+            except sqlite3.Error as e:
+                print(f"[錯誤] 讀取快取後端時發生異常: {e}")
+                row = None
+                self.backend_errors += 1
+            if row is not None:
+                value, expires_at = row
+                with self._lock:
+                    self.hits += 1
+                    self.backend_hits += 1
+                    self._store(key, value, expires_at)
+                return value
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl if value else self.negative_ttl
+        expires_at = time.time() + ttl
+        with self._lock:
+            self._store(key, value, expires_at)
+        if self.backend is not None:
+            try:
+                self.backend.set(key, value, len(value.encode('utf-8')), expires_at)
+                self.backend_evictions += self.backend.evict(self.backend_max_entries, self.backend_max_bytes)
+            except sqlite3.Error as e:
+                print(f"[錯誤] 寫入快取後端時發生異常: {e}")
+                self.backend_errors += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+        if self.backend is not None:
+            self.backend.delete(key)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def stats(self):
+        with self._lock:
+            data = {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'backend_hits': self.backend_hits,
+                'backend_evictions': self.backend_evictions,
+                'backend_errors': self.backend_errors,
+            }
+        if self.backend is not None:
+            try:
+                data['backend'] = self.backend.stats()
+            except sqlite3.Error as e:
+                data['backend'] = {'error': str(e)}
+        return data
+
+    # 寫入記憶體並淘汰超出上限的內容（需持有 self._lock）
+    def _store(self, key, value, expires_at):
+        size = self.sizeof(value)
+        self._remove(key)  # 先刪除舊內容，即使新內容因過大而不放入記憶體，亦不會繼續返回舊內容
+        if size > self.max_bytes:
+            return  # 單項內容超出總上限，不放入記憶體
+        self._entries[key] = (value, size, expires_at)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[1]
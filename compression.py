@@ -0,0 +1,70 @@
+import gzip
+import zlib
+
+try:
+    import brotli  # 可選依賴，未安裝時只使用 gzip
+except ImportError:
+    brotli = None
+
+# 值得壓縮的內容類型
+COMPRESSIBLE_MIMETYPES = ('application/json', 'text/event-stream', 'text/plain', 'text/html', 'text/css',
+                          'application/javascript', 'text/javascript')
+
+
+# 按 Accept-Encoding 選擇壓縮格式（br 優先於 gzip），不接受任何壓縮時返回 None
+def negotiate_encoding(accept_encoding):
+    accepted = {}
+    for part in (accept_encoding or "").split(','):
+        name, _, params = part.strip().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name.strip().lower()] = quality
+    for encoding in (('br',) if brotli is not None else ()) + ('gzip',):
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+# 逐段壓縮串流回應，每段後同步刷新，客戶端可即時解壓每個事件
+def _compress_stream(chunks, encoding):
+    if encoding == 'br':
+        compressor = brotli.Compressor()
+        for chunk in chunks:
+            data = chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+            yield compressor.process(data) + compressor.flush()
+        yield compressor.finish()
+        return
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 輸出 gzip 格式
+    for chunk in chunks:
+        data = chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+        yield compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+# 按請求的 Accept-Encoding 壓縮 Flask 回應：一般回應超過 min_size 字節時整體壓縮，SSE 串流逐段壓縮；
+# 檔案回應（direct_passthrough）及已壓縮的回應不作處理
+def compress_response(response, accept_encoding, min_size=500):
+    if (response.status_code < 200 or response.status_code >= 300 or response.direct_passthrough
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    encoding = negotiate_encoding(accept_encoding)
+    response.vary.add('Accept-Encoding')
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        if response.mimetype != 'text/event-stream':
+            return response
+        response.response = _compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        response.set_data(brotli.compress(data) if encoding == 'br' else gzip.compress(data, compresslevel=6))
+    response.headers['Content-Encoding'] = encoding
+    return response
@@ -0,0 +1,161 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+# 任務被取消時拋出，由工作函數在檢查點調用 job.check_cancelled() 觸發
+class JobCancelled(Exception):
+    pass
+
+
+# 排隊任務已達上限時拋出，路由應返回 429
+class QueueFullError(Exception):
+    pass
+
+
+# 單個背景任務的狀態
+class Job:
+    def __init__(self, kind):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = 'queued'  # queued / running / succeeded / failed / cancelled
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.partial = {}  # 執行中已完成的部分結果，例如 iterations_data
+        self.result = None
+        self.error = None
+        self.future = None
+        self._cancel_event = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def finished(self):
+        return self.status in ('succeeded', 'failed', 'cancelled')
+
+    @property
+    def cancel_requested(self):
+        return self._cancel_event.is_set()
+
+    # 在工作函數的檢查點調用，若已請求取消則中止任務
+    def check_cancelled(self):
+        if self._cancel_event.is_set():
+            raise JobCancelled()
+
+    # 更新部分結果（線程安全）
+    def update_partial(self, **kwargs):
+        with self._lock:
+            self.partial.update(kwargs)
+
+    # 將數據附加到部分結果中的列表（線程安全）
+    def append_partial(self, key, value):
+        with self._lock:
+            self.partial.setdefault(key, []).append(value)
+
+    def to_dict(self):
+        with self._lock:
+            data = {
+                'job_id': self.id,
+                'kind': self.kind,
+                'status': self.status,
+                'created_at': self.created_at,
+                'started_at': self.started_at,
+                'finished_at': self.finished_at,
+                'partial': {k: list(v) if isinstance(v, list) else v for k, v in self.partial.items()},
+            }
+        if self.status == 'succeeded':
+            data['result'] = self.result
+        if self.error:
+            data['error'] = self.error
+        return data
+
+
+# 背景任務隊列：以固定大小的線程池執行任務，限制同時執行及排隊的任務數量
+class JobQueue:
+    def __init__(self, max_workers=4, max_pending=16, max_finished=200, finished_ttl=3600):
+        self.max_workers = max_workers  # 同時執行的任務上限
+        self.max_pending = max_pending  # 排隊等待的任務上限（背壓）
+        self.max_finished = max_finished  # 保留已完成任務結果的數量上限
+        self.finished_ttl = finished_ttl  # 已完成任務結果的保留秒數
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job-worker')
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    # 提交任務，func(job, *args, **kwargs) 的返回值作為任務結果
+    def submit(self, kind, func, *args, **kwargs):
+        with self._lock:
+            self._prune()
+            active = sum(1 for job in self._jobs.values() if not job.finished)
+            if active >= self.max_workers + self.max_pending:
+                raise QueueFullError(f"任務隊列已滿（{active} 個任務執行或排隊中）")
+            job = Job(kind)
+            self._jobs[job.id] = job
+        job.future = self._executor.submit(self._run, job, func, args, kwargs)
+        print(f"[INFO] 已提交任務 {job.id} ({kind})")
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    # 取消任務：排隊中的任務直接取消，執行中的任務在下一個檢查點中止
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is None:
+            return None
+        if job.finished:
+            return job
+        job._cancel_event.set()
+        if job.future is not None and job.future.cancel():
+            self._finish(job, 'cancelled')
+        print(f"[INFO] 已請求取消任務 {job_id}")
+        return job
+
+    def stats(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+        return {
+            'max_workers': self.max_workers,
+            'max_pending': self.max_pending,
+            'jobs': counts,
+        }
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+    def _run(self, job, func, args, kwargs):
+        if job.cancel_requested:
+            self._finish(job, 'cancelled')
+            return
+        job.status = 'running'
+        job.started_at = time.time()
+        try:
+            result = func(job, *args, **kwargs)
+        except JobCancelled:
+            self._finish(job, 'cancelled')
+            print(f"[INFO] 任務 {job.id} 已取消")
+        except Exception as e:
+            job.error = str(e)
+            self._finish(job, 'failed')
+            print(f"[錯誤] 任務 {job.id} 執行失敗: {e}")
+        else:
+            job.result = result
+            self._finish(job, 'succeeded')
+            print(f"[INFO] 任務 {job.id} 已完成，用時 {job.finished_at - job.started_at:.1f} 秒")
+
+    def _finish(self, job, status):
+        job.status = status
+        job.finished_at = time.time()
+
+    # 清理過期或超出數量上限的已完成任務（需持有 self._lock）
+    def _prune(self):
+        now = time.time()
+        finished = sorted((job for job in self._jobs.values() if job.finished),
+                          key=lambda job: job.finished_at)
+        expired = [job for job in finished if now - job.finished_at > self.finished_ttl]
+        overflow = finished[:max(0, len(finished) - self.max_finished)]
+        for job in expired + overflow:
+            self._jobs.pop(job.id, None)
@@ -0,0 +1,158 @@
+import contextvars
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor
+from concurrent.futures import wait as wait_futures
+
+import openai
+
+# 可重試的錯誤：速率限制（429）、超時、連接錯誤及伺服器錯誤（5xx）
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError,
+                    openai.InternalServerError)
+
+
+# LLM 調用超出截止時間時拋出
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+def is_retryable(error):
+    if isinstance(error, RETRYABLE_ERRORS):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code in (408, 409)
+
+
+# 回應中的 Retry-After 秒數（沒有時返回 None）
+def retry_after_seconds(error):
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+# 帶隨機抖動的指數退避（full jitter）：第 n 次重試前等待 0 至 min(max_delay, base_delay * 2^n) 秒，
+# 伺服器要求的 Retry-After 較長時以其為準
+class Backoff:
+    def __init__(self, max_retries=4, base_delay=0.5, max_delay=20):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, retry_index, retry_after=None):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry_index))
+        if retry_after:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+
+# 按階段記錄最近的調用用時，用於決定對沖請求的等待時間
+class LatencyTracker:
+    def __init__(self, window=200):
+        self.window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            self._samples.setdefault(stage, deque(maxlen=self.window)).append(seconds)
+
+    # 該階段用時的百分位數，樣本少於 min_samples 時返回 None
+    def percentile(self, stage, p, min_samples=20):
+        with self._lock:
+            samples = sorted(self._samples.get(stage, ()))
+        if len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(p / 100 * len(samples)))]
+
+
+# 一次 LLM 調用（包括重試及對沖請求）的統計
+class CallStats:
+    def __init__(self):
+        self.attempts = 0
+        self.retries = 0
+        self.queued = 0.0  # 等待速率限制的秒數
+        self.hedged = False  # 是否發出了對沖請求
+        self.hedge_won = False  # 對沖請求是否比原請求先完成
+
+
+# 具韌性的 LLM 調用：每次調用有截止時間，可重試的錯誤按退避重試，可選地在等待過久時發出對沖請求
+class ResilientCaller:
+    def __init__(self, backoff=None, hedge_workers=8):
+        self.backoff = backoff or Backoff()
+        self._hedge_workers = hedge_workers
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self._hedge_workers, thread_name_prefix='llm-hedge')
+            return self._executor
+
+    # attempt(timeout, stats) 發出一次請求並返回結果；deadline 為整個調用（包括重試）的秒數上限；
+    # hedge_after 不為 None 時，請求超過該秒數仍未完成便發出相同的對沖請求，採用先完成的結果；
+    # on_discard(result) 處理被捨棄的對沖結果（例如記錄浪費的 token）
+    def call(self, attempt, deadline, hedge_after=None, on_discard=None):
+        stats = CallStats()
+        expires = time.monotonic() + deadline
+        retry_index = 0
+        while True:
+            remaining = expires - time.monotonic()
+            if remaining <= 0:
+                raise DeadlineExceeded(f"LLM 調用超出 {deadline} 秒的截止時間")
+            try:
+                if hedge_after is not None and hedge_after < remaining:
+                    return self._hedged(attempt, expires, hedge_after, stats, on_discard), stats
+                stats.attempts += 1
+                return attempt(remaining, stats), stats
+            except Exception as e:
+                if not is_retryable(e) or retry_index >= self.backoff.max_retries:
+                    raise
+                delay = self.backoff.delay(retry_index, retry_after_seconds(e))
+                if time.monotonic() + delay >= expires:
+                    raise
+                print(f"[INFO] LLM 調用失敗（{type(e).__name__}），{delay:.2f} 秒後第 {retry_index + 1} 次重試")
+                stats.retries += 1
+                retry_index += 1
+                time.sleep(delay)
+
+    def _hedged(self, attempt, expires, hedge_after, stats, on_discard):
+        executor = self._get_executor()
+        stats.attempts += 1
+        # 在背景線程中沿用調用者的 contextvars（例如當前請求的追蹤）
+        primary = executor.submit(contextvars.copy_context().run, attempt, expires - time.monotonic(), stats)
+        done, _ = wait_futures([primary], timeout=hedge_after)
+        if done:
+            return primary.result()
+        stats.hedged = True
+        stats.attempts += 1
+        hedge = executor.submit(contextvars.copy_context().run, attempt, expires - time.monotonic(), stats)
+        pending = [primary, hedge]
+        error = None
+        while pending:
+            done, _ = wait_futures(pending, timeout=max(0, expires - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                self._discard(pending, on_discard)
+                raise DeadlineExceeded("LLM 調用及對沖請求均超出截止時間")
+            for future in done:
+                pending.remove(future)
+                if future.exception() is not None:
+                    error = future.exception()
+                    continue
+                stats.hedge_won = future is hedge
+                self._discard(pending, on_discard)
+                return future.result()
+        raise error
+
+    # 不再等待的請求完成後，把其結果交給 on_discard（例如記錄已使用的 token），失敗的請求不作處理
+    @staticmethod
+    def _discard(futures, on_discard):
+        if on_discard is None:
+            return
+        for future in futures:
+            future.add_done_callback(lambda f: on_discard(f.result()) if f.exception() is None else None)
@@ -1,65 +1,257 @@
-from flask import Flask, render_template, request, jsonify
-from openai import OpenAI
-import os
-import re
-import tiktoken
-from replit.object_storage import Client  # 引入 Replit Object Storage
-from firecrawl import FirecrawlApp  # 引入 Firecrawl
-import tiktoken
-import datetime
+# 導入其他模組前先記錄時間，以量度冷啟動中導入的用時，因此其後的導入不在檔案開頭（以 noqa: E402 標示）
+import time
+
+IMPORT_STARTED = time.perf_counter()
+
+import contextvars  # noqa: E402
+import cProfile  # noqa: E402
+import datetime  # noqa: E402
+import functools  # noqa: E402
+import hashlib  # noqa: E402
+import json  # noqa: E402
+import math  # noqa: E402
+import os  # noqa: E402
+import pstats  # noqa: E402
+import re  # noqa: E402
+import resource  # noqa: E402
+import threading  # noqa: E402
+import uuid  # noqa: E402
+from concurrent.futures import ThreadPoolExecutor  # noqa: E402
+from concurrent.futures import TimeoutError as FuturesTimeoutError  # noqa: E402
+from concurrent.futures import wait as wait_futures  # noqa: E402
+from contextlib import contextmanager  # noqa: E402
+from types import SimpleNamespace  # noqa: E402
+
+import httpx  # noqa: E402
+from flask import (  # noqa: E402
+    Blueprint,
+    Flask,
+    Response,
+    jsonify,
+    render_template,
+    request,
+    stream_with_context,
+)
+from openai import BadRequestError, DefaultHttpxClient, OpenAI  # noqa: E402
+
+from cache import SQLiteBackend, TTLCache  # noqa: E402
+from compression import compress_response  # noqa: E402
+from job_queue import JobQueue, QueueFullError  # noqa: E402
+from llm_client import Backoff, DeadlineExceeded, LatencyTracker, ResilientCaller  # noqa: E402
+from metrics import MetricsRegistry, Trace  # noqa: E402
+from rate_limit import RateLimiter  # noqa: E402
+from retrieval import BM25Index, split_chunks  # noqa: E402
+from search_log import LocalDirectoryStorage, SearchLog  # noqa: E402
+from singleflight import SingleFlight  # noqa: E402
+from stopping import (  # noqa: E402
+    CostCeiling,
+    Deadline,
+    MaxRounds,
+    Plateau,
+    StopController,
+    TargetScore,
+    TokenCeiling,
+)
+from text_diff import diff_text  # noqa: E402
+from token_budget import TokenBudget  # noqa: E402
+
+# 路由登記在 blueprint 上，由 create_app() 建立應用程式時註冊
+routes = Blueprint('routes', __name__)
+
+
+# 每個進程只建立一次的對象：首次使用時才建立（導入模組時不需要憑證），fork 出的工作進程會各自重新建立，不共用連接
+def per_process(factory):
+    lock = threading.Lock()
+    state = {'pid': None, 'value': None}
+
+    @functools.wraps(factory)
+    def get():
+        pid = os.getpid()
+        if state['pid'] != pid:
+            with lock:
+                if state['pid'] != pid:
+                    state['value'] = factory()
+                    state['pid'] = pid
+        return state['value']
+    return get
+
+
+# Firecrawl 客戶端（API 金鑰為 FIRECRAWL_API_KEY）
+@per_process
+def get_firecrawl_app():
+    from firecrawl import FirecrawlApp  # 引入 Firecrawl
+    return FirecrawlApp(api_key=os.getenv("FIRECRAWL_API_KEY"))
+
+
+# OpenAI 客戶端，同一進程內的所有請求共用其 HTTP 連接池；重試由 llm_caller 負責，因此關閉 SDK 的自動重試
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+
+
+@per_process
+def get_openai_client():
+    limits = httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS)
+    return OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0, http_client=DefaultHttpxClient(limits=limits))
+
+
+# Replit Object Storage 客戶端（設定 SEARCH_LOG_DIR 時改用本地目錄，方便本地開發及測試）
+SEARCH_LOG_DIR = os.getenv("SEARCH_LOG_DIR", "")
+
+
+@per_process
+def get_storage_client():
+    if SEARCH_LOG_DIR:
+        return LocalDirectoryStorage(SEARCH_LOG_DIR)
+    from replit.object_storage import Client  # 引入 Replit Object Storage
+    return Client()
+
+
+# 搜索日志：按批次寫入分段物件，不再下載及重寫整個日志檔案
+LEGACY_LOG_FILENAME = "adam-llm-iteration.log"  # 舊版的單一日志檔案
+
+
+@per_process
+def get_search_log():
+    return SearchLog(get_storage_client(),
+                     batch_size=int(os.getenv("SEARCH_LOG_BATCH_SIZE", "20")),
+                     flush_interval=float(os.getenv("SEARCH_LOG_FLUSH_INTERVAL", "10")))
+
+
+# 今天的日期，每次構造提示時計算，長時間運行的工作進程不會使用過時的日期
+def current_date():
+    return datetime.datetime.now().strftime("%Y-%m-%d")
 
-# 設置 Firecrawl API 金鑰
-FIRECRAWL_API_KEY = os.getenv("FIRECRAWL_API_KEY")
-firecrawl_app = FirecrawlApp(api_key=FIRECRAWL_API_KEY)
 
-CURRENT_DATE = datetime.datetime.now().strftime("%Y-%m-%d")
+# 設置模型名稱
+MODEL_NAME = "gpt-4o-mini-2024-07-18"
 
-# 設置 Flask 應用程序
-app = Flask(__name__, static_folder='static')
+# 初始化背景任務隊列（同時執行及排隊的任務上限可透過環境變量設定）
+job_queue = JobQueue(max_workers=int(os.getenv("JOB_WORKERS", "4")),
+                     max_pending=int(os.getenv("JOB_MAX_PENDING", "16")))
 
-# 初始化 OpenAI 客戶端
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# 合併相同的並行請求（問題、補充資料及核心事實相同），成功的結果保留 SINGLE_FLIGHT_TTL 秒
+single_flight = SingleFlight(ttl=float(os.getenv("SINGLE_FLIGHT_TTL", "30"))) \
+    if os.getenv("SINGLE_FLIGHT_ENABLED", "1") == "1" else None
 
-# 初始化 Replit Object Storage 客戶端
-storage_client = Client()
 
-# 設置模型名稱
-MODEL_NAME = "gpt-4o-mini-2024-07-18"
+# 記錄搜索日志
+def log_search(user_question, model_name, direct_tokens, final_tokens, best_score, cache_hits=0, saved_tokens=0,
+               stop_reason=None):
+    get_search_log().append({
+        'date': datetime.datetime.now().isoformat(),
+        'user_question': user_question,
+        'model': model_name,
+        'direct_tokens': direct_tokens,
+        'final_tokens': final_tokens,
+        'best_score': round(best_score, 2),
+        'cache_hits': cache_hits,
+        'saved_tokens': saved_tokens,
+        'stop_reason': stop_reason,
+    })
 
 
-# 記錄搜索日志
-def log_search(user_question, model_name, direct_tokens, final_tokens, best_score):
-    log_entry = (f"Date: {datetime.datetime.now()}\n"
-                 f"User Question: {user_question}\n"
-                 f"Model Used: {model_name}\n"
-                 f"Direct LLM Tokens: {direct_tokens}\n"
-                 f"Final Optimized LLM Tokens: {final_tokens}\n"
-                 f"Best Score: {best_score:.2f}\n"
-                 "----------------------------------------\n")
-    log_filename = "adam-llm-iteration.log"  # system log
-    existing_log = ""
+# 將日志項目格式化為舊版的文字格式
+def format_log_entry(entry):
+    return (f"Date: {entry.get('date')}\n"
+            f"User Question: {entry.get('user_question')}\n"
+            f"Model Used: {entry.get('model')}\n"
+            f"Direct LLM Tokens: {entry.get('direct_tokens')}\n"
+            f"Final Optimized LLM Tokens: {entry.get('final_tokens')}\n"
+            f"Best Score: {entry.get('best_score', 0):.2f}\n"
+            f"LLM Cache Hits: {entry.get('cache_hits', 0)} (Saved Tokens: {entry.get('saved_tokens', 0)})\n"
+            "----------------------------------------\n")
+
+
+# 解析時間參數：epoch 秒或 ISO 格式日期時間
+def parse_time_param(value):
+    if not value:
+        return None
     try:
-        existing_log = storage_client.download_as_text(log_filename)
-    except Exception:
-        pass  # 日誌文件不存在，略過
-    new_log = existing_log + log_entry
-    storage_client.upload_from_text(log_filename, new_log)
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
 
 
-# 添加查看 adam-llm-iteration.log 的路由
-@app.route('/view-log', methods=['GET'])
+# 查看搜索日志，由新至舊排列
+# 參數：offset / limit 分頁，start / end 時間範圍（epoch 秒或 ISO 日期），format=json 返回 JSON，legacy=1 查看舊版日志檔案
+@routes.route('/view-log', methods=['GET'])
 def view_log():
     try:
-        log_content = storage_client.download_as_text("adam-llm-iteration.log")
-        return log_content
+        if request.args.get('legacy') == '1':
+            return get_storage_client().download_as_text(LEGACY_LOG_FILENAME)
+        offset = max(0, int(request.args.get('offset', 0)))
+        limit = min(500, max(1, int(request.args.get('limit', 50))))
+        start = parse_time_param(request.args.get('start'))
+        end = parse_time_param(request.args.get('end'))
+    except ValueError as e:
+        return str(e), 400
+    try:
+        entries, has_more = get_search_log().query(start=start, end=end, offset=offset, limit=limit)
     except Exception as e:
         return str(e), 500
+    if request.args.get('format') == 'json':
+        return jsonify(entries=entries, offset=offset, limit=limit, has_more=has_more)
+    return Response(''.join(format_log_entry(entry) for entry in entries), mimetype='text/plain')
+
+
+# 查看網頁快取及 LLM 回應快取的命中、未命中及淘汰統計
+@routes.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    return jsonify(scrape_cache=scrape_cache.stats(), index_cache=index_cache.stats(), llm_cache=llm_cache.stats(),
+                   prompt_budget=token_budget.stats())
+
+
+# 以 Prometheus 文字格式輸出指標：流程各階段及 LLM 調用的用時分佈、token 數、重試次數，以及快取和任務隊列的狀態
+@routes.route('/metrics', methods=['GET'])
+def metrics_route():
+    for name, cache in (('scrape', scrape_cache), ('index', index_cache), ('llm', llm_cache)):
+        for key, value in cache.stats().items():
+            if isinstance(value, (int, float)):
+                metrics.set(f'cache_{key}', value, cache=name)
+    counts = job_queue.stats()['jobs']
+    for status in ('queued', 'running', 'succeeded', 'failed', 'cancelled'):
+        metrics.set('jobs', counts.get(status, 0), "背景任務數量", status=status)
+    if single_flight is not None:
+        for state, value in single_flight.stats().items():
+            metrics.set('single_flights', value, "共享執行數量（執行中及保留期內）", state=state)
+    rss, peak_rss = process_memory()
+    metrics.set('process_resident_memory_bytes', rss, "工作進程目前的記憶體用量")
+    metrics.set('process_peak_resident_memory_bytes', peak_rss, "工作進程的最高記憶體用量")
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+# 取得 tiktoken 編碼器（只建立一次，建立應用程式時預熱）
+@functools.lru_cache(maxsize=None)
+def get_encoder():
+    import tiktoken
+    return tiktoken.encoding_for_model(MODEL_NAME)
 
 
 # 計算文本的 token 數量
 def count_tokens(text):
-    encoder = tiktoken.encoding_for_model(MODEL_NAME)
-    return len(encoder.encode(text))
+    return len(get_encoder().encode(text))
+
+
+# 各階段提示中可變部分（答案、補充資料、上下文等）的 token 預算，可用 PROMPT_BUDGET_<STAGE> 覆蓋
+PROMPT_BUDGETS = {stage: int(os.getenv(f"PROMPT_BUDGET_{stage.upper()}", str(default))) for stage, default in {
+    'target': 16000,
+    'direct': 16000,
+    'evaluation': 12000,
+    'optimizer': 12000,
+}.items()}
+token_budget = TokenBudget(get_encoder, PROMPT_BUDGETS)
+
+# 單一網頁內容的 token 上限
+SCRAPE_PAGE_TOKEN_LIMIT = int(os.getenv("SCRAPE_PAGE_TOKEN_LIMIT", "6000"))
+
+
+# 按該階段的預算截斷提示的各個部分，sections 為 (文本, 優先次序, 保留方式)，詳見 TokenBudget.fit
+def fit_prompt_sections(stage, *sections):
+    texts, trimmed = token_budget.fit(stage, sections)
+    usage = current_usage.get()
+    if usage is not None and trimmed:
+        usage.record_trimmed(stage, trimmed)
+    return texts
 
 
 # 格式化回答
@@ -70,40 +262,497 @@ def format_answer(response):
     return answer
 
 
+# 記錄單次請求的 LLM 調用統計（包括快取命中及節省的 token 數）
+# parent 不為 None 時，所有記錄會同時轉發到 parent（用於統計單個階段的成本）
+class LLMUsage:
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cache_hits = 0
+        self.saved_tokens = 0
+        self.avoided_calls = 0  # 因重用已有結果而無需發出的調用
+        self.avoided_tokens = 0
+        self.hedge_wasted_tokens = 0  # 被捨棄的對沖結果使用的 token（已計入調用及 token 總數）
+        self.stages = {}  # 階段 -> {'calls', 'prompt_tokens', 'completion_tokens', 'trimmed_tokens'}
+        self._lock = threading.Lock()
+
+    # 已調用及從快取取得的 token 總數，用於計算某個階段的 token 成本
+    @property
+    def total_tokens(self):
+        with self._lock:
+            return self.prompt_tokens + self.completion_tokens + self.saved_tokens
+
+    # hedge_wasted 表示被捨棄的對沖結果：其 token 同樣需要付費，因此與一般調用一樣計入（亦影響 token / 成本上限）
+    def record(self, usage, cached=False, stage=None, hedge_wasted=False):
+        if self.parent is not None:
+            self.parent.record(usage, cached, stage, hedge_wasted)
+        with self._lock:
+            if cached:
+                self.cache_hits += 1
+                self.saved_tokens += usage.total_tokens
+            else:
+                self.calls += 1
+                self.prompt_tokens += usage.prompt_tokens
+                self.completion_tokens += usage.completion_tokens
+                if hedge_wasted:
+                    self.hedge_wasted_tokens += usage.total_tokens
+                if stage:
+                    stats = self._stage(stage)
+                    stats['calls'] += 1
+                    stats['prompt_tokens'] += usage.prompt_tokens
+                    stats['completion_tokens'] += usage.completion_tokens
+
+    # 記錄因超出預算而被截斷的提示 token 數
+    def record_trimmed(self, stage, tokens):
+        if self.parent is not None:
+            self.parent.record_trimmed(stage, tokens)
+        with self._lock:
+            self._stage(stage)['trimmed_tokens'] += tokens
+
+    def _stage(self, stage):
+        return self.stages.setdefault(stage, {'calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'trimmed_tokens': 0})
+
+    def record_avoided(self, calls, tokens):
+        if self.parent is not None:
+            self.parent.record_avoided(calls, tokens)
+        with self._lock:
+            self.avoided_calls += calls
+            self.avoided_tokens += tokens
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'llm_calls': self.calls,
+                'prompt_tokens': self.prompt_tokens,
+                'completion_tokens': self.completion_tokens,
+                'cache_hits': self.cache_hits,
+                'saved_tokens': self.saved_tokens,
+                'avoided_calls': self.avoided_calls,
+                'avoided_tokens': self.avoided_tokens,
+                'hedge_wasted_tokens': self.hedge_wasted_tokens,
+                'stages': {stage: dict(stats) for stage, stats in self.stages.items()},
+            }
+
+
+# 當前請求的 LLM 調用統計，由 track_llm_usage() 設置
+current_usage = contextvars.ContextVar('current_usage', default=None)
+
+
+# 為當前請求開始新的 LLM 調用統計
+def track_llm_usage():
+    usage = LLMUsage()
+    current_usage.set(usage)
+    return usage
+
+
+# 在 with 區塊內單獨統計某個階段的調用，記錄同時轉發到當前請求的統計
+@contextmanager
+def track_stage_usage():
+    tracker = LLMUsage(parent=current_usage.get())
+    token = current_usage.set(tracker)
+    try:
+        yield tracker
+    finally:
+        current_usage.reset(token)
+
+
+# 並行執行 LLM 調用的線程池（用於 beam 模式），以 submit_llm_task 提交以保留當前請求的統計
+llm_executor = ThreadPoolExecutor(max_workers=int(os.getenv("LLM_PARALLELISM", "8")),
+                                  thread_name_prefix='llm')
+
+
+def submit_llm_task(func, *args):
+    return llm_executor.submit(contextvars.copy_context().run, func, *args)
+
+
+# 進程內的指標（由 /metrics 以 Prometheus 格式輸出）及當前請求的追蹤記錄（由 start_trace() 設置）
+metrics = MetricsRegistry()
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+# 是否允許請求啟用 profiling（"profile": true），以及 profiling 結果列出的函數數量；
+# 預設關閉：profiling 會增加開銷、略過相同請求的合併，並在回應中列出伺服器的檔案路徑，只應由操作者啟用
+PROFILING_ALLOWED = os.getenv("PROFILING_ALLOWED", "0") == "1"
+PROFILE_TOP_FUNCTIONS = int(os.getenv("PROFILE_TOP_FUNCTIONS", "25"))
+
+
+# 為當前請求開始新的追蹤記錄，profile 為 True 時保留每個 span 的明細
+def start_trace(profile=False):
+    trace = Trace(keep_spans=profile)
+    current_trace.set(trace)
+    return trace
+
+
+# 在 with 區塊內記錄一個流程階段的用時
+@contextmanager
+def trace_stage(stage):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        seconds = time.monotonic() - start
+        metrics.observe('pipeline_stage_seconds', seconds, "流程各階段的用時（秒）", stage=stage)
+        trace = current_trace.get()
+        if trace is not None:
+            trace.record('stage', stage, start, seconds)
+
+
+# 以 trace_stage 記錄函數的用時
+def traced(stage):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with trace_stage(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# 記錄一次 LLM 調用的用時、token 數、重試次數、對沖請求及快取命中
+# start 為開始調用的時間，queued 為等待速率限制的秒數；快取命中時 usage 為節省的用量；error 為調用失敗時的異常
+def record_llm_call(stage, start, usage=None, cached=False, retries=0, queued=0.0, error=None, hedged=False,
+                    hedge_won=False):
+    seconds = time.monotonic() - start
+    status = 'error' if error is not None else ('cached' if cached else 'ok')
+    metrics.inc('llm_requests_total', "LLM 調用次數", stage=stage, status=status)
+    attrs = {'cache_hits': int(cached), 'retries': retries, 'errors': int(error is not None)}
+    if error is not None:
+        metrics.inc('llm_errors_total', "LLM 調用失敗次數（按異常類型）", stage=stage, error=type(error).__name__)
+    if hedged:
+        metrics.inc('llm_hedges_total', "發出的對沖請求次數（按先完成的請求）", stage=stage,
+                    winner='hedge' if hedge_won else 'primary')
+        attrs['hedges'] = 1
+    if not cached:
+        metrics.observe('llm_request_seconds', seconds, "LLM API 調用的用時（秒）", stage=stage)
+    if retries:
+        metrics.inc('llm_retries_total', "LLM API 調用的重試次數", value=retries, stage=stage)
+    if queued:
+        metrics.inc('llm_rate_limit_wait_seconds_total', "等待 LLM 速率限制的秒數", value=queued, stage=stage)
+        attrs['queued_seconds'] = round(queued, 4)
+    if usage is not None:
+        if cached:
+            metrics.inc('llm_cache_saved_tokens_total', "LLM 快取節省的 token 數", value=usage.total_tokens, stage=stage)
+            attrs['saved_tokens'] = usage.total_tokens
+        else:
+            metrics.inc('llm_tokens_total', "LLM 使用的 token 數", value=usage.prompt_tokens, stage=stage, kind='prompt')
+            metrics.inc('llm_tokens_total', "LLM 使用的 token 數", value=usage.completion_tokens, stage=stage,
+                        kind='completion')
+            attrs['prompt_tokens'] = usage.prompt_tokens
+            attrs['completion_tokens'] = usage.completion_tokens
+    trace = current_trace.get()
+    if trace is not None:
+        trace.record('llm', stage, start, seconds, **attrs)
+
+
+# 以 cProfile 分析 with 區塊內當前線程的 CPU 用時（enabled 為 False 時不作分析），
+# 區塊結束後把累計用時最高的函數寫入產出的列表
+@contextmanager
+def profile_block(enabled):
+    report = []
+    profiler = None
+    if enabled:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:  # 同一時間已有其他 profiler 運行
+            print(f"[錯誤] 無法啟用 profiling: {e}")
+            profiler = None
+    try:
+        yield report
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            rows = sorted(pstats.Stats(profiler).stats.items(), key=lambda item: item[1][3], reverse=True)
+            report.extend({'function': pstats.func_std_string(func),
+                           'calls': calls,
+                           'own_seconds': round(own, 4),
+                           'cumulative_seconds': round(cumulative, 4)}
+                          for func, (_, calls, own, cumulative, _) in rows[:PROFILE_TOP_FUNCTIONS])
+
+
+# 完成一個流程的追蹤：把各階段用時（及 profiling 結果）附加到回應中，並記錄整個流程的用時
+def attach_trace(result, pipeline, trace, profile_report):
+    result['trace'] = trace.to_dict()
+    if trace.keep_spans:
+        result['profile'] = profile_report
+    metrics.observe('pipeline_request_seconds', result['trace']['total_seconds'], "整個流程的用時（秒）",
+                    pipeline=pipeline)
+    return result
+
+
+# 請求是否啟用 profiling：JSON 中的 "profile": true 或查詢參數 ?profile=1
+def profile_from_request(data):
+    return PROFILING_ALLOWED and (bool(data.get('profile')) or request.args.get('profile') == '1')
+
+
+# LLM 回應快取：以 (model, messages, max_tokens, temperature, response_format, tools) 的雜湊值為鍵，
+# 只快取已啟用的階段，且 temperature 不高於 LLM_CACHE_MAX_TEMPERATURE 的調用；
+# 預設只列出以低 temperature 調用的確定性階段（optimizer 為 0.5、compare 為 0.7，不會被快取）
+LLM_CACHE_STAGES = {stage.strip() for stage in os.getenv(
+    "LLM_CACHE_STAGES", "target,direct,evaluation,extract_core_facts,fact_check").split(",") if stage.strip()}
+LLM_CACHE_MAX_TEMPERATURE = float(os.getenv("LLM_CACHE_MAX_TEMPERATURE", "0.3"))
+LLM_CACHE_DB = os.getenv("LLM_CACHE_DB", "")
+llm_cache = TTLCache(max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "1024")),
+                     max_bytes=int(os.getenv("LLM_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+                     ttl=float(os.getenv("LLM_CACHE_TTL", "86400")),
+                     backend=SQLiteBackend(LLM_CACHE_DB, table="llm_cache") if LLM_CACHE_DB else None)
+
+
+# 計算 LLM 調用的快取鍵，該階段不可快取時返回 None
+def llm_cache_key(stage, params):
+    if stage not in LLM_CACHE_STAGES or params.get('temperature', 1) > LLM_CACHE_MAX_TEMPERATURE:
+        return None
+    key_data = {k: params.get(k) for k in ('model', 'messages', 'max_tokens', 'temperature', 'response_format', 'tools')}
+    digest = hashlib.sha256(json.dumps(key_data, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+    return f"{stage}:{digest}"
+
+
+# 從快取中讀取回應，返回與 OpenAI 回應結構相同的物件，未命中時返回 None
+def llm_cache_lookup(key):
+    if key is None:
+        return None
+    cached = llm_cache.get(key)
+    if not cached:
+        return None
+    data = json.loads(cached)
+    tool_calls = [SimpleNamespace(function=SimpleNamespace(name=call['name'], arguments=call['arguments']))
+                  for call in data.get('tool_calls', [])]
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content=data['content'], tool_calls=tool_calls or None),
+                                 finish_reason=data['finish_reason'])],
+        usage=SimpleNamespace(**data['usage']))
+
+
+# 將回應內容（及 function calling 的調用參數 [(名稱, 參數)]）寫入快取
+def llm_cache_store(key, content, finish_reason, usage, tool_calls=None):
+    if key is None or not (content or tool_calls):
+        return
+    data = {
+        'content': content,
+        'finish_reason': finish_reason,
+        'usage': {'prompt_tokens': usage.prompt_tokens,
+                  'completion_tokens': usage.completion_tokens,
+                  'total_tokens': usage.total_tokens},
+    }
+    if tool_calls:
+        data['tool_calls'] = [{'name': name, 'arguments': arguments} for name, arguments in tool_calls]
+    llm_cache.set(key, json.dumps(data, ensure_ascii=False))
+
+
+# 全局的 LLM 速率限制（rate_limit.RateLimiter），按 LLM_RPM / LLM_TPM 設定，為 None 時不作限制（批量模式可另行設置）
+LLM_RPM = int(os.getenv("LLM_RPM", "0"))
+LLM_TPM = int(os.getenv("LLM_TPM", "0"))
+llm_rate_limiter = RateLimiter(rpm=LLM_RPM or None, tpm=LLM_TPM or None) if LLM_RPM or LLM_TPM else None
+
+
+# 按速率限制等待發出請求，返回預計使用的 token 數（提示 + max_tokens）
+def acquire_llm_rate(params):
+    if llm_rate_limiter is None:
+        return 0
+    estimate = sum(count_tokens(message['content']) for message in params['messages']) + params.get('max_tokens', 0)
+    llm_rate_limiter.acquire(estimate)
+    return estimate
+
+
+# 按實際用量修正速率限制中預計的 token 數（請求失敗時 usage 為 None，退回全部預計的 token 數）
+def settle_llm_rate(estimate, usage):
+    if llm_rate_limiter is not None:
+        llm_rate_limiter.adjust((usage.total_tokens if usage is not None else 0) - estimate)
+
+
+# LLM 調用的韌性設定：每次調用（包括重試）不超過 LLM_TIMEOUT 秒（可用 LLM_TIMEOUT_<STAGE> 按階段覆蓋）；
+# 429、超時、連接錯誤及 5xx 按帶抖動的指數退避重試最多 LLM_MAX_RETRIES 次；
+# LLM_HEDGE_STAGES 中的階段在請求超過該階段最近用時的 LLM_HEDGE_PERCENTILE 百分位數
+# （樣本不足時為 LLM_HEDGE_AFTER 秒）仍未完成時，發出相同的對沖請求並採用先完成的結果
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "90"))
+LLM_HEDGE_STAGES = {stage.strip() for stage in os.getenv("LLM_HEDGE_STAGES", "").split(",") if stage.strip()}
+LLM_HEDGE_AFTER = float(os.getenv("LLM_HEDGE_AFTER", "8"))
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+llm_caller = ResilientCaller(Backoff(max_retries=int(os.getenv("LLM_MAX_RETRIES", "4")),
+                                     base_delay=float(os.getenv("LLM_BACKOFF_BASE", "0.5")),
+                                     max_delay=float(os.getenv("LLM_BACKOFF_MAX", "20"))),
+                             hedge_workers=int(os.getenv("LLM_HEDGE_WORKERS", "16")))
+llm_latency = LatencyTracker()
+
+
+def llm_timeout(stage):
+    return float(os.getenv(f"LLM_TIMEOUT_{stage.upper()}", LLM_TIMEOUT))
+
+
+# 對沖請求的等待秒數，該階段不使用對沖請求時返回 None
+def llm_hedge_after(stage):
+    if stage not in LLM_HEDGE_STAGES:
+        return None
+    observed = llm_latency.percentile(stage, LLM_HEDGE_PERCENTILE)
+    return observed if observed is not None else LLM_HEDGE_AFTER
+
+
+# 發出一次 API 請求（每次重試及對沖請求各自按速率限制排隊），返回 (回應, 預計的 token 數)
+def llm_attempt(stage, params, timeout, stats, **extra):
+    queued_start = time.monotonic()
+    estimate = acquire_llm_rate(params)
+    start = time.monotonic()
+    if llm_rate_limiter is not None:
+        stats.queued += start - queued_start
+    timeout -= start - queued_start
+    if timeout <= 0:
+        settle_llm_rate(estimate, None)
+        raise DeadlineExceeded(f"{stage}: 等待速率限制時已超出截止時間")
+    try:
+        response = get_openai_client().chat.completions.create(**params, **extra, timeout=timeout)
+    except Exception:
+        settle_llm_rate(estimate, None)
+        raise
+    if not extra.get('stream'):
+        llm_latency.record(stage, time.monotonic() - start)
+    return response, estimate
+
+
+# 被捨棄的對沖結果：修正速率限制，並把浪費的 token 記錄到指標及發出請求的統計中（可能在請求完成後才到達）
+def discard_hedged_response(stage, response, estimate, usage_tracker=None):
+    settle_llm_rate(estimate, response.usage)
+    if usage_tracker is not None:
+        usage_tracker.record(response.usage, stage=stage, hedge_wasted=True)
+    metrics.inc('llm_hedge_wasted_tokens_total', "被捨棄的對沖結果使用的 token 數", value=response.usage.total_tokens,
+                stage=stage)
+
+
+# 所有非串流的 LLM 調用均經此函數：先查快取，未命中才調用 API，並記錄到當前請求的統計中
+def chat_completion(stage, **params):
+    usage_tracker = current_usage.get()
+    start = time.monotonic()
+    key = llm_cache_key(stage, params)
+    response = llm_cache_lookup(key)
+    if response is not None:
+        print(f"[INFO] {stage}: 使用 LLM 快取，節省 token = {response.usage.total_tokens}")
+        if usage_tracker is not None:
+            usage_tracker.record(response.usage, cached=True, stage=stage)
+        record_llm_call(stage, start, response.usage, cached=True)
+        return response
+    try:
+        (response, estimate), stats = llm_caller.call(
+            lambda timeout, stats: llm_attempt(stage, params, timeout, stats), llm_timeout(stage),
+            hedge_after=llm_hedge_after(stage), on_discard=lambda result: discard_hedged_response(stage, *result, usage_tracker))
+    except Exception as e:
+        record_llm_call(stage, start, error=e)
+        raise
+    settle_llm_rate(estimate, response.usage)
+    if usage_tracker is not None:
+        usage_tracker.record(response.usage, stage=stage)
+    record_llm_call(stage, start, response.usage, retries=stats.retries, queued=stats.queued, hedged=stats.hedged,
+                    hedge_won=stats.hedge_won)
+    message = response.choices[0].message
+    tool_calls = [(call.function.name, call.function.arguments) for call in message.tool_calls or []]
+    llm_cache_store(key, message.content, response.choices[0].finish_reason, response.usage, tool_calls)
+    return response
+
+
+# 構造目標 LLM 的訊息
+def build_target_messages(prompt, additional_info=""):
+    if additional_info:
+        prompt = f"今天是 {current_date()}。以下是原始的補充資料(參考資料不一定正確)，請謹慎地分析、篩選合適的資料來組織答案，留意資料中所屬的時間範圍是否與問題有關，如果問題涉及 2023 年10月前你要運用你的知識庫去回答，再用補充資料來輔助(如有);如果問題涉及 2023 年10月後，你要從補充資料中提取有關資料去回答(如有)，再用知識庫去輔助 ：\n\n{additional_info}\n\n{prompt}"
+    return [{
+        "role": "user",
+        "content": f"根據以下問題以繁體中文生成答案：{prompt}"
+    }]
+
+
 # 使用目標 LLM 生成答案
 def target_llm(prompt, additional_info=""):
-    if additional_info:
-        prompt = f"今天是 {CURRENT_DATE}。以下是原始的補充資料(參考資料不一定正確)，請謹慎地分析、篩選合適的資料來組織答案，留意資料中所屬的時間範圍是否與問題有關，如果問題涉及 2023 年10月前你要運用你的知識庫去回答，再用補充資料來輔助(如有);如果問題涉及 2023 年10月後，你要從補充資料中提取有關資料去回答(如有)，再用知識庫去輔助 ：\n\n{additional_info}\n\n{prompt}"
-    full_prompt = f"今天是 {CURRENT_DATE}。{prompt}"
-    response = client.chat.completions.create(model=MODEL_NAME,
-                                              messages=[{
-                                                  "role": "user",
-                                                  "content": 
-                                                  f"根據以下問題以繁體中文生成答案：{prompt}"
-                                              }],
-                                              max_tokens=2000,
-                                              temperature=0.3)
+    response = chat_completion('target',
+                               model=MODEL_NAME,
+                               messages=build_target_messages(prompt, additional_info),
+                               max_tokens=2000,
+                               temperature=0.3)
     answer = format_answer(response)
     tokens_used = response.usage.total_tokens
     print(f"[INFO] target_llm: tokens_used = {tokens_used}")  # 添加日誌
     return answer, tokens_used
 
-# 直接使用 LLM 生成答案
-def direct_llm(prompt, additional_info=""):
-    if additional_info:
-        additional_info_processed = handle_additional_info(additional_info)
-        full_additional_info = additional_info_processed["content"]
-
-        prompt = f"今天是 {CURRENT_DATE}。以下是原始的補充資料(參考資料不一定正確)，請謹慎地分析、篩選合適的資料來組織答案，留意資料中所屬的時間範圍是否與問題有關，如果問題涉及 2023 年10月前你要運用你的知識庫去回答，再用補充資料來輔助(如有);如果問題涉及 2023 年10月後，你要優先從補充資料中提取有關資料去回答(如有)，再用知識庫去輔助 ：\n\n{full_additional_info}\n\n{prompt}"
-    response = client.chat.completions.create(model=MODEL_NAME,
-                                              messages=[{
-                                                  "role":
-                                                  "user",
-                                                  "content":
-                                                  f"根據以下問題以繁體中文生成答案：{prompt}"
-                                              }],
-                                              max_tokens=2000,
-                                              temperature=0.3)
+
+# 以串流方式使用目標 LLM 生成答案
+# 每收到一段文字便產出 ('delta', ...) 事件，完成後返回 (答案, token 數)，用法：answer, tokens = yield from ...
+def target_llm_stream(prompt, additional_info="", stage="answer"):
+    params = {'model': MODEL_NAME,
+              'messages': build_target_messages(prompt, additional_info),
+              'max_tokens': 2000,
+              'temperature': 0.3}
+    usage_tracker = current_usage.get()
+    start = time.monotonic()
+    key = llm_cache_key('target', params)
+    cached = llm_cache_lookup(key)
+    if cached is not None:
+        # 快取命中時一次過產出完整答案
+        if usage_tracker is not None:
+            usage_tracker.record(cached.usage, cached=True, stage='target')
+        record_llm_call('target', start, cached.usage, cached=True)
+        yield 'delta', {'stage': stage, 'text': cached.choices[0].message.content}
+        print(f"[INFO] target_llm_stream ({stage}): 使用 LLM 快取，節省 token = {cached.usage.total_tokens}")
+        return format_answer(cached), cached.usage.total_tokens
+
+    # 只在建立串流前重試，串流開始後不再重試（避免重複產出片段），亦不使用對沖請求
+    try:
+        (response, estimate), stats = llm_caller.call(
+            lambda timeout, stats: llm_attempt('target', params, timeout, stats, stream=True,
+                                               stream_options={"include_usage": True}),
+            llm_timeout('target'))
+    except Exception as e:
+        record_llm_call('target', start, error=e)
+        raise
+    parts = []
+    finish_reason = None
+    usage = None
+    tokens_used = 0
+    for chunk in response:
+        if chunk.usage:
+            usage = chunk.usage  # 最後一個 chunk 帶有 usage
+            tokens_used = usage.total_tokens
+        if not chunk.choices:
+            continue
+        choice = chunk.choices[0]
+        if choice.delta and choice.delta.content:
+            parts.append(choice.delta.content)
+            yield 'delta', {'stage': stage, 'text': choice.delta.content}
+        if choice.finish_reason:
+            finish_reason = choice.finish_reason
+    content = ''.join(parts)
+    settle_llm_rate(estimate, usage)
+    record_llm_call('target', start, usage, retries=stats.retries, queued=stats.queued)
+    if usage is not None:
+        if usage_tracker is not None:
+            usage_tracker.record(usage, stage='target')
+        llm_cache_store(key, content, finish_reason, usage)
+    answer = content.strip()
+    if finish_reason == 'length':
+        answer += '... ...'
+    print(f"[INFO] target_llm_stream ({stage}): tokens_used = {tokens_used}")  # 添加日誌
+    return answer, tokens_used
+
+
+# 生成答案：串流模式下逐段產出 token 事件，否則一次過返回
+def generate_answer(prompt, additional_info="", stage="answer", stream=False):
+    with trace_stage(stage):
+        if stream:
+            return (yield from target_llm_stream(prompt, additional_info, stage))
+        return target_llm(prompt, additional_info)
+
+# 直接使用 LLM 生成答案，additional_content 為已經過 handle_additional_info 處理的補充資料
+@traced('direct_answer')
+def direct_llm(prompt, additional_content=""):
+    if additional_content:
+        additional_content, = fit_prompt_sections('direct', (additional_content, 0, 'head'))
+        prompt = f"今天是 {current_date()}。以下是原始的補充資料(參考資料不一定正確)，請謹慎地分析、篩選合適的資料來組織答案，留意資料中所屬的時間範圍是否與問題有關，如果問題涉及 2023 年10月前你要運用你的知識庫去回答，再用補充資料來輔助(如有);如果問題涉及 2023 年10月後，你要優先從補充資料中提取有關資料去回答(如有)，再用知識庫去輔助 ：\n\n{additional_content}\n\n{prompt}"
+    response = chat_completion('direct',
+                               model=MODEL_NAME,
+                               messages=[{
+                                   "role":
+                                   "user",
+                                   "content":
+                                   f"根據以下問題以繁體中文生成答案：{prompt}"
+                               }],
+                               max_tokens=2000,
+                               temperature=0.3)
     answer = format_answer(response)
     tokens_used = response.usage.total_tokens
     print(f"[INFO] direct_llm: tokens_used = {tokens_used}")  # 添加日誌
@@ -111,11 +760,183 @@ def direct_llm(prompt, additional_info=""):
 
 
 # 處理補充資料，從網址中提取內容
-cached_data = {}
-def handle_additional_info(additional_info, token_limit=None):
+# 網頁快取：限制項目數量及總字節數，失敗結果只保留較短時間；設定 SCRAPE_CACHE_DB 後以 SQLite 在多個進程間共享
+SCRAPE_CACHE_DB = os.getenv("SCRAPE_CACHE_DB", "")
+scrape_cache = TTLCache(max_entries=int(os.getenv("SCRAPE_CACHE_MAX_ENTRIES", "256")),
+                        max_bytes=int(os.getenv("SCRAPE_CACHE_MAX_BYTES", str(32 * 1024 * 1024))),
+                        ttl=float(os.getenv("SCRAPE_CACHE_TTL", "3600")),
+                        negative_ttl=float(os.getenv("SCRAPE_CACHE_NEGATIVE_TTL", "60")),
+                        backend=SQLiteBackend(SCRAPE_CACHE_DB, table="scrape_cache") if SCRAPE_CACHE_DB else None)
+
+# 抓取網址的並行設定：單一網址的超時秒數、整體的截止秒數
+SCRAPE_URL_TIMEOUT = float(os.getenv("SCRAPE_URL_TIMEOUT", "20"))
+SCRAPE_DEADLINE = float(os.getenv("SCRAPE_DEADLINE", "30"))
+scrape_executor = ThreadPoolExecutor(max_workers=int(os.getenv("SCRAPE_WORKERS", "8")),
+                                     thread_name_prefix='scraper')
+
+
+# 客戶端超時比 Firecrawl 伺服器端的超時多出的秒數
+SCRAPE_CLIENT_GRACE = float(os.getenv("SCRAPE_CLIENT_GRACE", "5"))
+
+
+# 以 Firecrawl 的 /v1/scrape API 抓取網址，返回與 FirecrawlApp.scrape_url 相同的資料。
+# firecrawl 1.2.4 的 scrape_url 以 requests.post 發出請求而不設超時，服務卡住時會一直佔用抓取線程，
+# 所有 SCRAPE_WORKERS 個線程都卡住後便無法再抓取任何網址；這裡沿用客戶端的設定，但加上客戶端超時
+def firecrawl_scrape(url, params=None):
+    import requests
+
+    app = get_firecrawl_app()
+    params = params or {}
+    timeout = params.get('timeout', SCRAPE_URL_TIMEOUT * 1000) / 1000 + SCRAPE_CLIENT_GRACE
+    response = requests.post(f"{app.api_url}/v1/scrape",
+                             headers={'Content-Type': 'application/json', 'Authorization': f"Bearer {app.api_key}"},
+                             json={'url': url, **params}, timeout=timeout)
+    response.raise_for_status()
+    data = response.json()
+    if not data.get('success') or 'data' not in data:
+        raise RuntimeError(f"Firecrawl 抓取失敗: {data.get('error')}")
+    return data['data']
+
+
+# 抓取單一網址並格式化內容，成功時寫入快取；scraper 預設為 firecrawl_scrape
+def scrape_url_content(url, scraper=None, timeout=SCRAPE_URL_TIMEOUT):
+    scraper = scraper or firecrawl_scrape
+    content = ""
+    try:
+        scrape_result = scraper(url, params={'formats': ['markdown'], 'timeout': int(timeout * 1000)})
+        print(f"[INFO] 抓取結果，網址 {url}: {scrape_result}")
+
+        # 修正：直接從 scrape_result 中獲取 metadata 和 markdown
+        status_code = scrape_result.get('metadata', {}).get('statusCode')
+        content = scrape_result.get('markdown', '')
+
+        if status_code == 200:
+            print(f"[INFO] 成功提取內容，網址 {url}")
+            print(f"[INFO] 狀態碼: {status_code}")
+            print(f"[INFO] 提取內容預覽: {content[:100]}...")  # 日誌顯示首100字符
+            if content:
+                # 提取元數據
+                metadata = scrape_result.get('metadata', {})
+                title = metadata.get('title', '')
+                description = metadata.get('description', '')
+
+                # 將元數據添加到內容中
+                content = f"標題: {title}\n描述: {description}\n\n{content}"
+                #print(f"*** Firecrawl 提取內容: {content[:500]}...")  # 只打印前500個字符
+            else:
+                print(f"[INFO] 狀態碼 200 但無內容，網址 {url}")
+        else:
+            print(f"[INFO] 意外狀態碼 {status_code}，網址 {url}")
+            content = ""
+    except Exception as e:
+        print(f"[錯誤] 抓取網址 {url} 時發生異常: {e}")
+        content = ""
+    scrape_cache.set(url, content)  # 空內容（失敗）只作短暫的負快取
+    return content
+
+
+# 正在抓取的網址 -> future：同一網址同時只抓取一次，其他請求等待同一結果（完成後由快取提供）
+scrape_inflight = {}
+scrape_inflight_lock = threading.Lock()
+
+
+def submit_scrape(url, scraper=None, timeout=SCRAPE_URL_TIMEOUT):
+    with scrape_inflight_lock:
+        future = scrape_inflight.get(url)
+        if future is not None:
+            print(f"[INFO] 網址 {url} 正在抓取，等待同一結果")
+            metrics.inc('scrape_coalesced_total', "與正在進行的抓取合併的網址數量")
+            return future
+        future = scrape_inflight[url] = scrape_executor.submit(scrape_url_content, url, scraper, timeout)
+
+    def remove(done):
+        with scrape_inflight_lock:
+            if scrape_inflight.get(url) is done:
+                del scrape_inflight[url]
+    future.add_done_callback(remove)
+    return future
+
+
+# 並行抓取多個網址：每個網址受 url_timeout 限制，整體不超過 deadline；
+# 超時的網址會被略過，只返回已完成的部分結果（背景抓取完成後仍會寫入快取）
+def scrape_urls(urls, scraper=None, url_timeout=SCRAPE_URL_TIMEOUT, deadline=SCRAPE_DEADLINE):
+    results = {}
+    futures = {}
+    for url in urls:
+        cached = scrape_cache.get(url)
+        if cached is not None:
+            results[url] = cached
+            print(f"[INFO] 使用快取內容，網址 {url}")
+        else:
+            futures[url] = submit_scrape(url, scraper, url_timeout)
+
+    start = time.monotonic()
+    for url, future in futures.items():
+        remaining = min(url_timeout, deadline) - (time.monotonic() - start)
+        try:
+            results[url] = future.result(timeout=max(0, remaining))
+        except FuturesTimeoutError:
+            print(f"[錯誤] 抓取網址 {url} 超時，略過此網址")
+    print(f"[INFO] 抓取 {len(futures)} 條網址用時 {time.monotonic() - start:.2f} 秒")
+    return [(url, results[url]) for url in urls if url in results]
+
+
+# 將內容截斷至不超過 token_limit 個 token
+def truncate_tokens(content, token_limit):
+    encoder = get_encoder()
+    tokenize_content = encoder.encode(content)
+    if len(tokenize_content) > token_limit:
+        content = encoder.decode(tokenize_content[:token_limit])
+    return content
+
+
+# 網頁內容的檢索設定：只把與問題最相關的片段放入提示，而非整頁內容
+RETRIEVAL_ENABLED = os.getenv("RETRIEVAL_ENABLED", "1") == "1"
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "6"))  # 所有網頁合共選取的片段數量
+RETRIEVAL_CHUNK_CHARS = int(os.getenv("RETRIEVAL_CHUNK_CHARS", "1200"))
+RETRIEVAL_MIN_CHARS = int(os.getenv("RETRIEVAL_MIN_CHARS", "4000"))  # 短於此長度的網頁直接使用整頁內容
+
+# 網頁的 BM25 索引快取，以網址及內容雜湊值為鍵，網頁內容更新後會重新建立索引
+index_cache = TTLCache(max_entries=int(os.getenv("SCRAPE_CACHE_MAX_ENTRIES", "256")),
+                       max_bytes=int(os.getenv("SCRAPE_CACHE_MAX_BYTES", str(32 * 1024 * 1024))),
+                       ttl=float(os.getenv("SCRAPE_CACHE_TTL", "3600")),
+                       sizeof=lambda index: index.size)
+
+
+# 取得網頁的 BM25 索引（已快取時直接重用）
+def get_page_index(url, content):
+    key = f"{url}#{hashlib.sha1(content.encode('utf-8')).hexdigest()}"
+    index = index_cache.get(key)
+    if index is None:
+        index = BM25Index(split_chunks(content, RETRIEVAL_CHUNK_CHARS))
+        index_cache.set(key, index)
+    return index
+
+
+# 從多個網頁中選取與問題最相關的片段，按網頁及片段原有次序排列，返回 [(網址, [片段])]；
+# 每個有相關片段的網頁至少保留分數最高的一個，其餘名額按分數在所有網頁之間分配；沒有相關片段的網頁不包括在內
+def retrieve_relevant_chunks(pages, query, top_k=RETRIEVAL_TOP_K):
+    indexes = [get_page_index(url, content) for url, content in pages]
+    page_hits = [index.search(query, top_k) for index in indexes]
+    selected = [(hits[0][0], page_position, hits[0][1]) for page_position, hits in enumerate(page_hits) if hits]
+    rest = [(score, page_position, chunk_position) for page_position, hits in enumerate(page_hits)
+            for score, chunk_position in hits[1:]]
+    rest.sort(key=lambda hit: hit[0], reverse=True)
+    selected += rest[:max(0, top_k - len(selected))]
+    selected.sort(key=lambda hit: (hit[1], hit[2]))
+    results = []
+    for page_position, (url, _) in enumerate(pages):
+        chunks = [indexes[page_position].chunks[hit[2]] for hit in selected if hit[1] == page_position]
+        if chunks:
+            results.append((url, chunks))
+    return results
+
+
+# query 為用戶問題：提供且啟用檢索時，較長的網頁只保留與問題最相關的片段
+@traced('scrape')
+def handle_additional_info(additional_info, token_limit=SCRAPE_PAGE_TOKEN_LIMIT, scraper=None, query=None):
     urls = re.findall(r'http[s]?://\S+', additional_info)
     relevant_content = ""
-    encoder = tiktoken.encoding_for_model(MODEL_NAME)
 
     valid_urls = []
     for url in urls[:3]:  # 限制最多處理 3 條網址
@@ -123,46 +944,27 @@ def handle_additional_info(additional_info, token_limit=None):
             valid_urls.append(url)
 
     if valid_urls:
-        for url in valid_urls:
-            if url in cached_data:
-                content = cached_data[url]
-                print(f"[INFO] 使用快取內容，網址 {url}")
-            else:
-                try:
-                    scrape_result = firecrawl_app.scrape_url(url, params={'formats': ['markdown']})
-                    print(f"[INFO] 抓取結果，網址 {url}: {scrape_result}")
-
-                    # 修正：直接從 scrape_result 中獲取 metadata 和 markdown
-                    status_code = scrape_result.get('metadata', {}).get('statusCode')
-                    content = scrape_result.get('markdown', '')
-
-                    if status_code == 200:
-                        print(f"[INFO] 成功提取內容，網址 {url}")
-                        print(f"[INFO] 狀態碼: {status_code}")
-                        print(f"[INFO] 提取內容預覽: {content[:100]}...")  # 日誌顯示首100字符
-                        if content:
-                            # 提取元數據
-                            metadata = scrape_result.get('metadata', {})
-                            title = metadata.get('title', '')
-                            description = metadata.get('description', '')
-
-                            # 將元數據添加到內容中
-                            content = f"標題: {title}\n描述: {description}\n\n{content}"
-                            #print(f"*** Firecrawl 提取內容: {content[:500]}...")  # 只打印前500個字符
-
-                            tokenize_content = encoder.encode(content)
-                            if token_limit and len(tokenize_content) > token_limit:
-                                content = encoder.decode(tokenize_content[:token_limit])
-                            cached_data[url] = content
-                            relevant_content += f"來源: {url}\n{content}\n\n"
-                        else:
-                            print(f"[INFO] 狀態碼 200 但無內容，網址 {url}")
-                    else:
-                        print(f"[INFO] 意外狀態碼 {status_code}，網址 {url}")
-                    cached_data[url] = content  # 無論內容是否為空,都快取結果
-                except Exception as e:
-                    print(f"[錯誤] 抓取網址 {url} 時發生異常: {e}")
-                    cached_data[url] = ""
+        pages = [(url, content) for url, content in scrape_urls(valid_urls, scraper) if content]
+        long_pages = []
+        if query and RETRIEVAL_ENABLED:
+            long_pages = [(url, content) for url, content in pages if len(content) > RETRIEVAL_MIN_CHARS]
+        for url, content in pages:
+            if (url, content) not in long_pages:
+                relevant_content += f"來源: {url}\n{truncate_tokens(content, token_limit)}\n\n"
+        if long_pages:
+            retrieved = dict(retrieve_relevant_chunks(long_pages, query))
+            fallback_count = 0
+            for url, content in long_pages:
+                chunks = retrieved.get(url)
+                if chunks:
+                    relevant_content += f"來源: {url}（相關片段）\n" + "\n...\n".join(chunks) + "\n\n"
+                else:
+                    # 沒有片段與問題相符（例如以中文提問而網頁為英文）時，與檢索前一樣使用截斷後的網頁內容
+                    relevant_content += f"來源: {url}\n{truncate_tokens(content, token_limit)}\n\n"
+                    fallback_count += 1
+            print(f"[INFO] 檢索: {len(long_pages)} 個網頁共 {sum(len(c) for _, c in long_pages)} 字符，"
+                  f"選取 {sum(len(chunks) for chunks in retrieved.values())} 個相關片段，"
+                  f"{fallback_count} 個網頁沒有相關片段而使用截斷內容")
 
     sanitized_additional_info = re.sub(r'\s+', ' ', additional_info).strip()
 
@@ -171,16 +973,23 @@ def handle_additional_info(additional_info, token_limit=None):
         "content": relevant_content + "\n" + sanitized_additional_info
     }
 
-# 評估生成的答案質量
-def evaluation_llm(user_question, generated_answer, original_facts, additional_info=""):
-    eval_prompt = f"""問題是：{user_question}
-答案是：{generated_answer}
-核心事實：{original_facts}
-
-{"用戶提供的補充資料：" + additional_info if additional_info else ""}
-
-請嚴格地對這個答案進行全面評估，考慮以下方面：
-1. 準確性 (0-10分)：評估答案的正確性，特別注意是否正確包含並強調了核心事實。
+# 評估的輸出格式：json_schema（結構化輸出）/ tool（function calling）/ text（文字評估，以正則表達式提取分數）
+# 結構化評估失敗（模型不支援、輸出被截斷或格式不符）時自動改用文字評估
+EVALUATION_FORMAT = os.getenv("EVALUATION_FORMAT", "json_schema")
+# 精簡模式只返回各方面的分數及改進建議，不包括每個方面的評論，大幅減少輸出的 token 數
+EVALUATION_COMPACT = os.getenv("EVALUATION_COMPACT", "1") == "1"
+EVALUATION_MAX_TOKENS = int(os.getenv("EVALUATION_MAX_TOKENS", "300" if EVALUATION_COMPACT else "600"))
+
+# 評估的方面：(結構化輸出的欄位名稱, 中文名稱)
+EVALUATION_ASPECTS = [
+    ('accuracy', "準確性"),
+    ('comprehensiveness', "全面性"),
+    ('depth', "深度"),
+    ('examples', "相關例子"),
+    ('logic', "論證的邏輯性"),
+]
+
+EVALUATION_CRITERIA = """1. 準確性 (0-10分)：評估答案的正確性，特別注意是否正確包含並強調了核心事實。
 2. 全面性 (0-10分)︰評估是否有遺漏的關鍵信息或觀點或有關的延伸思考。
 3. 深度 (0-10分)︰評估是否有深入的分析或只是表面的描述。
 4. 相關例子 (0-10分)︰評估是否提供了合乎具體性與描述完整性相關範例。如沒有，給予0分。
@@ -189,13 +998,108 @@ def evaluation_llm(user_question, generated_answer, original_facts, additional_i
 評分時，請特別考慮以下幾點：
 - 答案是否準確利用了相關信息？
 - 如果有補充資料，答案是否完全覆蓋了這些信息？
-- 答案是否提供了額外的有價值信息？
+- 答案是否提供了額外的有價值信息？"""
+
+
+# 結構化評估的 JSON schema（strict 模式不支援 minimum / maximum，分數範圍在解析時限制）
+def evaluation_schema(compact=EVALUATION_COMPACT):
+    properties = {}
+    for key, aspect in EVALUATION_ASPECTS:
+        if compact:
+            properties[key] = {"type": "integer", "description": f"{aspect}：0-10 分"}
+        else:
+            properties[key] = {
+                "type": "object",
+                "description": aspect,
+                "properties": {
+                    "score": {"type": "integer", "description": "0-10 分"},
+                    "comment": {"type": "string", "description": "30 字內的繁體中文簡要評論"},
+                },
+                "required": ["score", "comment"],
+                "additionalProperties": False,
+            }
+    properties['suggestions'] = {"type": "string", "description": "繁體中文的改進建議"}
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": [key for key, _ in EVALUATION_ASPECTS] + ['suggestions'],
+        "additionalProperties": False,
+    }
+
+
+# 以結構化輸出（json_schema）或 function calling（tool）評估答案，返回與文字評估相同格式的 (總分, 評估文本, 詳細分數)
+# 調用被拒絕或輸出無法解析時拋出異常
+def structured_evaluation(eval_header, output_format, compact=EVALUATION_COMPACT):
+    if compact:
+        instruction = "只需為每個方面給出 0-10 的整數分數，並以繁體中文給出不超過 3 點、合共 100 字內的改進建議。"
+    else:
+        instruction = "為每個方面給出 0-10 的整數分數及 30 字內的簡要評論，並以繁體中文給出改進建議。"
+    params = {'model': MODEL_NAME,
+              'messages': [{"role": "user", "content": f"{eval_header}\n請嚴格地對這個答案進行全面評估，考慮以下方面：\n{EVALUATION_CRITERIA}\n\n{instruction}"}],
+              'max_tokens': EVALUATION_MAX_TOKENS,
+              'temperature': 0.2}
+    schema = evaluation_schema(compact)
+    if output_format == 'tool':
+        params['tools'] = [{"type": "function",
+                            "function": {"name": "submit_evaluation", "description": "提交答案的評估結果",
+                                         "parameters": schema, "strict": True}}]
+        params['tool_choice'] = {"type": "function", "function": {"name": "submit_evaluation"}}
+        params['parallel_tool_calls'] = False
+    else:
+        params['response_format'] = {"type": "json_schema",
+                                     "json_schema": {"name": "evaluation", "schema": schema, "strict": True}}
+
+    response = chat_completion('evaluation', **params)
+    message = response.choices[0].message
+    if output_format == 'tool':
+        data = json.loads(message.tool_calls[0].function.arguments)
+    else:
+        data = json.loads(message.content)
+
+    scores = []
+    lines = []
+    for i, (key, aspect) in enumerate(EVALUATION_ASPECTS, 1):
+        value = data[key] if compact else data[key]['score']
+        score = max(0, min(10, int(value)))
+        scores.append((aspect, score))
+        comment = "" if compact else f" - {data[key]['comment'].strip()}"
+        lines.append(f"{i}. {aspect}：{score}/10{comment}")
+    total_score = sum(score for _, score in scores)
+    # 評估文本與文字評估的格式相同，改進建議放在結尾（optimizer_llm 截斷時保留結尾）
+    evaluation = "\n".join(lines) + f"\n\n總評分：{total_score}/50\n\n改進建議：{data['suggestions'].strip()}"
+    return total_score / 50, evaluation, scores
+
+
+# 評估生成的答案質量
+@traced('evaluation')
+def evaluation_llm(user_question, generated_answer, original_facts, additional_info=""):
+    generated_answer, additional_info = fit_prompt_sections('evaluation',
+                                                            (generated_answer, 1, None),
+                                                            (additional_info, 0, 'head'))
+    eval_header = f"""問題是：{user_question}
+答案是：{generated_answer}
+核心事實：{original_facts}
+
+{"用戶提供的補充資料：" + additional_info if additional_info else ""}
+"""
+
+    if EVALUATION_FORMAT in ('json_schema', 'tool'):
+        try:
+            return structured_evaluation(eval_header, EVALUATION_FORMAT)
+        except (BadRequestError, json.JSONDecodeError, KeyError, IndexError, TypeError, ValueError, AttributeError) as e:
+            print(f"[錯誤] 結構化評估失敗，改用文字評估: {e}")
+            metrics.inc('evaluation_fallbacks_total', "結構化評估失敗而改用文字評估的次數", format=EVALUATION_FORMAT)
+
+    eval_prompt = f"""{eval_header}
+請嚴格地對這個答案進行全面評估，考慮以下方面：
+{EVALUATION_CRITERIA}
 
 為每個方面打分，並給出簡要評論。最後，以繁體中文給出 "總評分"（滿分50分）和 "改進建議"。
 請確保在評分後明確標註"總評分："，例如"總評分：42/50"。
 """
 
-    response = client.chat.completions.create(
+    response = chat_completion(
+        'evaluation',
         model=MODEL_NAME,
         messages=[{"role": "user", "content": eval_prompt}],
         max_tokens=800,
@@ -206,24 +1110,29 @@ def evaluation_llm(user_question, generated_answer, original_facts, additional_i
     print("Evaluation response:", evaluation)
 
     scores = []
-
-    total_score_match = re.search(r'總評分：\s*(\d+(?:\.\d+)?)/50', evaluation)
-    if total_score_match:
-        total_score = float(total_score_match.group(1))
-    else:
-        total_score = 0  # 確保 total_score 始終有值
-
-    for aspect in ["準確性", "全面性", "深度", "相關例子", "論證的邏輯性"]:
+    for aspect in [aspect for _, aspect in EVALUATION_ASPECTS]:
         score_match = re.search(rf'{aspect}.*?(\d+)/10', evaluation)
         if score_match:
             scores.append((aspect, int(score_match.group(1))))
         else:
             scores.append((aspect, 0))  # 若無匹配則設為0
 
+    total_score_match = re.search(r'總評分[：:]\s*(\d+(?:\.\d+)?)\s*/\s*50', evaluation)
+    if total_score_match:
+        total_score = float(total_score_match.group(1))
+    else:
+        # 找不到總評分時以各方面分數的總和代替，避免評分變為 0 而觸發不必要的優化迭代
+        total_score = sum(score for _, score in scores)
+        print(f"[錯誤] 評估中找不到總評分，以各方面分數總和 {total_score} 代替")
+
     return total_score / 50, evaluation, scores  # 返回總分（0-1範圍）、評估文本和詳細分數
 
 
+@traced('optimizer')
 def optimizer_llm(user_question, current_answer, evaluation, original_facts):
+    current_answer, evaluation = fit_prompt_sections('optimizer',
+                                                     (current_answer, 1, 'head'),
+                                                     (evaluation, 0, 'tail'))  # 改進建議在評估的結尾
     optimize_prompt = f"""原始問題：{user_question}
 當前答案：{current_answer}
 評估結果：{evaluation}
@@ -241,7 +1150,8 @@ def optimizer_llm(user_question, current_answer, evaluation, original_facts):
 
 請基於以上指導原則，以繁體中文生成一個新的、更優化的回答："""
 
-    response = client.chat.completions.create(
+    response = chat_completion(
+        'optimizer',
         model=MODEL_NAME,
         messages=[{"role": "user", "content": optimize_prompt}],
         max_tokens=2000,
@@ -250,14 +1160,16 @@ def optimizer_llm(user_question, current_answer, evaluation, original_facts):
 
     return format_answer(response)
 
+@traced('extract_core_facts')
 def extract_core_facts(answer, question):
     prompt = f"""從以下回答中提取與問題"{question}"直接相關的核心事實：
 
 {answer}
 
-今天是 {CURRENT_DATE}。請列出最重要的 1-3 個核心事實，不能根據推測。若問題涉及日期或時間的概念，請確保使用有效且符合問題要求的資料來回答（例如：問題詢問 2020 年的 CPI 經濟數據，必須使用 2020 年的資料）。如答案中資料的時間與問題要求的時間範圍不符，請明確指出。如果問題涉及 2023 年 10 月前的資料，請使用你的知識庫回答；若問題涉及 2023 年 10 月後的資料，請從補充資料中提取相關內容（如有）。回答格式應為簡潔的要點列表。"""
+今天是 {current_date()}。請列出最重要的 1-3 個核心事實，不能根據推測。若問題涉及日期或時間的概念，請確保使用有效且符合問題要求的資料來回答（例如：問題詢問 2020 年的 CPI 經濟數據，必須使用 2020 年的資料）。如答案中資料的時間與問題要求的時間範圍不符，請明確指出。如果問題涉及 2023 年 10 月前的資料，請使用你的知識庫回答；若問題涉及 2023 年 10 月後的資料，請從補充資料中提取相關內容（如有）。回答格式應為簡潔的要點列表。"""
 
-    response = client.chat.completions.create(
+    response = chat_completion(
+        'extract_core_facts',
         model=MODEL_NAME,
         messages=[{"role": "user", "content": prompt}],
         max_tokens=200,
@@ -266,6 +1178,7 @@ def extract_core_facts(answer, question):
 
     return response.choices[0].message.content.strip()
 
+@traced('fact_check')
 def fact_check(answer, core_facts, question):
     prompt = f"""請檢查以下回答是否包含並正確陳述了這些核心事實：
 
@@ -278,9 +1191,10 @@ def fact_check(answer, core_facts, question):
 問題：
 {question}
 
-今天是 {CURRENT_DATE}。請檢查回答的資料年份是否符合問題要求的時間範圍。如果問題涉及 2023 年 10 月前的內容，使用你的知識庫回答；若涉及 2023 年 10 月後，從補充資料中提取相關內容（如有）。如回答缺少或錯誤陳述核心事實，請直接修改並提供正確答案，不需添加評論；若回答正確無誤，則直接返回原回答。請避免在回答中包含任何檢查過程的描述或評論。"""
+今天是 {current_date()}。請檢查回答的資料年份是否符合問題要求的時間範圍。如果問題涉及 2023 年 10 月前的內容，使用你的知識庫回答；若涉及 2023 年 10 月後，從補充資料中提取相關內容（如有）。如回答缺少或錯誤陳述核心事實，請直接修改並提供正確答案，不需添加評論；若回答正確無誤，則直接返回原回答。請避免在回答中包含任何檢查過程的描述或評論。"""
 
-    response = client.chat.completions.create(
+    response = chat_completion(
+        'fact_check',
         model=MODEL_NAME,
         messages=[{"role": "user", "content": prompt}],
         max_tokens=1000,
@@ -290,35 +1204,315 @@ def fact_check(answer, core_facts, question):
     return response.choices[0].message.content.strip()
 
 
+# 解析請求中的數值設定，不是有限數字時拋出 ValueError（路由返回 400）
+def parse_request_number(name, value, cast):
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError(f"{name} 必須為數字")
+    try:
+        number = float(value)
+    except ValueError:
+        raise ValueError(f"{name} 必須為數字") from None
+    if not math.isfinite(number):
+        raise ValueError(f"{name} 必須為有限的數字")
+    return cast(number)
+
+
+# Beam 模式設定：每輪並行生成 width 個候選答案，保留評分最高的 top_k 個進入下一輪，
+# 最多 rounds 輪，整個搜索不超過 time_budget 秒
+DEFAULT_BEAM_CONFIG = {
+    'width': int(os.getenv("BEAM_WIDTH", "3")),
+    'top_k': int(os.getenv("BEAM_TOP_K", "2")),
+    'rounds': int(os.getenv("BEAM_ROUNDS", "2")),
+    'time_budget': float(os.getenv("BEAM_TIME_BUDGET", "90")),
+}
+# 請求中 beam 設定的上限（不低於預設值），避免單一請求並行大量的候選答案
+BEAM_MAX_CONFIG = {
+    'width': max(DEFAULT_BEAM_CONFIG['width'], int(os.getenv("BEAM_MAX_WIDTH", "5"))),
+    'top_k': max(DEFAULT_BEAM_CONFIG['top_k'], int(os.getenv("BEAM_MAX_TOP_K", "3"))),
+    'rounds': max(DEFAULT_BEAM_CONFIG['rounds'], int(os.getenv("BEAM_MAX_ROUNDS", "3"))),
+    'time_budget': max(DEFAULT_BEAM_CONFIG['time_budget'], float(os.getenv("BEAM_MAX_TIME_BUDGET", "180"))),
+}
+PIPELINE_MODE = os.getenv("PIPELINE_MODE", "sequential")  # sequential / beam
+
+
+# 從請求中取得 beam 設定：beam 可為 true 或覆蓋部分設定的字典，未指定時按 PIPELINE_MODE 決定；
+# 覆蓋的數值限制在 1 至 BEAM_MAX_* 之間，數值無效時拋出 ValueError
+def beam_config_from_request(data):
+    beam = data.get('beam', PIPELINE_MODE == 'beam')
+    if beam is None or beam is False:
+        return None
+    if not isinstance(beam, (bool, dict)):
+        raise ValueError("beam 必須為 true、false 或物件")
+    config = dict(DEFAULT_BEAM_CONFIG)
+    if isinstance(beam, dict):
+        for key, value in beam.items():
+            if key in config:
+                number = parse_request_number(f"beam.{key}", value, type(config[key]))
+                config[key] = min(BEAM_MAX_CONFIG[key], max(1, number))
+    config['top_k'] = min(config['top_k'], config['width'])
+    # beam 模式的輪數上限為 beam.rounds 與 iteration.max_rounds 中較小者（見 build_stop_controller），
+    # 請求同時指定兩者而數值不同時無法判斷意圖，因此拒絕
+    iteration = data.get('iteration')
+    if isinstance(beam, dict) and 'rounds' in beam and isinstance(iteration, dict) and 'max_rounds' in iteration:
+        if parse_request_number("iteration.max_rounds", iteration['max_rounds'], int) != config['rounds']:
+            raise ValueError("beam.rounds 與 iteration.max_rounds 不一致：beam 模式取兩者中較小的輪數，請只指定其中一個")
+    return config
+
+
+# 優化迭代的停止條件（見 stopping.py），可在請求中以 "iteration": {...} 覆蓋部分設定；上限為 0 表示不限制
+DEFAULT_ITERATION_CONFIG = {
+    'max_rounds': int(os.getenv("ITERATION_MAX_ROUNDS", "2")),
+    'target_score': float(os.getenv("ITERATION_TARGET_SCORE", "0.9")),
+    'plateau_epsilon': float(os.getenv("ITERATION_PLATEAU_EPSILON", "0.02")),  # 0.02 即總評分 1/50
+    'plateau_rounds': int(os.getenv("ITERATION_PLATEAU_ROUNDS", "1")),
+    'max_tokens': int(os.getenv("ITERATION_MAX_TOKENS", "0")),
+    'max_cost': float(os.getenv("ITERATION_MAX_COST", "0")),  # 美元
+    'deadline': float(os.getenv("ITERATION_DEADLINE", "0")),  # 秒
+    # 可選：上一次評估的準確性達到此分數時略過事實檢查，預設 0 即每輪都檢查
+    'skip_fact_check_accuracy': int(os.getenv("FACT_CHECK_SKIP_ACCURACY", "0")),
+}
+
+# 每百萬 token 的價格（美元），用於成本上限
+LLM_PRICE_PROMPT = float(os.getenv("LLM_PRICE_PROMPT", "0.15"))
+LLM_PRICE_COMPLETION = float(os.getenv("LLM_PRICE_COMPLETION", "0.6"))
+
+
+# 取較嚴格的上限（0 表示不限制）：請求只能收緊伺服器設定的上限，不能放寬或取消
+def tighter_limit(default, requested):
+    if requested <= 0:
+        return default
+    return requested if default <= 0 else min(default, requested)
+
+
+# 從請求中取得停止條件：請求只能令迭代更早停止（較少輪數、較低的目標分數、較嚴格的 token / 成本 / 時間上限）；
+# 數值無效時拋出 ValueError
+def iteration_config_from_request(data):
+    config = dict(DEFAULT_ITERATION_CONFIG)
+    overrides = data.get('iteration')
+    if overrides is None:
+        return config
+    if not isinstance(overrides, dict):
+        raise ValueError("iteration 必須為物件")
+    values = {key: parse_request_number(f"iteration.{key}", value, type(config[key]))
+              for key, value in overrides.items() if key in config}
+    for key in ('max_rounds', 'max_tokens', 'max_cost', 'deadline'):
+        if key in values:
+            config[key] = tighter_limit(config[key], values[key])
+    if 'target_score' in values:
+        config['target_score'] = min(config['target_score'], values['target_score'])
+    if 'plateau_epsilon' in values:
+        config['plateau_epsilon'] = max(config['plateau_epsilon'], values['plateau_epsilon'])
+    if 'plateau_rounds' in values:
+        config['plateau_rounds'] = max(1, min(config['plateau_rounds'], values['plateau_rounds']))
+    if 'skip_fact_check_accuracy' in values:
+        config['skip_fact_check_accuracy'] = max(0, values['skip_fact_check_accuracy'])
+    return config
+
+
+# 按設定建立停止策略；beam 模式的輪數上限及截止時間分別取 beam 的輪數及時間預算與停止條件中較小者
+def build_stop_controller(config, usage, beam_config=None):
+    max_rounds = config['max_rounds']
+    deadline = config['deadline']
+    if beam_config:
+        max_rounds = min(max_rounds, beam_config['rounds']) if max_rounds > 0 else beam_config['rounds']
+        deadline = min(deadline, beam_config['time_budget']) if deadline > 0 else beam_config['time_budget']
+    policies = [TargetScore(config['target_score']), MaxRounds(max_rounds)]
+    if config['plateau_epsilon'] > 0:
+        policies.append(Plateau(config['plateau_epsilon'], config['plateau_rounds']))
+    if config['max_tokens'] > 0:
+        policies.append(TokenCeiling(config['max_tokens']))
+    if config['max_cost'] > 0:
+        policies.append(CostCeiling(config['max_cost'], LLM_PRICE_PROMPT, LLM_PRICE_COMPLETION))
+    if deadline > 0:
+        policies.append(Deadline(deadline))
+    return StopController(policies, usage)
+
+
+# 上一次評估的準確性已達到設定的分數時略過事實檢查。注意只能依據被優化的答案（上一輪）的評分：
+# 本輪改寫後的新答案尚未評估，略過時新答案未經事實檢查便會進入評估，因此此選項預設關閉
+def should_skip_fact_check(scores, config):
+    threshold = config['skip_fact_check_accuracy']
+    accuracy = dict(tuple(score) for score in scores).get("準確性", 0)
+    if threshold > 0 and accuracy >= threshold:
+        print(f"[INFO] 準確性已達 {accuracy}/10，略過事實檢查")
+        metrics.inc('fact_check_skipped_total', "因準確性已高而略過的事實檢查次數")
+        return True
+    return False
+
+
+# 構造優化迭代的目標 LLM 問題，按預算截斷補充資料及較舊的上下文，返回 (問題, 上下文)
+def build_optimization_question(new_prompt, additional_content, core_facts, context):
+    new_prompt, additional_content, core_facts, context = fit_prompt_sections(
+        'target',
+        (new_prompt, 2, 'head'),
+        (additional_content, 1, 'head'),
+        (core_facts, 3, None),
+        (context, 0, 'tail'))  # 保留最近的回答及評估
+    return f"{new_prompt}\n\n補充資料：\n{additional_content}\n核心事實：{core_facts}", context
+
+
+# 生成一個優化候選答案：優化提示 -> 目標 LLM -> 事實檢查（skip_fact_check 為 True 時略過），返回 (答案, token 數)
+def generate_candidate(user_question, answer, evaluation, core_facts, additional_content, skip_fact_check=False):
+    new_prompt = optimizer_llm(user_question, answer, evaluation, core_facts)
+    new_full_question, context = build_optimization_question(
+        new_prompt, additional_content, core_facts, f"\n前一次回答：{answer}\n評估：{evaluation}\n")
+    with trace_stage('rewrite'):
+        candidate, tokens = target_llm(new_full_question, context)
+    if skip_fact_check:
+        return candidate, tokens
+    return fact_check(candidate, core_facts, user_question), tokens
+
+
+# Beam 模式的優化迭代：每輪並行生成及評估多個候選答案，只保留評分最高的 top_k 個
+# beam 為 [(評分, 答案, 評估文本, 詳細分數)]；evaluate 為同一答案只評估一次的評估函數；controller 決定何時停止
+# 每輪產出一個 ('iteration', ...) 事件，完成後返回 (最佳評分, 最佳答案, 最佳詳細分數, 生成候選使用的 token 數)
+def beam_search_events(user_question, core_facts, additional_content, beam, evaluate, config, iterations_data, logs,
+                       controller, iteration_config):
+    best_score, best_answer, _, best_scores = max(beam, key=lambda item: item[0])
+    total_tokens = 0
+    round_index = 0
+
+    while not controller.should_stop():
+        round_index += 1
+        controller.start_round()
+
+        # 按評分次序輪流選擇父答案，並行生成候選答案
+        parents = [beam[i % len(beam)] for i in range(config['width'])]
+        futures = [submit_llm_task(generate_candidate, user_question, parent[1], parent[2], core_facts, additional_content,
+                                   should_skip_fact_check(parent[3], iteration_config))
+                   for parent in parents]
+        done, not_done = wait_futures(futures, timeout=controller.remaining())
+        candidates = []
+        for future in done:
+            try:
+                candidate, tokens = future.result()
+            except Exception as e:
+                print(f"[錯誤] beam: 生成候選答案時發生異常: {e}")
+                continue
+            total_tokens += tokens
+            candidates.append(candidate)
+        if not_done:
+            print(f"[INFO] beam: {len(not_done)} 個候選答案超出時間預算，已略過")
+        if not candidates:
+            controller.stop('no_candidates', "本輪沒有成功生成的候選答案")
+            break
+
+        # 並行評估候選答案
+        eval_futures = [submit_llm_task(evaluate, candidate) for candidate in candidates]
+        done, _ = wait_futures(eval_futures, timeout=controller.remaining())
+        scored = []
+        for candidate, future in zip(candidates, eval_futures, strict=True):
+            if future in done and future.exception() is None:
+                score, evaluation, scores = future.result()
+                scored.append((score, candidate, evaluation, scores))
+        if not scored:
+            controller.stop('no_candidates', "本輪沒有成功評估的候選答案")
+            break
+
+        scored.sort(key=lambda item: item[0], reverse=True)
+        round_best = scored[0]
+        beam = sorted(beam + scored, key=lambda item: item[0], reverse=True)[:config['top_k']]
+        if round_best[0] > best_score:
+            best_score, best_answer, _, best_scores = round_best
+        controller.end_round(best_score)
+
+        logs.append(f"\nBeam 第 {round_index} 輪 - 候選評分: {[round(item[0], 2) for item in scored]}")
+        logs.append(f"詳細評分: {round_best[3]}")
+        iterations_data.append({
+            'iteration': round_index,
+            'answer': round_best[1],
+            'score': round_best[0],
+            'evaluation': round_best[2],
+            'scores': round_best[3],
+            'candidate_scores': [item[0] for item in scored]
+        })
+        yield 'iteration', iterations_data[-1]
+
+    return best_score, best_answer, best_scores, total_tokens
+
+
 # 主循環，用於多層次優化
-def main_loop(user_question, additional_info="", original_facts=""):
+# 以生成器形式逐步產出 (事件名稱, 數據) ，每個階段完成後即時產出，最後產出 ('result', response_data)
+# direct_result 為 /direct_llm 的結果（見 run_direct_llm），提供時重用其直接回答及評估，不再重新生成
+# beam_config 不為 None 時以 beam 模式進行優化迭代（見 beam_config_from_request）
+# 最後的 response_data 附有各階段用時（trace），profile 為 True 時另附 span 明細及 CPU 熱點（profile）
+def main_loop_events(user_question, additional_info="", original_facts="", stream=False, direct_result=None,
+                     beam_config=None, profile=False, iteration_config=None):
+    trace = start_trace(profile)
+    with profile_block(profile) as profile_report:
+        for event, data in optimization_events(user_question, additional_info, original_facts, stream,
+                                               direct_result, beam_config, iteration_config):
+            if event == 'result':
+                break
+            yield event, data
+        else:
+            return
+    yield 'result', attach_trace(data, 'main_loop', trace, profile_report)
+
+
+def optimization_events(user_question, additional_info="", original_facts="", stream=False, direct_result=None,
+                        beam_config=None, iteration_config=None):
+    usage = track_llm_usage()
+    direct_result = direct_result or {}
+    direct_tokens = direct_result.get('direct_tokens') or 0
     logs = []
     iterations_data = []
     logs.append("\n===== 多層次 LLM (初始回答) =====")
+    yield 'start', {'user_question': user_question}
 
     # 構造帶有補充資料的完整問題
     full_question = user_question
     additional_content = ""
     if additional_info:
-        additional_info_processed = handle_additional_info(additional_info)
+        additional_info_processed = handle_additional_info(additional_info, query=user_question)
         additional_content = additional_info_processed["content"]
+        trimmed_content, = fit_prompt_sections('target', (additional_content, 0, 'head'))
 
-        full_question = f"以下是原始的補充資料，請謹慎地分析、篩選合適的資料來組織答案，留意資料中涉及的時間範圍(如有)是否與問題有關 ：\n\n{additional_content}\n\n{user_question}"
+        full_question = f"以下是原始的補充資料，請謹慎地分析、篩選合適的資料來組織答案，留意資料中涉及的時間範圍(如有)是否與問題有關 ：\n\n{trimmed_content}\n\n{user_question}"
 
-    initial_answer, initial_tokens = target_llm(full_question)
+    # 重用直接回答作為初始回答，避免再次生成
+    reused_direct_answer = bool(direct_result.get('direct_answer'))
+    if reused_direct_answer:
+        initial_answer = direct_result['direct_answer']
+        initial_tokens = direct_tokens
+        usage.record_avoided(1, initial_tokens)
+        print("[INFO] main_loop: 重用直接回答作為初始回答")
+    else:
+        initial_answer, initial_tokens = yield from generate_answer(full_question, stage='initial_answer', stream=stream)
     logs.append(initial_answer)
     logs.append(f"\n<初始回答使用的 token 數>：{initial_tokens}")
+    yield 'initial_answer', {'answer': initial_answer, 'tokens': initial_tokens, 'reused': reused_direct_answer}
 
     # 提取核心事實
     core_facts = original_facts if original_facts else extract_core_facts(initial_answer, user_question)
 
+    # 同一答案文本只評估一次：答案文本 -> (評分, 評估文本, 詳細分數, token 數)
+    evaluations = {}
+    if (reused_direct_answer and original_facts and direct_result.get('direct_evaluation')
+            and direct_result.get('direct_scores') and direct_result.get('direct_score') is not None):
+        evaluations[initial_answer] = (direct_result['direct_score'] / 10,  # 10分制轉回 0-1 範圍
+                                       direct_result['direct_evaluation'],
+                                       [tuple(score) for score in direct_result['direct_scores']],
+                                       direct_result.get('direct_evaluation_tokens') or 0)
+
+    def evaluate(text):
+        if text in evaluations:
+            score, evaluation, scores, tokens = evaluations[text]
+            usage.record_avoided(1, tokens)
+            print("[INFO] main_loop: 重用相同答案的評估結果")
+            return score, evaluation, scores
+        with track_stage_usage() as stage_usage:
+            score, evaluation, scores = evaluation_llm(user_question, text, core_facts, additional_content)
+        evaluations[text] = (score, evaluation, scores, stage_usage.total_tokens)
+        return score, evaluation, scores
+
     # 評估初始回答
-    initial_score, initial_evaluation, initial_scores = evaluation_llm(user_question, initial_answer, core_facts, additional_content)
+    initial_score, initial_evaluation, initial_scores = evaluate(initial_answer)
 
     answer = initial_answer
+    evaluation = initial_evaluation
+    scores = initial_scores
     context = ""
-    iteration_count = 0
-    max_iterations = 2 # 2 = 3 次
     best_score = initial_score
     best_answer = answer
     best_scores = initial_scores
@@ -333,38 +1527,58 @@ def main_loop(user_question, additional_info="", original_facts=""):
         'evaluation': initial_evaluation,
         'scores': initial_scores
     })
+    yield 'iteration', {**iterations_data[-1], 'initial_score': initial_score * 10, 'core_facts': core_facts}
+
+    iteration_config = iteration_config or dict(DEFAULT_ITERATION_CONFIG)
+    controller = build_stop_controller(iteration_config, usage, beam_config)
+    controller.start(initial_score)
+
+    if beam_config:
+        best_score, best_answer, best_scores, beam_tokens = yield from beam_search_events(
+            user_question, core_facts, additional_content,
+            [(initial_score, initial_answer, initial_evaluation, initial_scores)],
+            evaluate, beam_config, iterations_data, logs, controller, iteration_config)
+        total_tokens += beam_tokens
+
+    # 逐輪優化：每輪生成一個新答案並評估，直至觸發停止策略
+    while not beam_config and not controller.should_stop():
+        controller.start_round()
+        skip_fact_check = should_skip_fact_check(scores, iteration_config)
+        new_prompt = optimizer_llm(user_question, answer, evaluation, core_facts)
+        context += f"\n前一次回答：{answer}\n評估：{evaluation}\n"
 
-    for i in range(max_iterations):
-        score, evaluation, scores = evaluation_llm(user_question, answer, core_facts, additional_content)
-        logs.append(f"\n迭代 {i + 1} - 評分: {score:.2f}")
-        logs.append(f"詳細評分: {scores}")
-        iterations_data.append({
-            'iteration': i + 1,
-            'answer': answer,
-            'score': score,
-            'evaluation': evaluation,
-            'scores': scores
-        })
+        # 使用已爬取的補充資料進行優化迭代
+        new_full_question, context = build_optimization_question(new_prompt, additional_content, core_facts, context)
+        with trace_stage('rewrite'):
+            answer, tokens = target_llm(new_full_question, context)
+
+        # 事實檢查步驟
+        if not skip_fact_check:
+            answer = fact_check(answer, core_facts, user_question)
+        total_tokens += tokens
 
+        score, evaluation, scores = evaluate(answer)
         if score > best_score:
             best_score = score
             best_answer = answer
             best_scores = scores
-        if score > 0.9:
-            break
-
-        new_prompt = optimizer_llm(user_question, answer, evaluation, core_facts)
-        context += f"\n前一次回答：{answer}\n評估：{evaluation}\n"
-
-        # 使用已爬取的補充資料進行優化迭代
-        new_full_question = f"{new_prompt}\n\n補充資料：\n{additional_content}\n核心事實：{core_facts}"
-        answer, tokens = target_llm(new_full_question, context)
+        controller.end_round(best_score)
 
-        # 事實檢查步驟
-        answer = fact_check(answer, core_facts, user_question)
+        logs.append(f"\n迭代 {controller.rounds} - 評分: {score:.2f}")
+        logs.append(f"詳細評分: {scores}")
+        iterations_data.append({
+            'iteration': controller.rounds,
+            'answer': answer,
+            'score': score,
+            'evaluation': evaluation,
+            'scores': scores,
+            'fact_checked': not skip_fact_check
+        })
+        yield 'iteration', iterations_data[-1]
 
-        total_tokens += tokens
-        iteration_count += 1
+    stop_reason = controller.to_dict()
+    metrics.inc('iteration_stops_total', "優化迭代按停止策略的停止次數", policy=stop_reason['policy'] or 'none')
+    logs.append(f"\n停止優化迭代（{stop_reason['policy']}）：{stop_reason['detail']}")
 
     logs.append(f"\n===== 最終多層 LLM 回答（評分：{best_score:.2f}）=====")
     logs.append(best_answer)
@@ -380,9 +1594,11 @@ def main_loop(user_question, additional_info="", original_facts=""):
 回答應該是完整的、可以獨立閱讀的 'best_answer' 內容，包括所有細節、相關例子、邏輯論證、資料出處。請確保回答準確、全面、有學術深度。使用中英對照解釋專業名詞、人名、地方名、公司名稱等。如果內容裡包括數字、中文與英文，字與字之間要加入 (空隔) 作分隔，方便閱讀 (例如︰約翰 (John) 是一位老師, 英國國家統計局 (ONS) 為英國統計局的執行機構, 明年是 2025 年)。"""
     #但不應包含任何元描述或評論
     
-    final_answer, final_tokens = target_llm(final_prompt)
+    final_answer, final_tokens = yield from generate_answer(final_prompt, stage='final_answer', stream=stream)
     #print(f"*** main_loop *** final_answer Markdown content:\n{final_answer}")
     total_tokens += final_tokens
+    yield 'final_answer', {'answer': final_answer, 'final_score': best_score * 10, 'total_tokens': total_tokens,
+                           'stop_reason': stop_reason}
 
     # 比較初始回答和最終回答
     comparison_result = compare_answers(user_question, initial_answer, final_answer, initial_scores, best_scores)
@@ -400,14 +1616,115 @@ def main_loop(user_question, additional_info="", original_facts=""):
         'iterations_data': iterations_data,
         'initial_scores': initial_scores,
         'final_scores': best_scores,
-        'core_facts': core_facts
+        'core_facts': core_facts,
+        'stop_reason': stop_reason,
+        'llm_usage': usage.to_dict(),
+        'result_id': store_result_iterations(iterations_data)
     }
 
-    return jsonify(response_data)
+    try:
+        log_search(user_question, MODEL_NAME, direct_tokens, total_tokens, best_score,
+                   cache_hits=usage.cache_hits, saved_tokens=usage.saved_tokens, stop_reason=stop_reason['policy'])
+    except Exception as e:
+        print(f"[錯誤] 寫入搜索日志時發生異常: {e}")
+
+    yield 'result', response_data
+
+
+# 主循環，一次過返回所有結果
+def run_main_loop(user_question, additional_info="", original_facts="", direct_result=None, beam_config=None,
+                  profile=False, iteration_config=None):
+    response_data = {}
+    for event, data in main_loop_events(user_question, additional_info, original_facts, direct_result=direct_result,
+                                        beam_config=beam_config, profile=profile, iteration_config=iteration_config):
+        if event == 'result':
+            response_data = data
+    return response_data
+
+
+def main_loop(user_question, additional_info="", original_facts="", direct_result=None, beam_config=None,
+              profile=False, iteration_config=None, compact=False):
+    key = single_flight_key('main_loop', user_question, additional_info, original_facts, direct_result or {},
+                            beam_config, iteration_config)
+    result = run_coalesced('main_loop', key, profile, run_main_loop, user_question, additional_info,
+                           original_facts, direct_result, beam_config, profile, iteration_config)
+    return jsonify(compact_result(result) if compact else result)
+
+
+# 將事件格式化為 Server-Sent Events 訊息
+def format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+# 每次優化的完整迭代記錄（答案及評估），在精簡回應模式下供客戶端按需取得
+RESULT_STORE_DB = os.getenv("RESULT_STORE_DB", "")
+result_store = TTLCache(max_entries=int(os.getenv("RESULT_STORE_MAX_ENTRIES", "256")),
+                        max_bytes=int(os.getenv("RESULT_STORE_MAX_BYTES", str(32 * 1024 * 1024))),
+                        ttl=float(os.getenv("RESULT_STORE_TTL", "3600")),
+                        backend=SQLiteBackend(RESULT_STORE_DB, table="result_store") if RESULT_STORE_DB else None)
+
+
+# 保存迭代記錄，返回結果 ID
+def store_result_iterations(iterations_data):
+    result_id = uuid.uuid4().hex
+    result_store.set(result_id, json.dumps(iterations_data, ensure_ascii=False))
+    return result_id
+
+
+# 精簡回應模式：略去重複的欄位及評估文本，迭代答案以相對上一次迭代的差異表示（見 text_diff.py）；
+# 請求中以 "compact": true 或 ?compact=1 啟用，RESPONSE_COMPACT=1 時預設啟用
+RESPONSE_COMPACT = os.getenv("RESPONSE_COMPACT", "0") == "1"
+COMPACT_DROPPED_FIELDS = ('final_answer_markdown', 'logs')  # 與 final_answer 及各迭代內容重複
+STREAMED_FIELDS = ('initial_answer', 'final_answer', 'iterations_data')  # 串流中已在之前的事件發送
+
+
+def compact_from_request(data):
+    value = data.get('compact', request.args.get('compact'))
+    if value is None:
+        return RESPONSE_COMPACT
+    return value in (True, 1, '1', 'true')
+
+
+# 以差異代替迭代答案（差異不比原文短時保留原文），並略去評估文本
+def compact_iteration(item, previous_answer):
+    compacted = {key: value for key, value in item.items() if key not in ('answer', 'evaluation')}
+    diff = diff_text(previous_answer, item['answer'])
+    if len(json.dumps(diff, ensure_ascii=False)) < len(json.dumps(item['answer'], ensure_ascii=False)):
+        compacted['answer_diff'] = diff
+    else:
+        compacted['answer'] = item['answer']
+    return compacted
+
+
+# streamed 為 True 時亦略去串流中已發送過的欄位
+def compact_result(data, streamed=False):
+    dropped = COMPACT_DROPPED_FIELDS + (STREAMED_FIELDS if streamed else ())
+    compacted = {key: value for key, value in data.items() if key not in dropped}
+    if not streamed:
+        previous_answer = data['initial_answer']
+        compacted['iterations_data'] = []
+        for item in data['iterations_data']:
+            compacted['iterations_data'].append(compact_iteration(item, previous_answer))
+            previous_answer = item['answer']
+    compacted['compact'] = True
+    return compacted
+
+
+def compact_events(events):
+    previous_answer = ""
+    for event, data in events:
+        if event == 'initial_answer':
+            previous_answer = data['answer']
+        elif event == 'iteration':
+            data, previous_answer = compact_iteration(data, previous_answer), data['answer']
+        elif event == 'result':
+            data = compact_result(data, streamed=True)
+        yield event, data
 
 
 
 # 比較直接 LLM 和最終優化後 LLM 的答案
+@traced('compare')
 def compare_answers(user_question, direct_answer, final_answer, direct_scores, final_scores):
     comparison_prompt = f"""請對以下兩個回答進行答案的質量分析：
 
@@ -431,7 +1748,8 @@ def compare_answers(user_question, direct_answer, final_answer, direct_scores, f
 關於 "{user_question}" 的答案分析報告：
 """
 
-    response = client.chat.completions.create(
+    response = chat_completion(
+        'compare',
         model=MODEL_NAME,
         messages=[{"role": "user", "content": comparison_prompt}],
         max_tokens=600,
@@ -442,54 +1760,341 @@ def compare_answers(user_question, direct_answer, final_answer, direct_scores, f
     return comparison_text
 
 # 定義主頁路由
-@app.route('/', methods=['GET', 'POST'])
+@routes.route('/', methods=['GET', 'POST'])
 def home():
     return render_template('index.html', MODEL_NAME=MODEL_NAME)
 
 
-# 定義直接 LLM 路由
-@app.route('/direct_llm', methods=['POST'])
-def direct_llm_route():
-    user_question = request.json.get('user_question')
-    additional_info = request.json.get('additional_info', "")
-    print("[INFO] Received direct_llm_route Request")
-    if user_question:
+# 直接 LLM 流程：生成直接回答、提取核心事實並評估
+def run_direct_llm(user_question, additional_info="", profile=False):
+    usage = track_llm_usage()
+    trace = start_trace(profile)
+    with profile_block(profile) as profile_report:
+        # 補充資料只處理一次，之後的生成及評估均重用處理結果
+        additional_content = ""
         if additional_info:
-            additional_content = handle_additional_info(additional_info)
-            user_question_with_info = f"{user_question}\n\n補充資料：\n{additional_content}"
-        else:
-            user_question_with_info = user_question
-        direct_answer, direct_tokens = direct_llm(user_question_with_info)
+            additional_content = handle_additional_info(additional_info, query=user_question)["content"]
+        direct_answer, direct_tokens = direct_llm(user_question, additional_content)
 
         # 提取核心事實
         original_facts = extract_core_facts(direct_answer, user_question)
 
         # 評估直接回答
-        direct_score, _, _ = evaluation_llm(user_question, direct_answer, original_facts, additional_info)
-        return jsonify(
-            direct_answer=direct_answer,
-            direct_tokens=direct_tokens,
-            direct_score=direct_score * 10,  # 總評分轉為10分制
-            original_facts=original_facts  # 添加這行，將核心事實傳遞給前端
-        )
+        with track_stage_usage() as evaluation_usage:
+            direct_score, direct_evaluation, direct_scores = evaluation_llm(user_question, direct_answer, original_facts, additional_content)
+    return attach_trace({
+        'direct_answer': direct_answer,
+        'direct_tokens': direct_tokens,
+        'direct_score': direct_score * 10,  # 總評分轉為10分制
+        'direct_scores': direct_scores,
+        'direct_evaluation': direct_evaluation,
+        'direct_evaluation_tokens': evaluation_usage.total_tokens,
+        'original_facts': original_facts,  # 添加這行，將核心事實傳遞給前端
+        'llm_usage': usage.to_dict()
+    }, 'direct', trace, profile_report)
+
+
+# 從請求中取出 /direct_llm 返回的結果，供 main_loop 重用
+DIRECT_RESULT_FIELDS = ('direct_answer', 'direct_tokens', 'direct_score', 'direct_scores',
+                        'direct_evaluation', 'direct_evaluation_tokens')
+
+
+# 欄位由客戶端提供，須先檢查類型：答案及評估為字符串，分數及 token 數為數字，direct_scores 為 [方面, 分數] 的列表；
+# 類型不符時拋出 ValueError（路由返回 400）
+def direct_result_from_request(data):
+    result = {field: data.get(field) for field in DIRECT_RESULT_FIELDS if data.get(field) is not None}
+    for field in ('direct_answer', 'direct_evaluation'):
+        if field in result and not isinstance(result[field], str):
+            raise ValueError(f"{field} 必須為字符串")
+    for field in ('direct_tokens', 'direct_evaluation_tokens'):
+        if field in result:
+            result[field] = max(0, parse_request_number(field, result[field], int))
+    if 'direct_score' in result:
+        result['direct_score'] = parse_request_number('direct_score', result['direct_score'], float)
+    if 'direct_scores' in result:
+        scores = result['direct_scores']
+        if not isinstance(scores, list) or not all(
+                isinstance(score, (list, tuple)) and len(score) == 2 and isinstance(score[0], str) for score in scores):
+            raise ValueError("direct_scores 必須為 [方面, 分數] 的列表")
+        result['direct_scores'] = [[aspect, parse_request_number(f"direct_scores.{aspect}", value, float)]
+                                   for aspect, value in scores]
+    return result
+
+
+# 相同請求的鍵：流程名稱、問題、補充資料及核心事實（合併空白後），以及其他影響結果的設定
+# （主循環包括直接 LLM 的結果，其答案及評估是優化的起點）；整個鍵以 sha256 雜湊，較長的答案亦不會令鍵變長
+def single_flight_key(pipeline, user_question, additional_info="", original_facts="", *settings):
+    texts = [re.sub(r'\s+', ' ', text or "").strip() for text in (user_question, additional_info, original_facts)]
+    payload = json.dumps([pipeline, *texts, *settings], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def record_single_flight(pipeline, role):
+    metrics.inc('single_flight_requests_total', "可合併的請求數量（按角色）", pipeline=pipeline, role=role)
+    if role != 'leader':
+        print(f"[INFO] {pipeline}: 共用相同請求的執行結果（{role}）")
+
+
+# 相同的並行請求只執行一次 func；停用合併或請求 profiling 時直接執行
+def run_coalesced(pipeline, key, profile, func, *args):
+    if single_flight is None or profile:
+        return func(*args)
+    result, role = single_flight.do(key, func, *args)
+    record_single_flight(pipeline, role)
+    return result
+
+
+# 相同的並行串流請求共用同一個事件生成器（在背景線程執行）；停用合併或請求 profiling 時直接執行
+def coalesced_events(pipeline, key, profile, factory):
+    if single_flight is None or profile:
+        return factory()
+    events, role = single_flight.events(key, factory)
+    record_single_flight(pipeline, role)
+    return events
+
+
+# 定義直接 LLM 路由
+@routes.route('/direct_llm', methods=['POST'])
+def direct_llm_route():
+    user_question = request.json.get('user_question')
+    additional_info = request.json.get('additional_info', "")
+    print("[INFO] Received direct_llm_route Request")
+    if user_question:
+        profile = profile_from_request(request.json)
+        return jsonify(run_coalesced('direct', single_flight_key('direct', user_question, additional_info), profile,
+                                     run_direct_llm, user_question, additional_info, profile))
     return jsonify(error="Invalid input"), 400
 
 # 主循環路由
-@app.route('/main_loop', methods=['POST'])
+@routes.route('/main_loop', methods=['POST'])
 def main_loop_route():
     user_question = request.json.get('user_question')
     direct_answer = request.json.get('direct_answer')
-    direct_tokens = request.json.get('direct_tokens', 0)
-    direct_score = request.json.get('direct_score', 0)
     additional_info = request.json.get('additional_info', "")
     original_facts = request.json.get('original_facts', "")
     print("[INFO] Received main_loop_route Request")
 
     if user_question and direct_answer:
+        try:
+            direct_result = direct_result_from_request(request.json)
+            beam_config = beam_config_from_request(request.json)
+            iteration_config = iteration_config_from_request(request.json)
+        except ValueError as e:
+            return jsonify(error=str(e)), 400
         # 直接調用 main_loop 並返回其結果
-        return main_loop(user_question, additional_info, original_facts)
+        return main_loop(user_question, additional_info, original_facts, direct_result,
+                         beam_config, profile_from_request(request.json), iteration_config,
+                         compact_from_request(request.json))
+    return jsonify(error="Invalid input"), 400
+
+# 主循環串流路由：以 Server-Sent Events 逐步返回每個階段的結果
+@routes.route('/main_loop_stream', methods=['POST'])
+def main_loop_stream_route():
+    user_question = request.json.get('user_question')
+    direct_answer = request.json.get('direct_answer')
+    profile = profile_from_request(request.json)
+    compact = compact_from_request(request.json)
+    additional_info = request.json.get('additional_info', "")
+    original_facts = request.json.get('original_facts', "")
+    print("[INFO] Received main_loop_stream_route Request")
+
+    if not (user_question and direct_answer):
+        return jsonify(error="Invalid input"), 400
+    try:
+        direct_result = direct_result_from_request(request.json)
+        beam_config = beam_config_from_request(request.json)
+        iteration_config = iteration_config_from_request(request.json)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+    def generate():
+        key = single_flight_key('main_loop_stream', user_question, additional_info, original_facts,
+                                direct_result, beam_config, iteration_config)
+        try:
+            events = coalesced_events(
+                'main_loop_stream', key, profile,
+                lambda: main_loop_events(user_question, additional_info, original_facts, stream=True,
+                                         direct_result=direct_result, beam_config=beam_config,
+                                         profile=profile, iteration_config=iteration_config))
+            for event, data in compact_events(events) if compact else events:
+                yield format_sse(event, data)
+        except Exception as e:
+            print(f"[錯誤] main_loop_stream 發生異常: {e}")
+            yield format_sse('error', {'message': str(e)})
+
+    return Response(stream_with_context(generate()),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})  # 避免反向代理緩衝串流
+
+# 按需取得某次迭代的完整內容（答案及評估），result_id 見主循環結果
+@routes.route('/results/<result_id>/iterations/<int:iteration>', methods=['GET'])
+def result_iteration_route(result_id, iteration):
+    stored = result_store.get(result_id)
+    if stored is None:
+        return jsonify(error="Result not found"), 404
+    for item in json.loads(stored):
+        if item['iteration'] == iteration:
+            return jsonify(item)
+    return jsonify(error="Iteration not found"), 404
+
+
+# 背景任務：直接 LLM 流程
+def direct_llm_job(job, user_question, additional_info="", profile=False):
+    job.check_cancelled()
+    return run_direct_llm(user_question, additional_info, profile)
+
+
+# 背景任務：主循環，每完成一個階段便更新任務的部分結果，並在階段之間檢查是否已取消
+def main_loop_job(job, user_question, additional_info="", original_facts="", direct_result=None, beam_config=None,
+                  profile=False, iteration_config=None):
+    for event, data in main_loop_events(user_question, additional_info, original_facts, direct_result=direct_result,
+                                        beam_config=beam_config, profile=profile, iteration_config=iteration_config):
+        job.check_cancelled()
+        if event == 'initial_answer':
+            job.update_partial(stage=event, initial_answer=data['answer'], initial_tokens=data['tokens'])
+        elif event == 'iteration':
+            job.append_partial('iterations_data', data)
+            job.update_partial(stage=event)
+        elif event == 'final_answer':
+            job.update_partial(stage=event, final_answer=data['answer'])
+        elif event == 'result':
+            return data
+
+
+# 提交背景任務，隊列已滿時返回 429
+def submit_job(kind, func, *args):
+    try:
+        job = job_queue.submit(kind, func, *args)
+    except QueueFullError as e:
+        return jsonify(error=str(e)), 429, {'Retry-After': '10'}
+    return jsonify(job_id=job.id, status=job.status, status_url=f"/jobs/{job.id}"), 202
+
+
+# 以背景任務方式執行直接 LLM 流程，立即返回任務 ID
+@routes.route('/jobs/direct_llm', methods=['POST'])
+def direct_llm_job_route():
+    user_question = request.json.get('user_question')
+    additional_info = request.json.get('additional_info', "")
+    print("[INFO] Received direct_llm_job_route Request")
+    if user_question:
+        return submit_job('direct_llm', direct_llm_job, user_question, additional_info,
+                          profile_from_request(request.json))
+    return jsonify(error="Invalid input"), 400
+
+
+# 以背景任務方式執行主循環，立即返回任務 ID
+@routes.route('/jobs/main_loop', methods=['POST'])
+def main_loop_job_route():
+    user_question = request.json.get('user_question')
+    direct_answer = request.json.get('direct_answer')
+    additional_info = request.json.get('additional_info', "")
+    original_facts = request.json.get('original_facts', "")
+    print("[INFO] Received main_loop_job_route Request")
+    if user_question and direct_answer:
+        try:
+            direct_result = direct_result_from_request(request.json)
+            beam_config = beam_config_from_request(request.json)
+            iteration_config = iteration_config_from_request(request.json)
+        except ValueError as e:
+            return jsonify(error=str(e)), 400
+        return submit_job('main_loop', main_loop_job, user_question, additional_info, original_facts,
+                          direct_result, beam_config,
+                          profile_from_request(request.json), iteration_config)
     return jsonify(error="Invalid input"), 400
 
+
+# 查詢任務狀態及部分結果
+@routes.route('/jobs/<job_id>', methods=['GET'])
+def job_status_route(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify(error="Job not found"), 404
+    return jsonify(job.to_dict())
+
+
+# 取消任務
+@routes.route('/jobs/<job_id>', methods=['DELETE'])
+def job_cancel_route(job_id):
+    job = job_queue.cancel(job_id)
+    if job is None:
+        return jsonify(error="Job not found"), 404
+    return jsonify(job_id=job.id, status=job.status, cancel_requested=job.cancel_requested)
+
+
+# 查詢任務隊列狀態
+@routes.route('/jobs', methods=['GET'])
+def jobs_stats_route():
+    return jsonify(job_queue.stats())
+
+# 工作進程的記憶體用量（字節），返回 (目前用量, 最高用量)；ru_maxrss 在 Linux 以 KB 為單位
+def process_memory():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    try:
+        with open('/proc/self/statm') as f:
+            rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        rss = peak
+    return rss, peak
+
+
+# 按 Accept-Encoding 以 gzip（或已安裝 brotli 時以 br）壓縮 JSON、文字及 SSE 回應
+RESPONSE_COMPRESSION = os.getenv("RESPONSE_COMPRESSION", "1") == "1"
+RESPONSE_COMPRESSION_MIN_BYTES = int(os.getenv("RESPONSE_COMPRESSION_MIN_BYTES", "500"))
+
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
+WARM_UP_ENABLED = os.getenv("WARM_UP", "1") == "1"
+startup_report = {}  # 冷啟動用時（秒）及記憶體用量，由 create_app() 填寫
+
+
+# 預熱 tiktoken 編碼器及 OpenAI 客戶端，避免由第一個請求承擔載入成本；返回各項用時
+def warm_up():
+    timings = {}
+    for name, func in (('encoder', lambda: get_encoder().encode("warm up")), ('openai_client', get_openai_client)):
+        start = time.perf_counter()
+        try:
+            func()
+        except Exception as e:
+            print(f"[錯誤] 預熱 {name} 時發生異常: {e}")
+        timings[name] = round(time.perf_counter() - start, 4)
+    return timings
+
+
+# 應用程式工廠：建立 Flask 應用程式並註冊路由，在工作進程啟動時預熱（warm_up 預設按 WARM_UP 環境變量），並記錄冷啟動用時及記憶體
+def create_app(warm_up_enabled=None):
+    start = time.perf_counter()
+    app = Flask(__name__, static_folder='static')
+    app.register_blueprint(routes)
+    if RESPONSE_COMPRESSION:
+        app.after_request(lambda response: compress_response(response, request.headers.get('Accept-Encoding'),
+                                                             RESPONSE_COMPRESSION_MIN_BYTES))
+    warm_up_timings = warm_up() if (WARM_UP_ENABLED if warm_up_enabled is None else warm_up_enabled) else {}
+    rss, _ = process_memory()
+    startup_report.update(import_seconds=round(IMPORT_SECONDS, 4),
+                          create_app_seconds=round(time.perf_counter() - start, 4),
+                          warm_up=warm_up_timings,
+                          rss_mb=round(rss / 1024 / 1024, 1))
+    for phase in ('import', 'create_app'):
+        metrics.set('startup_seconds', startup_report[f'{phase}_seconds'], "冷啟動各階段用時（秒）", phase=phase)
+    print(f"[INFO] 冷啟動用時 {IMPORT_SECONDS + startup_report['create_app_seconds']:.2f} 秒"
+          f"（導入 {IMPORT_SECONDS:.2f} 秒，建立應用程式 {startup_report['create_app_seconds']:.2f} 秒），"
+          f"記憶體 {startup_report['rss_mb']} MB")
+    return app
+
+
+# 存取 main.app（例如 gunicorn main:app、基準測試）時才建立應用程式，只導入模組（測試、batch_eval.py）不會預熱
+_app_lock = threading.Lock()
+
+
+def __getattr__(name):
+    if name != 'app':
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    with _app_lock:
+        if 'app' not in globals():
+            globals()['app'] = create_app()
+    return globals()['app']
+
+
 # 主程序入口
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8080, debug=True)
\ No newline at end of file
+    create_app().run(host='0.0.0.0', port=8080, debug=True)
\ No newline at end of file
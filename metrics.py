@@ -0,0 +1,107 @@
+import threading
+import time
+
+# 預設的延遲分佈區間（秒）
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# 進程內的指標登記：counter、gauge 及 histogram，以 Prometheus 文字格式輸出
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}  # 名稱 -> {'type', 'help', 'buckets', 'series': {labels: 數值或分佈}}
+
+    def _series(self, name, kind, help_text, labels, buckets=None):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = {'type': kind, 'help': help_text, 'buckets': buckets, 'series': {}}
+        return metric['series'], tuple(sorted(labels.items()))
+
+    def inc(self, name, help_text="", value=1, **labels):
+        with self._lock:
+            series, key = self._series(name, 'counter', help_text, labels)
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, help_text="", **labels):
+        with self._lock:
+            series, key = self._series(name, 'gauge', help_text, labels)
+            series[key] = value
+
+    def observe(self, name, value, help_text="", buckets=DEFAULT_BUCKETS, **labels):
+        with self._lock:
+            series, key = self._series(name, 'histogram', help_text, labels, buckets)
+            data = series.get(key)
+            if data is None:
+                data = series[key] = {'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    data['counts'][i] += 1
+            data['sum'] += value
+            data['count'] += 1
+
+    # 以 Prometheus 文字格式（0.0.4）輸出所有指標
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, metric in sorted(self._metrics.items()):
+                if metric['help']:
+                    lines.append(f"# HELP {name} {metric['help']}")
+                lines.append(f"# TYPE {name} {metric['type']}")
+                for key, value in sorted(metric['series'].items()):
+                    if metric['type'] != 'histogram':
+                        lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+                        continue
+                    for bound, count in zip(metric['buckets'] + (float('inf'),), value['counts'] + [value['count']], strict=True):
+                        lines.append(f"{name}_bucket{_format_labels(key + (('le', _format_value(bound)),))} {count}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {_format_value(value['sum'])}")
+                    lines.append(f"{name}_count{_format_labels(key)} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+
+# 單個請求的追蹤記錄：每個流程階段及 LLM 調用為一個 span（名稱、類別、開始時間、用時及屬性）
+# 可在多個線程中同時記錄（beam 模式並行的候選答案）
+class Trace:
+    def __init__(self, keep_spans=False):
+        self.keep_spans = keep_spans  # 是否保留每個 span 的明細（只在啟用 profiling 的請求中保留）
+        self.started = time.monotonic()
+        self.spans = []
+        self.summary = {}  # (類別, 名稱) -> 累計的 count、seconds 及數值屬性
+        self._lock = threading.Lock()
+
+    def record(self, kind, name, start, seconds, **attrs):
+        with self._lock:
+            stats = self.summary.setdefault((kind, name), {'count': 0, 'seconds': 0.0})
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            for key, value in attrs.items():
+                if isinstance(value, (int, float)):
+                    stats[key] = stats.get(key, 0) + value
+            if self.keep_spans:
+                self.spans.append(dict(kind=kind, name=name, start=round(start - self.started, 4),
+                                       seconds=round(seconds, 4), **attrs))
+
+    def to_dict(self):
+        with self._lock:
+            result = {'total_seconds': round(time.monotonic() - self.started, 4), 'stages': {}, 'llm': {}}
+            for (kind, name), stats in self.summary.items():
+                result['stages' if kind == 'stage' else 'llm'][name] = {
+                    key: round(value, 4) if isinstance(value, float) else value for key, value in stats.items()}
+            if self.keep_spans:
+                result['spans'] = sorted(self.spans, key=lambda span: span['start'])
+            return result
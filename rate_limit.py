@@ -0,0 +1,58 @@
+import threading
+import time
+
+
+# 令牌桶：容量為每分鐘的上限，按秒連續補充
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # 取得 amount 所需的等待秒數（0 表示可立即取得）；超出容量的請求只需等待桶滿
+    def wait_time(self, amount, now):
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount):
+        self.level -= amount
+
+
+# 每分鐘請求數（RPM）及 token 數（TPM）的速率限制，rpm / tpm 為 None 時不作限制
+class RateLimiter:
+    def __init__(self, rpm=None, tpm=None):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.waited_seconds = 0.0
+        self._lock = threading.Lock()
+
+    # 阻塞直至可發出一個預計使用 tokens 個 token 的請求
+    def acquire(self, tokens=0):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait = max(self.requests.wait_time(1, now) if self.requests else 0,
+                           self.tokens.wait_time(tokens, now) if self.tokens else 0)
+                if wait <= 0:
+                    if self.requests:
+                        self.requests.take(1)
+                    if self.tokens:
+                        self.tokens.take(tokens)
+                    return
+                self.waited_seconds += wait
+            time.sleep(wait)
+
+    # 請求完成後按實際用量修正預計的 token 數（delta 可為負數）
+    def adjust(self, delta):
+        if self.tokens and delta:
+            with self._lock:
+                self.tokens._refill(time.monotonic())
+                self.tokens.take(delta)
@@ -0,0 +1,79 @@
+import math
+import re
+from collections import Counter
+
+# 英文及數字按單詞切分，中日韓文字按相鄰兩字（bigram）切分
+_WORD_RE = re.compile(r'[a-z0-9]+(?:[.\-][a-z0-9]+)*')
+_CJK_RE = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]+')
+
+
+# 將文本切分為檢索用的詞項
+def tokenize(text):
+    text = text.lower()
+    terms = _WORD_RE.findall(text)
+    for run in _CJK_RE.findall(text):
+        if len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+
+# 按段落將網頁內容切分為不超過 chunk_chars 字符的片段（過長的段落會再按字符數切分）
+def split_chunks(text, chunk_chars=1200):
+    chunks = []
+    current = ""
+    for paragraph in re.split(r'\n\s*\n', text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        while len(paragraph) > chunk_chars:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(paragraph[:chunk_chars])
+            paragraph = paragraph[chunk_chars:]
+        if current and len(current) + len(paragraph) + 2 > chunk_chars:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+# 單一網頁的 BM25 索引
+class BM25Index:
+    def __init__(self, chunks, k1=1.5, b=0.75):
+        self.chunks = chunks
+        self.k1 = k1
+        self.b = b
+        self.term_freqs = [Counter(tokenize(chunk)) for chunk in chunks]
+        self.lengths = [sum(tf.values()) for tf in self.term_freqs]
+        self.avg_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0
+        doc_freq = Counter()
+        for tf in self.term_freqs:
+            doc_freq.update(tf.keys())
+        n = len(chunks)
+        self.idf = {term: math.log(1 + (n - df + 0.5) / (df + 0.5)) for term, df in doc_freq.items()}
+
+    # 估算索引佔用的字節數，用於快取的容量計算
+    @property
+    def size(self):
+        return sum(len(chunk.encode('utf-8')) * 2 for chunk in self.chunks)
+
+    # 返回與查詢最相關的 top_k 個片段 [(分數, 片段位置)]，按分數由高至低排列，只包括分數大於 0 的片段
+    def search(self, query, top_k=5):
+        query_terms = set(tokenize(query))
+        scores = []
+        for i, tf in enumerate(self.term_freqs):
+            norm = self.k1 * (1 - self.b + self.b * self.lengths[i] / self.avg_length) if self.avg_length else self.k1
+            score = 0.0
+            for term in query_terms:
+                freq = tf.get(term)
+                if freq:
+                    score += self.idf[term] * freq * (self.k1 + 1) / (freq + norm)
+            if score > 0:
+                scores.append((score, i))
+        scores.sort(key=lambda item: item[0], reverse=True)
+        return scores[:top_k]
@@ -0,0 +1,189 @@
+import atexit
+import datetime
+import json
+import math
+import os
+import threading
+import time
+import uuid
+from types import SimpleNamespace
+
+
+# 以本地目錄模擬 Replit Object Storage Client（只實現搜索日志用到的方法），用於本地開發及測試
+class LocalDirectoryStorage:
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.root, *name.split('/'))
+
+    def upload_from_text(self, name, text):
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, path)  # 以原子操作寫入，避免讀到寫了一半的內容
+
+    def download_as_text(self, name):
+        with open(self._path(name), encoding='utf-8') as f:
+            return f.read()
+
+    def list(self, prefix=None):
+        objects = []
+        for directory, _, files in os.walk(self.root):
+            for filename in files:
+                if filename.endswith('.tmp'):
+                    continue
+                name = os.path.relpath(os.path.join(directory, filename), self.root).replace(os.sep, '/')
+                if not prefix or name.startswith(prefix):
+                    objects.append(SimpleNamespace(name=name))
+        return objects
+
+
+# 只追加的搜索日志：日志項目先緩存在記憶體中，按批次寫入新的分段物件（JSON Lines），
+# 不會下載及重寫整個日志檔案，多個進程同時寫入亦不會互相覆蓋。
+# 分段名稱為 {prefix}{UTC 日期}/{開始毫秒}-{結束毫秒}-{寫入者}-{序號}.jsonl，每個分段只包含同一 UTC 日期的項目，
+# 查詢時按名稱只讀取所需的分段
+class SearchLog:
+    def __init__(self, storage, prefix="search-log/", batch_size=20, flush_interval=10, max_buffer=10000):
+        self.storage = storage
+        self.prefix = prefix
+        self.batch_size = batch_size  # 緩存達到此數量時立即寫入
+        self.flush_interval = flush_interval  # 背景定時寫入的間隔秒數
+        self.max_buffer = max_buffer  # 寫入失敗時最多保留的項目數量
+        self.writer_id = f"{os.getpid()}{uuid.uuid4().hex[:6]}"
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._sequence = 0
+        self._stop = threading.Event()
+        self._thread = None
+        if flush_interval:
+            self._thread = threading.Thread(target=self._flush_periodically, name='search-log-flusher', daemon=True)
+            self._thread.start()
+        atexit.register(self.close)
+
+    # 添加一個日志項目（字典），自動加上時間戳
+    def append(self, entry):
+        entry = dict(entry)
+        entry.setdefault('timestamp', time.time())
+        with self._lock:
+            self._buffer.append(entry)
+            should_flush = len(self._buffer) >= self.batch_size
+        if should_flush:
+            self.flush()
+
+    # 將緩存的項目寫入新的分段物件，返回寫入的項目數量；
+    # 項目按 UTC 日期分組，每組寫入一個分段，因此分段不會跨越日期（寫入失敗放回緩存的項目可能來自不同日期）
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batch, self._buffer = self._buffer, []
+            if not batch:
+                return 0
+            days = {}
+            for entry in batch:
+                day = datetime.datetime.fromtimestamp(entry['timestamp'], datetime.timezone.utc).strftime("%Y-%m-%d")
+                days.setdefault(day, []).append(entry)
+            written = 0
+            failed = []
+            for day, entries in sorted(days.items()):
+                if self._write_segment(day, entries):
+                    written += len(entries)
+                else:
+                    failed.extend(entries)
+            if failed:
+                with self._lock:
+                    # 放回緩存待下次重試，超出上限時丟棄最舊的項目
+                    self._buffer = (failed + self._buffer)[-self.max_buffer:]
+            return written
+
+    # 將同一日期的項目寫入一個分段，返回是否成功
+    def _write_segment(self, day, entries):
+        self._sequence += 1
+        timestamps = [entry['timestamp'] for entry in entries]
+        start_ms = int(min(timestamps) * 1000)
+        end_ms = int(max(timestamps) * 1000)
+        name = f"{self.prefix}{day}/{start_ms:013d}-{end_ms:013d}-{self.writer_id}-{self._sequence:06d}.jsonl"
+        text = ''.join(json.dumps(entry, ensure_ascii=False) + '\n' for entry in entries)
+        try:
+            self.storage.upload_from_text(name, text)
+        except Exception as e:
+            print(f"[錯誤] 寫入搜索日志分段 {name} 時發生異常: {e}")
+            return False
+        print(f"[INFO] 已寫入搜索日志分段 {name}（{len(entries)} 項）")
+        return True
+
+    # 查詢日志項目，按時間由新至舊排列；start / end 為 epoch 秒（可為 None），offset / limit 用於分頁
+    # 返回 (項目列表, 是否還有更多項目)
+    def query(self, start=None, end=None, offset=0, limit=50):
+        with self._lock:
+            pending = [entry for entry in self._buffer if self._in_range(entry['timestamp'], start, end)]
+        pending.sort(key=lambda entry: entry['timestamp'], reverse=True)
+
+        needed = offset + limit + 1  # 多取一項以判斷是否還有更多
+        entries = pending[:needed]
+        segments = self._segments(start, end)
+        # 分段按開始時間由新至舊讀取；已取得足夠項目後，結束時間早於已取得的最舊項目的分段無需下載
+        for _, segment_end, name in segments:
+            if len(entries) >= needed and segment_end < int(entries[needed - 1]['timestamp'] * 1000):
+                continue
+            try:
+                text = self.storage.download_as_text(name)
+            except Exception as e:
+                print(f"[錯誤] 讀取搜索日志分段 {name} 時發生異常: {e}")
+                continue
+            for line in text.splitlines():
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if self._in_range(entry['timestamp'], start, end):
+                    entries.append(entry)
+            entries.sort(key=lambda entry: entry['timestamp'], reverse=True)
+            del entries[needed:]
+        return entries[offset:offset + limit], len(entries) > offset + limit
+
+    # 列出與時間範圍重疊的分段 [(開始毫秒, 結束毫秒, 名稱)]，按開始時間由新至舊排列
+    def _segments(self, start=None, end=None):
+        prefixes = [self.prefix]
+        if start is not None and end is not None and end - start <= 31 * 86400:
+            # 時間範圍較短時只列出相關日期的分段（分段不會跨越 UTC 日期；仍包括前一天，以兼容舊版寫入的跨日分段）
+            first = datetime.datetime.fromtimestamp(start, datetime.timezone.utc).date() - datetime.timedelta(days=1)
+            last = datetime.datetime.fromtimestamp(end, datetime.timezone.utc).date()
+            prefixes = [f"{self.prefix}{first + datetime.timedelta(days=i):%Y-%m-%d}/"
+                        for i in range((last - first).days + 1)]
+        # 分段名稱中的毫秒數是向下取整的，因此查詢範圍亦按毫秒取整（開始向下、結束向上），
+        # 以免最新項目與 start 落在同一毫秒內的分段被略過
+        start_ms = math.floor(start * 1000) if start is not None else None
+        end_ms = math.ceil(end * 1000) if end is not None else None
+        segments = []
+        for prefix in prefixes:
+            for obj in self.storage.list(prefix=prefix):
+                filename = obj.name.rsplit('/', 1)[-1]
+                if not filename.endswith('.jsonl'):
+                    continue
+                try:
+                    segment_start, segment_end = (int(part) for part in filename.split('-')[:2])
+                except ValueError:
+                    continue
+                if start_ms is not None and segment_end < start_ms:
+                    continue
+                if end_ms is not None and segment_start > end_ms:
+                    continue
+                segments.append((segment_start, segment_end, obj.name))
+        segments.sort(reverse=True)
+        return segments
+
+    @staticmethod
+    def _in_range(timestamp, start, end):
+        return (start is None or timestamp >= start) and (end is None or timestamp <= end)
+
+    def _flush_periodically(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        self._stop.set()
+        self.flush()
@@ -0,0 +1,122 @@
+import threading
+import time
+
+
+# 一次共享執行的狀態：已產生的事件、結果或異常，可被多個請求同時等待
+class Flight:
+    def __init__(self):
+        self.events = []  # [(event, data)]，串流執行時逐步追加
+        self.result = None
+        self.error = None
+        self.done = False
+        self.finished_at = None
+        self._condition = threading.Condition()
+
+    def publish(self, event, data):
+        with self._condition:
+            self.events.append((event, data))
+            self._condition.notify_all()
+
+    def finish(self, result=None, error=None):
+        with self._condition:
+            self.result = result
+            self.error = error
+            self.done = True
+            self.finished_at = time.monotonic()
+            self._condition.notify_all()
+
+    # 等待執行完成並返回結果，執行失敗時拋出相同的異常
+    def wait(self):
+        with self._condition:
+            while not self.done:
+                self._condition.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    # 從頭重播已產生的事件，並繼續等待新事件直至執行完成；執行失敗時拋出相同的異常
+    def subscribe(self):
+        position = 0
+        while True:
+            with self._condition:
+                while position >= len(self.events) and not self.done:
+                    self._condition.wait()
+                pending = self.events[position:]
+                done = self.done
+            for item in pending:
+                yield item
+            position += len(pending)
+            if done and position >= len(self.events):
+                break
+        if self.error is not None:
+            raise self.error
+
+
+# 合併相同的並行請求：同一個鍵同時只執行一次，其他請求等待並共用結果（或串流事件）；
+# 成功的結果在完成後保留 ttl 秒，供稍後到達的相同請求直接使用；失敗的執行不會保留
+class SingleFlight:
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self._flights = {}  # 鍵 -> Flight（執行中或在保留期內）
+        self._lock = threading.Lock()
+
+    # 取得鍵對應的執行，返回 (flight, 角色)；角色為 leader（需要執行）、follower（等待執行中的結果）或 recent（保留期內的結果）
+    def _acquire(self, key):
+        with self._lock:
+            self._purge()
+            flight = self._flights.get(key)
+            if flight is not None:
+                return flight, 'recent' if flight.done else 'follower'
+            flight = self._flights[key] = Flight()
+            return flight, 'leader'
+
+    # 刪除已超出保留期的結果（需持有 self._lock）
+    def _purge(self):
+        now = time.monotonic()
+        for key in [key for key, flight in self._flights.items()
+                    if flight.done and now - flight.finished_at >= self.ttl]:
+            del self._flights[key]
+
+    def _finish(self, key, flight, result=None, error=None):
+        flight.finish(result, error)
+        if error is not None or self.ttl <= 0:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+
+    # 在當前線程執行 func（或等待相同請求的執行），返回 (結果, 角色)
+    def do(self, key, func, *args, **kwargs):
+        flight, role = self._acquire(key)
+        if role != 'leader':
+            return flight.wait(), role
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            self._finish(key, flight, error=e)
+            raise
+        self._finish(key, flight, result=result)
+        return result, role
+
+    # 在背景線程執行 factory() 返回的事件生成器，返回 (事件生成器, 角色)；
+    # 每個請求都從頭收到所有事件，請求中途斷開不會中止共享的執行
+    def events(self, key, factory):
+        flight, role = self._acquire(key)
+        if role == 'leader':
+            threading.Thread(target=self._run, args=(key, flight, factory), name='single-flight', daemon=True).start()
+        return flight.subscribe(), role
+
+    def _run(self, key, flight, factory):
+        try:
+            for event, data in factory():
+                flight.publish(event, data)
+        except Exception as e:
+            print(f"[錯誤] 共享執行發生異常: {e}")
+            self._finish(key, flight, error=e)
+            return
+        self._finish(key, flight)
+
+    def stats(self):
+        with self._lock:
+            self._purge()
+            running = sum(1 for flight in self._flights.values() if not flight.done)
+            return {'in_flight': running, 'recent': len(self._flights) - running}
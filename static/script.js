@@ -116,9 +116,9 @@ document.addEventListener('DOMContentLoaded', function() {
                     additionalInfoLabel.textContent += ' ✅';
                 }
 
-                // 然後發送 main_loop 請求
+                // 然後發送 main_loop 串流請求
                 progressInfo.textContent = '開始迭代優化...';
-                return fetch('/main_loop', {
+                return fetch('/main_loop_stream', {
                     method: 'POST',
                     headers: { 'Content-Type': 'application/json' },
                     body: JSON.stringify({ 
@@ -126,8 +126,12 @@ document.addEventListener('DOMContentLoaded', function() {
                         direct_answer: data.direct_answer, 
                         direct_tokens: data.direct_tokens, 
                         direct_score: data.direct_score, 
+                        direct_scores: data.direct_scores,
+                        direct_evaluation: data.direct_evaluation,
+                        direct_evaluation_tokens: data.direct_evaluation_tokens,
                         additional_info: additionalInfo,
-                        original_facts: data.original_facts
+                        original_facts: data.original_facts,
+                        compact: true  // 精簡模式：結果不重複串流中已發送的答案及迭代
                     })
                 });
             } else {
@@ -138,36 +142,49 @@ document.addEventListener('DOMContentLoaded', function() {
             if (!response.ok) {
                 throw new Error(`HTTP error! status: ${response.status}`);
             }
-            progressInfo.textContent = '迭代優化完成，正在生成最終答案...';
-            return response.json();
-        })
-        .then(data => {
-            console.log('Main loop response:', data);
-            saveFinalAnswerMarkdown(data.final_answer_markdown);
-            if (data.final_answer) {
-                document.getElementById('finalAnswerContent').innerText = data.final_answer;
-                document.getElementById('finalTokens').innerText = data.total_tokens || 'N/A';
-                document.getElementById('finalScore').innerText = (data.final_score || 0).toFixed(2);
-                document.getElementById('finalAnswerSection').style.display = 'block';
-            }
-            if (data.comparison_result) {
-                const comparisonResultContent = document.getElementById('comparisonResultContent');
-                comparisonResultContent.innerHTML = '';  // 清空現有內容
-                const resultParagraph = document.createElement('p');
-                resultParagraph.textContent = data.comparison_result;
-                comparisonResultContent.appendChild(resultParagraph);
-
-                updateComparisonTable(data.initial_scores || [], data.final_scores || []);
-                document.getElementById('comparisonResultSection').style.display = 'block';
-            }
-            if (data.iterations_data && Array.isArray(data.iterations_data)) {
-                drawChart(data.initial_score || 0, data.iterations_data);
-                document.getElementById('chartSection').style.display = 'block';
-            } else {
-                console.error('Invalid or missing iterations_data:', data.iterations_data);
-            }
-            progressInfo.textContent = '處理完成，顯示結果中...';
-            renderAllMarkdown();
+            const iterationsData = [];
+            let initialScore = 0;
+            let finalAnswer = '';
+            // 每收到一個階段的事件便即時更新頁面
+            return readEventStream(response, (event, data) => {
+                switch (event) {
+                    case 'start':
+                        progressInfo.textContent = '正在生成初始回答...';
+                        break;
+                    case 'delta':
+                        if (data.stage === 'final_answer') {
+                            document.getElementById('finalAnswerContent').innerText += data.text;
+                            document.getElementById('finalAnswerSection').style.display = 'block';
+                        }
+                        break;
+                    case 'initial_answer':
+                        progressInfo.textContent = '初始回答已生成，正在評估...';
+                        break;
+                    case 'iteration':
+                        if (data.iteration === 0) {
+                            initialScore = data.initial_score || 0;
+                        }
+                        iterationsData.push(data);
+                        drawChart(initialScore, iterationsData);
+                        document.getElementById('chartSection').style.display = 'block';
+                        progressInfo.textContent = `迭代 ${data.iteration} 完成 (評分: ${((data.score || 0) * 10).toFixed(2)})，繼續優化...`;
+                        break;
+                    case 'final_answer':
+                        finalAnswer = data.answer;
+                        saveFinalAnswerMarkdown(data.answer);
+                        document.getElementById('finalAnswerContent').innerText = data.answer;
+                        document.getElementById('finalTokens').innerText = data.total_tokens || 'N/A';
+                        document.getElementById('finalScore').innerText = (data.final_score || 0).toFixed(2);
+                        document.getElementById('finalAnswerSection').style.display = 'block';
+                        progressInfo.textContent = '最終答案已生成，正在比較答案...';
+                        break;
+                    case 'result':
+                        renderMainLoopResult({ ...data, final_answer: finalAnswer, iterations_data: iterationsData });
+                        break;
+                    case 'error':
+                        throw new Error(data.message);
+                }
+            });
         })
         .catch(error => {
             console.error('Error:', error);
@@ -179,6 +196,67 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     });
 
+    // 讀取 Server-Sent Events 串流，逐個事件回調 onEvent(event, data)
+    async function readEventStream(response, onEvent) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder('utf-8');
+        let buffer = '';
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) {
+                break;
+            }
+            buffer += decoder.decode(value, { stream: true });
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const frame = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+                let event = 'message';
+                const dataLines = [];
+                frame.split('\n').forEach(line => {
+                    if (line.startsWith('event:')) {
+                        event = line.slice(6).trim();
+                    } else if (line.startsWith('data:')) {
+                        dataLines.push(line.slice(5).trim());
+                    }
+                });
+                if (dataLines.length > 0) {
+                    onEvent(event, JSON.parse(dataLines.join('\n')));
+                }
+            }
+        }
+    }
+
+    // 顯示 main_loop 的完整結果
+    function renderMainLoopResult(data) {
+        console.log('Main loop response:', data);
+        saveFinalAnswerMarkdown(data.final_answer_markdown || data.final_answer);
+        if (data.final_answer) {
+            document.getElementById('finalAnswerContent').innerText = data.final_answer;
+            document.getElementById('finalTokens').innerText = data.total_tokens || 'N/A';
+            document.getElementById('finalScore').innerText = (data.final_score || 0).toFixed(2);
+            document.getElementById('finalAnswerSection').style.display = 'block';
+        }
+        if (data.comparison_result) {
+            const comparisonResultContent = document.getElementById('comparisonResultContent');
+            comparisonResultContent.innerHTML = '';  // 清空現有內容
+            const resultParagraph = document.createElement('p');
+            resultParagraph.textContent = data.comparison_result;
+            comparisonResultContent.appendChild(resultParagraph);
+
+            updateComparisonTable(data.initial_scores || [], data.final_scores || []);
+            document.getElementById('comparisonResultSection').style.display = 'block';
+        }
+        if (data.iterations_data && Array.isArray(data.iterations_data)) {
+            drawChart(data.initial_score || 0, data.iterations_data);
+            document.getElementById('chartSection').style.display = 'block';
+        } else {
+            console.error('Invalid or missing iterations_data:', data.iterations_data);
+        }
+        progressInfo.textContent = '處理完成，顯示結果中...';
+        renderAllMarkdown();
+    }
+
     function clearPreviousResults() {
         document.getElementById('directAnswerContent').innerText = '';
         document.getElementById('finalAnswerContent').innerText = '';
@@ -0,0 +1,166 @@
+import time
+
+# 優化迭代的停止策略：每個策略根據 StopController 記錄的迭代歷史判斷是否應停止，
+# 應停止時返回說明文字，否則返回 None。新增策略只需實現 name 及 check(controller)
+
+
+# 最佳評分已達到目標（0-1 範圍）
+class TargetScore:
+    name = 'target_score'
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+
+    def check(self, controller):
+        if controller.best_scores[-1] > self.threshold:
+            return f"最佳評分 {controller.best_scores[-1]:.2f} 已超過 {self.threshold}"
+        return None
+
+
+# 已完成的優化輪數達到上限
+class MaxRounds:
+    name = 'max_rounds'
+
+    def __init__(self, rounds):
+        self.rounds = rounds
+
+    def check(self, controller):
+        if controller.rounds >= self.rounds:
+            return f"已完成 {controller.rounds} 輪優化"
+        return None
+
+
+# 最近 rounds 輪的最佳評分提升均少於 epsilon
+class Plateau:
+    name = 'plateau'
+
+    def __init__(self, epsilon, rounds=1):
+        self.epsilon = epsilon
+        self.rounds = max(1, rounds)
+
+    def check(self, controller):
+        history = controller.best_scores
+        if len(history) <= self.rounds:
+            return None
+        gains = [history[i] - history[i - 1] for i in range(len(history) - self.rounds, len(history))]
+        if all(gain < self.epsilon for gain in gains):
+            return f"最近 {self.rounds} 輪評分提升 {[round(gain, 3) for gain in gains]} 均少於 {self.epsilon}"
+        return None
+
+
+# 請求已使用的 token 數加上預計下一輪的用量（上一輪的用量）會超出上限
+class TokenCeiling:
+    name = 'token_ceiling'
+
+    def __init__(self, max_tokens):
+        self.max_tokens = max_tokens
+
+    def check(self, controller):
+        used = controller.tokens_used()
+        if used + controller.last_round_tokens > self.max_tokens:
+            return f"已使用 {used} 個 token，預計下一輪需要 {controller.last_round_tokens} 個，上限為 {self.max_tokens}"
+        return None
+
+
+# 請求已花費的成本（美元）加上預計下一輪的成本會超出上限
+class CostCeiling:
+    name = 'cost_ceiling'
+
+    def __init__(self, max_cost, prompt_price, completion_price):
+        self.max_cost = max_cost
+        self.prompt_price = prompt_price  # 每百萬個提示 token 的價格
+        self.completion_price = completion_price  # 每百萬個輸出 token 的價格
+
+    def cost(self, prompt_tokens, completion_tokens):
+        return (prompt_tokens * self.prompt_price + completion_tokens * self.completion_price) / 1_000_000
+
+    def check(self, controller):
+        spent = self.cost(*controller.usage_snapshot())
+        next_round = self.cost(*controller.last_round_usage)
+        if spent + next_round > self.max_cost:
+            return f"已花費 ${spent:.4f}，預計下一輪需要 ${next_round:.4f}，上限為 ${self.max_cost}"
+        return None
+
+
+# 已用時間加上預計下一輪的用時（上一輪的用時）會超出截止時間
+class Deadline:
+    name = 'deadline'
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def check(self, controller):
+        elapsed = controller.elapsed()
+        if elapsed + controller.last_round_seconds > self.seconds:
+            return f"已用時 {elapsed:.1f} 秒，預計下一輪需要 {controller.last_round_seconds:.1f} 秒，截止時間為 {self.seconds} 秒"
+        return None
+
+
+# 按次序檢查各個停止策略，記錄觸發的策略；usage 為提供 prompt_tokens 及 completion_tokens 的用量統計
+class StopController:
+    def __init__(self, policies, usage=None, started=None):
+        self.policies = policies
+        self.usage = usage
+        self.started = started if started is not None else time.monotonic()
+        self.best_scores = []  # 初始回答及每輪優化後的最佳評分
+        self.rounds = 0
+        self.last_round_tokens = 0
+        self.last_round_usage = (0, 0)
+        self.last_round_seconds = 0.0
+        self.policy = None  # 觸發的策略名稱
+        self.detail = None
+        self._round_start = None
+
+    def usage_snapshot(self):
+        if self.usage is None:
+            return 0, 0
+        return self.usage.prompt_tokens, self.usage.completion_tokens
+
+    def tokens_used(self):
+        return sum(self.usage_snapshot())
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    # 截止時間前剩餘的秒數，沒有截止時間時返回 None
+    def remaining(self):
+        deadlines = [policy.seconds for policy in self.policies if isinstance(policy, Deadline)]
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - self.elapsed())
+
+    # 判斷是否應停止迭代，應停止時記錄觸發的策略並返回 True
+    def should_stop(self):
+        for policy in self.policies:
+            detail = policy.check(self)
+            if detail:
+                self.stop(policy.name, detail)
+                return True
+        return False
+
+    # 直接記錄停止原因（例如 beam 模式中所有候選答案都失敗）
+    def stop(self, policy, detail):
+        self.policy = policy
+        self.detail = detail
+        print(f"[INFO] 停止優化迭代（{policy}）：{detail}")
+
+    # 記錄初始回答的評分
+    def start(self, initial_score):
+        self.best_scores = [initial_score]
+
+    def start_round(self):
+        self._round_start = (self.usage_snapshot(), time.monotonic())
+
+    # 記錄一輪優化後的最佳評分、用量及用時（用於預計下一輪）
+    def end_round(self, best_score):
+        (prompt_start, completion_start), time_start = self._round_start
+        prompt_tokens, completion_tokens = self.usage_snapshot()
+        self.last_round_usage = (prompt_tokens - prompt_start, completion_tokens - completion_start)
+        self.last_round_tokens = sum(self.last_round_usage)
+        self.last_round_seconds = time.monotonic() - time_start
+        self.best_scores.append(best_score)
+        self.rounds += 1
+
+    def to_dict(self):
+        return {'policy': self.policy, 'detail': self.detail, 'rounds': self.rounds,
+                'best_scores': [round(score, 4) for score in self.best_scores]}
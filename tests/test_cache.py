@@ -0,0 +1,18 @@
+from cache import TTLCache
+
+
+def test_oversized_value_replaces_older_value():
+    cache = TTLCache(max_entries=10, max_bytes=100, ttl=60)
+    cache.set('key', "small")
+    cache.set('key', "x" * 500)
+
+    assert cache.get('key') is None
+
+
+def test_entries_are_evicted_by_total_bytes():
+    cache = TTLCache(max_entries=10, max_bytes=100, ttl=60)
+    cache.set('a', "x" * 60)
+    cache.set('b', "y" * 60)
+
+    assert cache.get('a') is None
+    assert cache.get('b') == "y" * 60
@@ -0,0 +1,77 @@
+import threading
+import time
+
+import httpx
+import openai
+import pytest
+
+from llm_client import Backoff, DeadlineExceeded, ResilientCaller
+
+
+def rate_limit_error():
+    request = httpx.Request('POST', "https://api.openai.com/v1/chat/completions")
+    response = httpx.Response(429, headers={'retry-after': '0'}, request=request)
+    return openai.RateLimitError("Rate limit reached", response=response, body=None)
+
+
+def test_retryable_errors_are_retried():
+    caller = ResilientCaller(Backoff(max_retries=3, base_delay=0.001))
+    failures = [rate_limit_error(), rate_limit_error()]
+
+    def attempt(_timeout, _stats):
+        if failures:
+            raise failures.pop()
+        return "ok"
+
+    result, stats = caller.call(attempt, deadline=5)
+
+    assert result == "ok"
+    assert (stats.attempts, stats.retries) == (3, 2)
+
+
+def test_hedge_wins_and_slow_primary_is_discarded():
+    caller = ResilientCaller(Backoff(max_retries=0))
+    calls = []
+    discarded = []
+    discarded_event = threading.Event()
+
+    def attempt(timeout, _stats):
+        calls.append(timeout)
+        if len(calls) == 1:
+            time.sleep(0.3)  # 原請求較慢
+            return "primary"
+        return "hedge"
+
+    def on_discard(result):
+        discarded.append(result)
+        discarded_event.set()
+
+    result, stats = caller.call(attempt, deadline=5, hedge_after=0.05, on_discard=on_discard)
+
+    assert result == "hedge"
+    assert stats.hedged and stats.hedge_won
+    assert discarded_event.wait(2)
+    assert discarded == ["primary"]
+
+
+def test_results_finishing_after_the_deadline_are_discarded():
+    caller = ResilientCaller(Backoff(max_retries=0))
+    release = threading.Event()
+    discarded = []
+    both_discarded = threading.Event()
+
+    def attempt(_timeout, _stats):
+        release.wait(2)
+        return "late"
+
+    def on_discard(result):
+        discarded.append(result)
+        if len(discarded) == 2:
+            both_discarded.set()
+
+    with pytest.raises(DeadlineExceeded):
+        caller.call(attempt, deadline=0.2, hedge_after=0.05, on_discard=on_discard)
+    release.set()
+
+    assert both_discarded.wait(2)
+    assert discarded == ["late", "late"]
@@ -0,0 +1,113 @@
+# 以本地的 Firecrawl 替身（sleep 或卡住的 scraper）測試補充資料網址的並行抓取、單一網址超時及整體截止時間
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+import pytest
+
+# main 在導入時讀取環境變量：搜索日志寫入臨時目錄，不需要 Object Storage 或任何 API 金鑰
+os.environ.setdefault('SEARCH_LOG_DIR', tempfile.mkdtemp(prefix="test-search-log-"))
+os.environ.setdefault('OPENAI_API_KEY', "test")
+os.environ.setdefault('FIRECRAWL_API_KEY', "test")
+os.environ['SCRAPE_CACHE_DB'] = ""
+
+import main  # noqa: E402
+
+PAGE_DELAY = 0.3
+
+
+def unique_urls(count):
+    # 每個測試使用不同的網址，避免命中之前測試寫入的網頁快取
+    prefix = uuid.uuid4().hex
+    return [f"https://example.com/{prefix}/page-{i}" for i in range(count)]
+
+
+def page(url):
+    return {'markdown': f"內容 {url}", 'metadata': {'statusCode': 200, 'title': url}}
+
+
+def sleeping_scraper(delay=PAGE_DELAY):
+    def scrape(url, **_kwargs):
+        time.sleep(delay)
+        return page(url)
+    return scrape
+
+
+@pytest.fixture
+def release():
+    # 卡住的 scraper 等待此事件；測試結束時釋放，令抓取線程返回線程池
+    event = threading.Event()
+    yield event
+    event.set()
+
+
+def test_urls_are_scraped_in_parallel():
+    urls = unique_urls(4)
+    start = time.monotonic()
+    results = main.scrape_urls(urls, scraper=sleeping_scraper(), url_timeout=5, deadline=5)
+    elapsed = time.monotonic() - start
+
+    assert [url for url, _ in results] == urls
+    assert all(content.endswith(f"內容 {url}") for url, content in results)
+    # 逐一抓取需要 4 * PAGE_DELAY 秒，並行抓取只需約一個 PAGE_DELAY
+    assert elapsed < 2 * PAGE_DELAY
+
+
+def test_hung_url_returns_partial_results(release):
+    urls = unique_urls(3)
+    hung_url = urls[1]
+
+    def scrape(url, **_kwargs):
+        if url == hung_url:
+            release.wait()
+        return page(url)
+
+    start = time.monotonic()
+    results = main.scrape_urls(urls, scraper=scrape, url_timeout=0.3, deadline=5)
+    elapsed = time.monotonic() - start
+
+    assert [url for url, _ in results] == [urls[0], urls[2]]
+    assert elapsed < 1
+
+
+def test_overall_deadline_holds(release):
+    urls = unique_urls(3)
+
+    def scrape(url, **_kwargs):
+        release.wait()
+        return page(url)
+
+    start = time.monotonic()
+    results = main.scrape_urls(urls, scraper=scrape, url_timeout=5, deadline=0.3)
+    elapsed = time.monotonic() - start
+
+    assert results == []
+    assert elapsed < 1
+
+
+def test_firecrawl_scrape_sets_a_client_timeout(monkeypatch):
+    import requests
+
+    calls = []
+
+    class FakeResponse:
+        def raise_for_status(self):
+            pass
+
+        def json(self):
+            return {'success': True, 'data': page("https://example.com")}
+
+    def fake_post(url, **kwargs):
+        calls.append((url, kwargs))
+        return FakeResponse()
+
+    monkeypatch.setattr(requests, 'post', fake_post)
+    data = main.firecrawl_scrape("https://example.com", params={'formats': ['markdown'], 'timeout': 2000})
+
+    assert data['markdown'] == "內容 https://example.com"
+    url, kwargs = calls[0]
+    assert url.endswith("/v1/scrape")
+    assert kwargs['json'] == {'url': "https://example.com", 'formats': ['markdown'], 'timeout': 2000}
+    assert kwargs['timeout'] == 2 + main.SCRAPE_CLIENT_GRACE
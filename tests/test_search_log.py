@@ -0,0 +1,97 @@
+# 以 LocalDirectoryStorage 測試只追加的搜索日志：時間範圍查詢、分頁、跨日期的寫入及寫入失敗後的重試
+import pytest
+
+from search_log import LocalDirectoryStorage, SearchLog
+
+DAY = 86400
+T = 1792320000.1237  # 2026-10-18 UTC
+
+
+class FailingStorage(LocalDirectoryStorage):
+    def __init__(self, root):
+        super().__init__(root)
+        self.failing = True
+
+    def upload_from_text(self, name, text):
+        if self.failing:
+            raise OSError("storage unavailable")
+        super().upload_from_text(name, text)
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return LocalDirectoryStorage(str(tmp_path))
+
+
+def make_log(storage):
+    return SearchLog(storage, batch_size=1000, flush_interval=0)
+
+
+def test_range_query_returns_entries_newest_first(storage):
+    log = make_log(storage)
+    for i in range(5):
+        log.append({'timestamp': T + i * 60, 'i': i})
+    log.flush()
+
+    entries, has_more = log.query(start=T + 60, end=T + 180)
+
+    assert [entry['i'] for entry in entries] == [3, 2, 1]
+    assert has_more is False
+
+
+def test_entry_in_the_same_millisecond_as_start_is_found(storage):
+    log = make_log(storage)
+    log.append({'timestamp': T})
+    log.flush()
+
+    entries, _ = log.query(start=T, end=T + 10)
+
+    assert [entry['timestamp'] for entry in entries] == [T]
+
+
+def test_pagination_across_segments_and_buffer(storage):
+    log = make_log(storage)
+    for i in range(6):
+        log.append({'timestamp': T + i, 'i': i})
+        if i % 2 == 1:
+            log.flush()  # 三個分段，每個兩項
+    log.append({'timestamp': T + 6, 'i': 6})  # 仍在緩存中
+
+    first, more_after_first = log.query(offset=0, limit=3)
+    second, more_after_second = log.query(offset=3, limit=3)
+    third, more_after_third = log.query(offset=6, limit=3)
+
+    assert [entry['i'] for entry in first] == [6, 5, 4]
+    assert [entry['i'] for entry in second] == [3, 2, 1]
+    assert [entry['i'] for entry in third] == [0]
+    assert (more_after_first, more_after_second, more_after_third) == (True, True, False)
+
+
+def test_flush_does_not_write_segments_across_days(storage):
+    log = make_log(storage)
+    log.append({'timestamp': T, 'day': 0})
+    log.append({'timestamp': T + 5 * DAY, 'day': 5})
+
+    assert log.flush() == 2
+    assert len(storage.list(prefix="search-log/")) == 2
+
+    entries, _ = log.query(start=T + 5 * DAY - 10, end=T + 5 * DAY + 10)
+    assert [entry['day'] for entry in entries] == [5]
+    entries, _ = log.query(start=T - 10, end=T + 10)
+    assert [entry['day'] for entry in entries] == [0]
+
+
+def test_failed_upload_is_retried_and_queryable_by_day(tmp_path):
+    storage = FailingStorage(str(tmp_path))
+    log = make_log(storage)
+    log.append({'timestamp': T, 'day': 0})
+    assert log.flush() == 0
+    log.append({'timestamp': T + 5 * DAY, 'day': 5})
+
+    storage.failing = False
+    assert log.flush() == 2
+
+    entries, _ = log.query(start=T + 5 * DAY - 10, end=T + 5 * DAY + 10)
+    assert [entry['day'] for entry in entries] == [5]
+    entries, _ = log.query()
+    assert [entry['day'] for entry in entries] == [5, 0]
@@ -0,0 +1,47 @@
+import re
+from difflib import SequenceMatcher
+
+# 按句子切分（句末標點及換行歸入前一句），所有片段連接後等於原文
+_SEGMENT_RE = re.compile(r'[^\n。！？!?；;]+[\n。！？!?；;]*|[\n。！？!?；;]+')
+
+
+def split_segments(text):
+    return _SEGMENT_RE.findall(text)
+
+
+# 計算由 previous 變為 current 的差異，返回操作列表：
+# 正整數 n 表示複製 previous 接下來的 n 個字符，負整數 -n 表示略過 previous 接下來的 n 個字符，字符串表示插入該文本
+def diff_text(previous, current):
+    old, new = split_segments(previous), split_segments(current)
+    ops = []
+
+    def add(op):
+        if ops and type(ops[-1]) is type(op) and (isinstance(op, str) or (ops[-1] > 0) == (op > 0)):
+            ops[-1] += op
+        else:
+            ops.append(op)
+
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, old, new, autojunk=False).get_opcodes():
+        if tag == 'equal':
+            add(sum(len(segment) for segment in old[i1:i2]))
+            continue
+        if i2 > i1:
+            add(-sum(len(segment) for segment in old[i1:i2]))
+        if j2 > j1:
+            add("".join(new[j1:j2]))
+    return ops
+
+
+# 把 diff_text 返回的操作套用到 previous，返回新的文本
+def apply_diff(previous, ops):
+    parts = []
+    position = 0
+    for op in ops:
+        if isinstance(op, str):
+            parts.append(op)
+        elif op > 0:
+            parts.append(previous[position:position + op])
+            position += op
+        else:
+            position -= op
+    return "".join(parts)
@@ -0,0 +1,60 @@
+import threading
+
+# 被截斷的部分末尾加上的標記
+TRIM_MARKER = "\n...(內容過長，已截斷)"
+
+
+# 提示的 token 預算：量度提示中每個可變部分的 token 數，總數超出該階段的預算時，
+# 按優先次序由低至高截斷各部分，直至符合預算
+class TokenBudget:
+    def __init__(self, get_encoder, budgets, default_budget=12000):
+        self.get_encoder = get_encoder  # 返回 tiktoken 編碼器的函數（編碼器應只建立一次）
+        self.budgets = budgets
+        self.default_budget = default_budget
+        self._lock = threading.Lock()
+        self._stats = {}  # 階段 -> {'prompts', 'trimmed_prompts', 'trimmed_tokens', 'last_tokens'}
+
+    def budget_for(self, stage):
+        return self.budgets.get(stage, self.default_budget)
+
+    # sections 為 (文本, 優先次序, 保留方式) 的列表：優先次序越低越先被截斷；
+    # 保留方式為 'head'（保留開頭）、'tail'（保留結尾，例如較新的上下文）或 None（不可截斷）
+    # 返回 (截斷後的文本列表, 被截斷的 token 數)
+    def fit(self, stage, sections):
+        encoder = self.get_encoder()
+        tokens = [encoder.encode(text) if text else [] for text, _, _ in sections]
+        total = sum(len(t) for t in tokens)
+        budget = self.budget_for(stage)
+        texts = [text for text, _, _ in sections]
+        over = total - budget
+        trimmed = 0
+        if over > 0:
+            order = sorted((i for i, (_, _, keep) in enumerate(sections) if keep and tokens[i]),
+                           key=lambda i: sections[i][1])
+            for i in order:
+                if over <= 0:
+                    break
+                cut = min(over, len(tokens[i]))
+                keep_count = len(tokens[i]) - cut
+                if sections[i][2] == 'tail':
+                    kept = tokens[i][cut:]
+                    texts[i] = (TRIM_MARKER.strip() + "\n" if kept else "") + encoder.decode(kept)
+                else:
+                    kept = tokens[i][:keep_count]
+                    texts[i] = encoder.decode(kept) + (TRIM_MARKER if kept else "")
+                over -= cut
+                trimmed += cut
+            if trimmed:
+                print(f"[INFO] {stage}: 提示共 {total} tokens，超出預算 {budget}，已截斷 {trimmed} tokens")
+        with self._lock:
+            stats = self._stats.setdefault(stage, {'prompts': 0, 'trimmed_prompts': 0, 'trimmed_tokens': 0, 'last_tokens': 0})
+            stats['prompts'] += 1
+            stats['last_tokens'] = total - trimmed
+            if trimmed:
+                stats['trimmed_prompts'] += 1
+                stats['trimmed_tokens'] += trimmed
+        return texts, trimmed
+
+    def stats(self):
+        with self._lock:
+            return {stage: dict(stats, budget=self.budget_for(stage)) for stage, stats in self._stats.items()}